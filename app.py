@@ -6,43 +6,68 @@ TODO:
 """
 
 import streamlit as st
-from methods.utils import setup_page
+from tabs.widgets import setup_page, render_memory_report, render_profile_report
 from methods.backuper import init_backup
-from methods.utils import load_data
+from methods.operations import load_data
+from methods.profiling import profile_mode, profile_rerun
 from tabs.loans import render_loans_tab
 from tabs.loaners import render_loaners_tab
 from tabs.books import render_books_tab
 from tabs.stats import render_statistics_tab
 from tabs.history import render_history_table
 
+# Sections of the app, keyed by their value in the ?tab= query param
+SECTIONS = {
+    'loans': "📖 השאלות",
+    'books': "📚 ספרים",
+    'loaners': "👥 שואלים",
+    'stats': "📊 סטטיסטיקות",
+    'history': "📜 היסטוריית השאלות",
+}
+
+def select_section():
+    """Render the section navigation, kept in sync with the ?tab= query param"""
+    if 'section' not in st.session_state:
+        section = st.query_params.get('tab')
+        st.session_state['section'] = section if section in SECTIONS else next(iter(SECTIONS))
+    section = st.radio("ניווט", list(SECTIONS), format_func=SECTIONS.get, horizontal=True,
+                       label_visibility='collapsed', key='section')
+    st.query_params['tab'] = section
+    return section
+
 def main():
     """Main function to run the Streamlit app"""
-    # init_backup()
+    # Starts the write-triggered backup thread on the first run only
+    init_backup()
 
     # Setup page
     setup_page()
-    
-    # Load data
-    books_df, loaners_df, loans_df = load_data()
-    
-    # Create tabs
-    tab1, tab2, tab3, tab4, tab5 = st.tabs(["📖 השאלות", "📚 ספרים", "👥 שואלים", "📊 סטטיסטיקות", "📜 היסטוריית השאלות"])
-    
-    # Render each tab
-    with tab1:
-        render_loans_tab(books_df, loaners_df, loans_df)
-    
-    with tab2:
-        render_books_tab(books_df, loaners_df, loans_df)
-    
-    with tab3:
-        render_loaners_tab(loaners_df, loans_df)
-    
-    with tab4:
-        stats_df = render_statistics_tab(books_df, loaners_df, loans_df)
-
-    with tab5:
-        render_history_table(stats_df)
+
+    # Only the selected section is rendered (st.tabs would run every tab body on each rerun)
+    section = select_section()
+
+    # ?profile=1 (or SIMPLIB_PROFILE=1) times the rerun, ?profile=cprofile also dumps a cProfile of it
+    history = st.session_state.setdefault('profile_history', [])
+    with profile_rerun(section, profile_mode(st.query_params.get('profile')), history) as record:
+        if section == 'loans':
+            render_loans_tab()
+        elif section == 'books':
+            books_df, _, _ = load_data()
+            render_books_tab(books_df)
+        elif section == 'loaners':
+            _, loaners_df, _ = load_data()
+            render_loaners_tab(loaners_df)
+        elif section == 'stats':
+            books_df, loaners_df, _ = load_data()
+            render_statistics_tab(books_df, loaners_df)
+        elif section == 'history':
+            render_history_table()
+    if record is not None:
+        render_profile_report(history)
+
+    # ?memory=1 shows what the shared frames and this session hold in memory
+    if st.query_params.get('memory'):
+        render_memory_report()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,13 @@
+"""
+Helpers shared by the benchmarks, without any dependency (the import time
+benchmark must not load the app to find out what it is measuring).
+"""
+
+import subprocess
+
+def git_commit():
+    """Return the short hash of the checked out commit, None outside a git checkout"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -0,0 +1,117 @@
+"""
+Concurrent writers benchmark: several librarian sessions check out, return and
+edit books against one storage at the same time, then the stored data is
+checked to make sure no loan or edit was lost.
+
+Each worker (a process, or a thread with --threads) owns its own books, so all
+of its writes must survive. The log compaction thresholds are lowered so the
+snapshots are rewritten many times while the other workers keep appending.
+
+    python -m benchmarks.concurrent_writes
+    python -m benchmarks.concurrent_writes --backend sqlite --workers 16 --loans 100
+    python -m benchmarks.concurrent_writes --backend parquet
+    python -m benchmarks.concurrent_writes --threads
+"""
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+import pandas as pd
+
+from benchmarks.storage_formats import make_storage
+from methods.storage import LOAN_COLUMNS
+
+# Compact the CSV logs often, so compactions race with the appends of the other workers
+COMPACT_BYTES = 2 * 1024
+
+def create_data(backend, directory, workers, loans):
+    """Create workers loaners and workers * loans books with no loans"""
+    books_df = pd.DataFrame({'id': range(1, workers * loans + 1), 'name': 'ספר', 'author': 'מחבר', 'category': '', 'active': True})
+    books_df['name'] = books_df['name'] + ' ' + books_df['id'].astype(str)
+    loaners_df = pd.DataFrame({'id': range(1, workers + 1), 'name': 'שואל', 'surname': '', 'phone': '', 'active': True})
+    loans_df = pd.DataFrame(columns=LOAN_COLUMNS)
+    if backend == 'csv':
+        books_df.to_csv(os.path.join(directory, 'book_names.csv'), index=False)
+        loaners_df.to_csv(os.path.join(directory, 'book_loaners.csv'), index=False)
+        loans_df.to_csv(os.path.join(directory, 'loans_log.csv'), index=False)
+    else:
+        storage = make_storage(backend, directory, COMPACT_BYTES)
+        storage.save_books(books_df)
+        storage.save_loaners(loaners_df)
+        if backend == 'parquet':
+            # Parquet loans are a snapshot file like the CSV ones, SQLite starts with an empty table
+            storage.save_loans(loans_df)
+
+def worker(backend, directory, worker_id, loans):
+    """Loan each of the worker's books, return every other one and edit its category"""
+    storage = make_storage(backend, directory, COMPACT_BYTES)
+    loan_date = date.today() - timedelta(days=worker_id)
+    for k in range(loans):
+        book_id = worker_id * loans + k + 1
+        storage.record_loan(worker_id + 1, book_id, loan_date)
+        if k % 2 == 0:
+            storage.record_return(worker_id + 1, book_id, loan_date, date.today())
+        storage.update_books({book_id: {'category': f'worker {worker_id}'}})
+
+def verify(backend, directory, workers, loans):
+    """Return a list of problems found in the stored data"""
+    storage = make_storage(backend, directory, COMPACT_BYTES)
+    loans_df = storage.load_loans()
+    books_df = storage.load_books().set_index('id')
+    problems = []
+    if len(loans_df) != workers * loans:
+        problems.append(f"expected {workers * loans} loans, found {len(loans_df)}")
+    if loans_df['book_id'].duplicated().any():
+        problems.append(f"{loans_df['book_id'].duplicated().sum()} books were loaned twice")
+    returned = set(loans_df.loc[loans_df['return_date'].notna(), 'book_id'])
+    for worker_id in range(workers):
+        for k in range(loans):
+            book_id = worker_id * loans + k + 1
+            if book_id not in set(loans_df['book_id']):
+                problems.append(f"loan of book {book_id} was lost")
+            if (k % 2 == 0) != (book_id in returned):
+                problems.append(f"return of book {book_id} was lost")
+            if books_df.at[book_id, 'category'] != f'worker {worker_id}':
+                problems.append(f"edit of book {book_id} was lost")
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description="Run concurrent writers against one storage and check that nothing was lost")
+    parser.add_argument('--backend', choices=['csv', 'sqlite', 'parquet'], default='csv')
+    parser.add_argument('--workers', type=int, default=8, help="number of concurrent writers")
+    parser.add_argument('--loans', type=int, default=50, help="loans per writer")
+    parser.add_argument('--threads', action='store_true', help="run the writers as threads of one process instead of processes")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='simplib_bench_')
+    try:
+        create_data(args.backend, directory, args.workers, args.loans)
+        runner = threading.Thread if args.threads else multiprocessing.Process
+        writers = [runner(target=worker, args=(args.backend, directory, i, args.loans)) for i in range(args.workers)]
+        start = time.perf_counter()
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        elapsed = time.perf_counter() - start
+
+        # Each loan is a checkout, an edit and (for every other one) a return
+        writes = args.workers * args.loans * 2 + args.workers * ((args.loans + 1) // 2)
+        print(f"{args.backend}, {args.workers} {'threads' if args.threads else 'processes'}: "
+              f"{writes} writes in {elapsed:.2f}s ({writes / elapsed:.0f} writes/s)")
+        problems = verify(args.backend, directory, args.workers, args.loans)
+        for problem in problems[:20]:
+            print(f"  {problem}")
+        print("FAILED" if problems else "OK - no loan, return or edit was lost")
+        return 1 if problems else 0
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == "__main__":
+    raise SystemExit(main())
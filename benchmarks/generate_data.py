@@ -0,0 +1,179 @@
+"""
+Synthetic library data: a Hebrew catalog, loaners and a loan history of any size.
+
+The data is reproducible from the seed and the end date. Borrowing is skewed
+toward popular titles and active loaners (Zipf weights, the copies of a title
+share its popularity), authors write in one category, loaners share family
+names, no loan is made on Saturday and a copy is never loaned twice at the same
+time: a loan ends at the latest when the next loan of the same copy starts, and
+only the last loan of a copy can still be open. About one loan in twenty is
+kept for more than a month, so recent ones show up as late.
+
+    python -m benchmarks.generate_data --out data/synthetic
+    python -m benchmarks.generate_data --books 50000 --loaners 5000 --loans 1000000 --years 10 --out data/large
+    SIMPLIB_DATA_DIR=data/large streamlit run app.py
+"""
+
+import argparse
+import os
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.storage_formats import make_storage
+
+FIRST_NAMES = [
+    'אברהם', 'יצחק', 'יעקב', 'משה', 'אהרן', 'דוד', 'שלמה', 'יוסף', 'בנימין', 'יהודה', 'אוריה', 'נועם', 'איתי', 'עומר',
+    'יונתן', 'אריאל', 'דניאל', 'אליה', 'גיא', 'רון', 'עידו', 'אסף', 'תומר', 'אלון', 'שרה', 'רבקה', 'רחל', 'לאה',
+    'מרים', 'חנה', 'אסתר', 'רות', 'נועה', 'תמר', 'מיכל', 'יעל', 'שירה', 'מאיה', 'אביגיל', 'הדס', 'טליה', 'אורית',
+    'דנה', 'ענבל', 'ליאת', 'נטע', 'הילה', 'רוני',
+]
+SURNAMES = [
+    'כהן', 'לוי', 'מזרחי', 'פרץ', 'ביטון', 'דהן', 'אברהם', 'פרידמן', 'אזולאי', 'מלכה', 'כץ', 'יוסף', 'חדד', 'עמר',
+    'אוחיון', 'גבאי', 'שפירא', 'בן דוד', 'רוזנברג', 'גולדשטיין', 'וייס', 'ברק', 'שחר', 'אלון', 'רביבו', 'סויסה',
+    'נחום', 'טל', 'שמעוני', 'הלוי', 'קליין', 'אשכנזי', 'ספרדי', 'בירנבאום', 'זילברמן', 'גרינברג',
+]
+NOUNS = [
+    'הבית', 'הים', 'השביל', 'הגן', 'הלילה', 'החלום', 'הסוד', 'המסע', 'השעון', 'הצל', 'האור', 'הנהר', 'היער', 'המכתב',
+    'השער', 'הדרך', 'העץ', 'המגדל', 'האי', 'הזיכרון', 'השיר', 'המלך', 'הנסיכה', 'הכוכב', 'המפה', 'הגשר', 'החורף',
+    'הקיץ', 'הרוח', 'האבן', 'הציפור', 'הספינה', 'המראה', 'השתיקה', 'הבאר', 'המפתח',
+]
+PLACES = [
+    'בירושלים', 'בגליל', 'במדבר', 'בעיר', 'בכפר', 'על ההר', 'ליד הים', 'בצפון', 'בדרום', 'בעמק', 'בנגב', 'בתל אביב',
+    'בחיפה', 'בצפת', 'מעבר לנהר', 'בסוף הרחוב', 'בין העצים', 'תחת השמיים',
+]
+CATEGORIES = [
+    'ילדים', 'שירה', 'ספרות ישראלית', 'פנטזיה', 'פילוסופיה', 'סיפורים קצרים', 'דת', 'רומן', 'אימה', 'היסטורי', 'דרמה',
+    'טרגדיה', 'ביוגרפיה', 'מדע בדיוני', 'הרפתקאות', 'קומדיה', 'פסיכולוגיה', 'אגדה', 'קומיקס', 'מוסר',
+]
+
+# Share of the books that are copies of another title, and of the loans kept for more than a month
+COPY_SHARE = 0.15
+LONG_LOAN_SHARE = 0.05
+# Share of the books and loaners that are no longer active (never ones with an open loan)
+INACTIVE_SHARE = 0.03
+
+def zipf_weights(rng, count, skew):
+    """Return count probabilities following a Zipf law of exponent skew, in a random order"""
+    weights = 1.0 / np.arange(1, count + 1) ** skew
+    rng.shuffle(weights)
+    return weights / weights.sum()
+
+def make_titles(rng, count):
+    """Return count distinct Hebrew book titles"""
+    kind = rng.integers(0, 3, count)
+    noun = pd.Series(rng.choice(NOUNS, count), dtype=object)
+    titles = pd.Series(np.select(
+        [kind == 0, kind == 1],
+        [noun + ' ' + rng.choice(PLACES, count), noun + ' של ' + rng.choice(FIRST_NAMES, count)],
+        default=noun + ' ו' + rng.choice(NOUNS, count)))
+    # Repeated titles become the next volumes of a series
+    volume = titles.groupby(titles).cumcount() + 1
+    return titles.where(volume == 1, titles + ' ' + volume.astype(str)).to_numpy()
+
+def make_books(rng, count, skew):
+    """Return (books, probability of each book being loaned)"""
+    titles = max(1, round(count * (1 - COPY_SHARE)))
+    authors = max(1, count // 8)
+    author_names = pd.Series(rng.choice(FIRST_NAMES, authors), dtype=object) + ' ' + rng.choice(SURNAMES, authors)
+    author_categories = rng.choice(CATEGORIES, authors, p=zipf_weights(rng, len(CATEGORIES), 0.7))
+    # Prolific authors write many titles
+    title_author = rng.choice(authors, titles, p=zipf_weights(rng, authors, 0.7))
+    # The first books are one per title, the rest copies of random titles
+    book_title = np.concatenate([np.arange(titles), rng.integers(0, titles, count - titles)])
+    books_df = pd.DataFrame({
+        'id': np.arange(1, count + 1),
+        'name': make_titles(rng, titles)[book_title],
+        'author': author_names.to_numpy()[title_author[book_title]],
+        'category': author_categories[title_author[book_title]],
+        'active': True,
+    })
+    # Copies share the popularity of their title
+    title_weights = zipf_weights(rng, titles, skew)
+    copies = np.bincount(book_title, minlength=titles)
+    weights = title_weights[book_title] / copies[book_title]
+    return books_df, weights / weights.sum()
+
+def make_loaners(rng, count):
+    """Return (loaners, probability of each loaner borrowing)"""
+    # Families share a surname, so surnames repeat a lot more than first names
+    loaners_df = pd.DataFrame({
+        'id': np.arange(1, count + 1),
+        'name': rng.choice(FIRST_NAMES, count),
+        'surname': rng.choice(SURNAMES, count, p=zipf_weights(rng, len(SURNAMES), 1.0)),
+        'phone': ['05' + ''.join(digits) for digits in rng.integers(0, 10, (count, 8)).astype(str)],
+        'active': True,
+    })
+    return loaners_df, zipf_weights(rng, count, 0.8)
+
+def make_loans(rng, count, years, end, book_weights, loaner_weights):
+    """Return count loans over the years before end, oldest first, none of them overlapping on a copy"""
+    end = pd.Timestamp(end)
+    days = np.sort(rng.integers(0, years * 365 + 1, count))
+    loan_date = pd.Series(end - pd.to_timedelta(years * 365 - days, unit='D'))
+    # The library is closed on Saturday
+    loan_date = loan_date.where(loan_date.dt.dayofweek != 5, loan_date + pd.Timedelta(days=1))
+    loan_date = loan_date.where(loan_date <= end, loan_date - pd.Timedelta(days=2)).sort_values(ignore_index=True)
+    duration = rng.gamma(2.0, 7.0, count).round().astype(int) + 1
+    long_loans = rng.random(count) < LONG_LOAN_SHARE
+    duration[long_loans] += rng.integers(30, 120, long_loans.sum())
+    loans_df = pd.DataFrame({
+        'loaner_id': rng.choice(len(loaner_weights), count, p=loaner_weights) + 1,
+        'book_id': rng.choice(len(book_weights), count, p=book_weights) + 1,
+        'loan_date': loan_date,
+        'return_date': loan_date + pd.to_timedelta(duration, unit='D'),
+    })
+    # A copy is returned at the latest when it is loaned again, and only its last loan can still be open
+    next_loan = loans_df.groupby('book_id')['loan_date'].shift(-1)
+    loans_df['return_date'] = loans_df['return_date'].where(next_loan.isna() | (loans_df['return_date'] < next_loan), next_loan)
+    loans_df.loc[next_loan.isna() & (loans_df['return_date'] > end), 'return_date'] = pd.NaT
+    # A loan is identified by its loaner, book and date
+    return loans_df.drop_duplicates(['loaner_id', 'book_id', 'loan_date']).reset_index(drop=True)
+
+def deactivate(rng, df, id_column, loans_df):
+    """Mark INACTIVE_SHARE of the rows inactive, skipping those with an open loan"""
+    open_ids = loans_df.loc[loans_df['return_date'].isna(), id_column]
+    candidates = df.loc[~df['id'].isin(open_ids), 'id'].to_numpy()
+    inactive = rng.choice(candidates, min(len(candidates), round(len(df) * INACTIVE_SHARE)), replace=False)
+    df.loc[df['id'].isin(inactive), 'active'] = False
+
+def generate(books=500, loaners=150, loans=5000, years=3, skew=0.6, seed=0, end=None):
+    """Return (books_df, loaners_df, loans_df) of a synthetic library, the same for the same arguments"""
+    rng = np.random.default_rng(seed)
+    end = end or date.today()
+    books_df, book_weights = make_books(rng, books, skew)
+    loaners_df, loaner_weights = make_loaners(rng, loaners)
+    loans_df = make_loans(rng, loans, years, end, book_weights, loaner_weights)
+    deactivate(rng, books_df, 'book_id', loans_df)
+    deactivate(rng, loaners_df, 'loaner_id', loans_df)
+    return books_df, loaners_df, loans_df
+
+def write_data(directory, books_df, loaners_df, loans_df):
+    """Write the frames as the CSV files of a data directory"""
+    os.makedirs(directory, exist_ok=True)
+    storage = make_storage('csv', directory)
+    storage.save_books(books_df)
+    storage.save_loaners(loaners_df)
+    storage.save_loans(loans_df)
+    return storage
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic library data directory")
+    parser.add_argument('--out', required=True, help="directory to write the CSV files to")
+    parser.add_argument('--books', type=int, default=500)
+    parser.add_argument('--loaners', type=int, default=150)
+    parser.add_argument('--loans', type=int, default=5000)
+    parser.add_argument('--years', type=int, default=3, help="years of loan history")
+    parser.add_argument('--skew', type=float, default=0.6, help="Zipf exponent of the title popularity")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--end', type=date.fromisoformat, help="date of the last loan, YYYY-MM-DD (default today)")
+    args = parser.parse_args()
+
+    books_df, loaners_df, loans_df = generate(args.books, args.loaners, args.loans, args.years, args.skew, args.seed, args.end)
+    write_data(args.out, books_df, loaners_df, loans_df)
+    print(f"Wrote {len(books_df):,} books, {len(loaners_df):,} loaners and {len(loans_df):,} loans "
+          f"({loans_df['return_date'].isna().sum():,} open) to {args.out}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Hot paths benchmark: times the functions a rerun spends its time in against
+synthetic libraries of growing size, headless, and writes the results as JSON.
+
+For each size a library is made with benchmarks.generate_data (books and
+loaners grow with the loans), saved to a temporary directory in the chosen
+backend, and each case is run --repeat times, the state it depends on being
+reset before every run for the cold cases. With --archive-days the loans
+returned that many days before the end of the data are archived first, so the
+loans store only holds the recent ones. Two result files can be compared case
+by case with --compare.
+
+    python -m benchmarks.hot_paths
+    python -m benchmarks.hot_paths --sizes 10000 100000 --backend parquet --out before.json
+    python -m benchmarks.hot_paths --sizes 10000 100000 --backend parquet --compare before.json
+    python -m benchmarks.hot_paths --sizes 100000 1000000 --archive-days 365
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+
+import paths
+from benchmarks.common import git_commit
+from benchmarks.generate_data import generate, write_data
+from benchmarks.storage_formats import make_storage
+from methods import aggregates, metrics, search, views
+from methods import storage as storage_module
+from methods.migrate import copy_storage
+from methods.operations import load_data
+from tabs.history import HISTORY_PAGE_ROWS
+from tabs.stats import render_stats_calculations
+
+SIZES = [10_000, 100_000, 1_000_000]
+# Rows of a table page, as shown by the books and loaners tabs
+PAGE_ROWS = 25
+# Fixed so the same sizes give the same data on every run
+END_DATE = date(2025, 1, 1)
+SEED = 0
+
+def dataset(loans):
+    """Return the generate_data arguments of the library with this many loans"""
+    return {'books': max(100, loans // 20), 'loaners': max(30, loans // 200), 'loans': loans,
+            'years': 10, 'seed': SEED, 'end': END_DATE}
+
+def clear_views():
+    with views._view_lock:
+        views._view_cache.clear()
+
+def reset_state():
+    """Drop the derived state built from the data: the cached views, metrics, aggregates and search index"""
+    metrics._state.clear()
+    aggregates._state.clear()
+    search._state.clear()
+    clear_views()
+
+def use_storage(storage, directory):
+    """Point get_storage() and the saved aggregates at a benchmark storage"""
+    storage_module._storage = storage
+    paths.aggregates_path = os.path.join(directory, 'aggregates.json')
+    reset_state()
+
+def rebuild_aggregates():
+    """Make the next get_aggregates() recompute the statistics from the loans"""
+    aggregates._state.clear()
+    if os.path.exists(paths.aggregates_path):
+        os.remove(paths.aggregates_path)
+
+def cases(storage):
+    """Return {name: (prepare, run)}, prepare being called untimed before each run"""
+    books_df, loaners_df, loans_df = load_data()
+    page_books = books_df.head(PAGE_ROWS)
+    page_loaners = loaners_df.head(PAGE_ROWS)
+    stats = aggregates.get_aggregates()
+    loaner_id = int(loans_df['loaner_id'].iloc[0])
+    return {
+        'load_data (cold)': (storage.clear_cache, load_data),
+        'load_data (cached)': (None, load_data),
+        'load_loan_history (cold)': (storage.clear_cache, storage.load_loan_history),
+        'get_metrics (rebuild)': (metrics._state.clear, metrics.get_metrics),
+        'get_aggregates (rebuild)': (rebuild_aggregates, aggregates.get_aggregates),
+        'render_stats_calculations': (None, lambda: render_stats_calculations(stats, loaners_df)),
+        'loans_view (merge)': (clear_views, views.loans_view),
+        'query_loans (history page)': (None, lambda: storage.query_loans(limit=HISTORY_PAGE_ROWS)),
+        'query_loans (loaner, all)': (None, lambda: storage.query_loans(loaner_id=loaner_id)),
+        'active_loans_view (merge)': (clear_views, views.active_loans_view),
+        'book_status (page)': (views.active_loans_view, lambda: views.book_status(page_books)),
+        'book_status (all books)': (views.active_loans_view, lambda: views.book_status(books_df)),
+        'loaner_status (page)': (views.active_loans_view, lambda: views.loaner_status(page_loaners)),
+        'loaner_status (all loaners)': (views.active_loans_view, lambda: views.loaner_status(loaners_df)),
+    }
+
+def measure(prepare, run, repeat):
+    """Return the timings in seconds of repeat runs"""
+    times = []
+    for _ in range(repeat):
+        if prepare is not None:
+            prepare()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return {'min': min(times), 'median': statistics.median(times), 'mean': statistics.fmean(times),
+            'max': max(times), 'runs': repeat}
+
+def bench_size(loans, backend, repeat, archive_days=None):
+    """Return the parameters and case timings of the library with this many loans"""
+    params = dataset(loans)
+    directory = tempfile.mkdtemp(prefix='simplib_hot_paths_')
+    try:
+        storage = write_data(directory, *generate(**params))
+        if backend != 'csv':
+            target = make_storage(backend, directory)
+            copy_storage(storage, target)
+            storage = target
+        if archive_days is not None:
+            storage.archive_loans(END_DATE - timedelta(days=archive_days))
+        use_storage(storage, directory)
+        results = {name: measure(prepare, run, repeat) for name, (prepare, run) in cases(storage).items()}
+        return {'params': {**params, 'end': params['end'].isoformat(), 'archive_days': archive_days,
+                           'current_loans': len(storage.load_loans())}, 'results': results}
+    finally:
+        use_storage(None, directory)
+        shutil.rmtree(directory, ignore_errors=True)
+
+def print_results(report, baseline=None):
+    for size, data in report['datasets'].items():
+        params = data['params']
+        print(f"{int(size):,} loans ({params['books']:,} books, {params['loaners']:,} loaners"
+              + (f", {params['current_loans']:,} not archived)" if params.get('archive_days') is not None else ")"))
+        base = (baseline or {}).get('datasets', {}).get(size, {}).get('results', {})
+        for name, timing in data['results'].items():
+            line = f"  {name:30} {timing['median'] * 1000:10.2f} ms (min {timing['min'] * 1000:.2f})"
+            if name in base:
+                line += f"  {base[name]['median'] / timing['median']:6.2f}x vs baseline"
+            print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the hot paths against synthetic libraries of growing size")
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help="numbers of loans")
+    parser.add_argument('--backend', choices=['csv', 'sqlite', 'parquet'], default='csv')
+    parser.add_argument('--repeat', type=int, default=5, help="runs per case")
+    parser.add_argument('--archive-days', type=int, help="archive the loans returned this many days before the end of the data")
+    parser.add_argument('--out', help="JSON file to write (default benchmarks/results/hot_paths-<time>.json)")
+    parser.add_argument('--compare', help="JSON file of an earlier run to compare the medians with")
+    args = parser.parse_args()
+
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'backend': args.backend,
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'datasets': {str(size): bench_size(size, args.backend, args.repeat, args.archive_days) for size in args.sizes},
+    }
+    out = args.out or os.path.join('benchmarks', 'results', f"hot_paths-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+    with open(out, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_results(report, baseline)
+    print(f"Results written to {out}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Import time benchmark: the cold start of the app and of the core, measured
+with python -X importtime in fresh interpreters, and written as JSON.
+
+Each target is imported --repeat times, each in a new process (the first run
+also warms the disk cache), and the median is kept together with the slowest
+top-level packages of the median run. It fails (exit status 1) when a target
+loads a module that must stay deferred until its feature is used, or with
+--compare when a target got more than --tolerance slower than in the older run.
+
+    python -m benchmarks.import_time
+    python -m benchmarks.import_time --out before.json
+    python -m benchmarks.import_time --compare before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+from datetime import datetime
+
+from benchmarks.common import git_commit
+
+# Name: (module imported, modules it must not load)
+TARGETS = {
+    'app': ('app', ['plotly.express', 'xlsxwriter']),
+    'core': ('methods.operations', ['streamlit', 'plotly', 'xlsxwriter']),
+}
+# Slowest top-level packages kept per target
+TOP_PACKAGES = 10
+
+_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+def parse_importtime(report):
+    """Return [(module, self seconds, cumulative seconds, depth)] of a -X importtime report"""
+    rows = []
+    for line in report.splitlines():
+        match = _LINE.match(line)
+        if match:
+            rows.append((match[4], int(match[1]) / 1e6, int(match[2]) / 1e6, len(match[3]) // 2))
+    return rows
+
+def import_rows(module):
+    """Import module in a new interpreter and return its parsed -X importtime report"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, check=True)
+    return parse_importtime(result.stderr)
+
+def summarize(module, rows):
+    """Return the total import time of module, the self time per top-level package and the modules loaded"""
+    packages = {}
+    for name, self_time, _, _ in rows:
+        package = name.split('.')[0]
+        packages[package] = packages.get(package, 0.0) + self_time
+    top = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:TOP_PACKAGES]
+    total = next(cumulative for name, _, cumulative, depth in reversed(rows) if name == module and depth == 0)
+    return {'total': total, 'packages': dict(top), 'modules': [name for name, _, _, _ in rows]}
+
+def deferred_loaded(modules, deferred):
+    """Return the modules of deferred that were loaded (a package counts if any of its submodules was)"""
+    return sorted({name for name in deferred for module in modules if module == name or module.startswith(name + '.')})
+
+def bench_target(module, deferred, repeat):
+    """Return the median import time of module and its breakdown"""
+    runs = [summarize(module, import_rows(module)) for _ in range(repeat)]
+    totals = [run['total'] for run in runs]
+    median_run = min(runs, key=lambda run: abs(run['total'] - statistics.median(totals)))
+    return {'module': module, 'median': statistics.median(totals), 'min': min(totals), 'max': max(totals),
+            'runs': repeat, 'packages': median_run['packages'], 'modules': len(median_run['modules']),
+            'deferred_loaded': deferred_loaded(median_run['modules'], deferred)}
+
+def check(report, baseline=None, tolerance=0.2):
+    """Return the failures of a report: deferred modules loaded, and targets slower than the baseline"""
+    failures = [f"{name} loads {', '.join(result['deferred_loaded'])} at import"
+                for name, result in report['targets'].items() if result['deferred_loaded']]
+    for name, result in report['targets'].items():
+        base = (baseline or {}).get('targets', {}).get(name)
+        if base and result['median'] > base['median'] * (1 + tolerance):
+            failures.append(f"{name} imports in {result['median'] * 1000:.0f} ms, "
+                            f"{base['median'] * 1000:.0f} ms in the baseline")
+    return failures
+
+def print_results(report, baseline=None):
+    for name, result in report['targets'].items():
+        line = f"{name} (import {result['module']}): {result['median'] * 1000:.0f} ms " \
+               f"(min {result['min'] * 1000:.0f}, {result['modules']} modules)"
+        base = (baseline or {}).get('targets', {}).get(name)
+        if base:
+            line += f"  {base['median'] * 1000:.0f} ms in the baseline"
+        print(line)
+        for package, seconds in result['packages'].items():
+            print(f"  {package:30} {seconds * 1000:8.1f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the cold import time of the app and of the core")
+    parser.add_argument('--targets', nargs='+', choices=list(TARGETS), default=list(TARGETS))
+    parser.add_argument('--repeat', type=int, default=5, help="fresh interpreters per target")
+    parser.add_argument('--out', help="JSON file to write (default benchmarks/results/import_time-<time>.json)")
+    parser.add_argument('--compare', help="JSON file of an earlier run to compare the medians with")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="slowdown over the baseline that fails (default 0.2)")
+    args = parser.parse_args()
+
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'targets': {name: bench_target(*TARGETS[name], args.repeat) for name in args.targets},
+    }
+    out = args.out or os.path.join('benchmarks', 'results', f"import_time-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+    with open(out, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_results(report, baseline)
+    print(f"Results written to {out}")
+    failures = check(report, baseline, args.tolerance)
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    raise SystemExit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
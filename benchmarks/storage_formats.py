@@ -0,0 +1,83 @@
+"""
+Storage formats benchmark: size on disk and cold load time of a large loan log
+in each storage backend.
+
+A synthetic loan log (one loan per row, oldest first, about one in ten still
+open, loaner and book ids drawn uniformly so they barely compress) is saved
+through each backend, then loaded with an empty cache several times; the best
+time is reported, along with the size of the loans file.
+
+    python -m benchmarks.storage_formats
+    python -m benchmarks.storage_formats --loans 200000 --repeat 5
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from methods.storage import (CsvStorage, ParquetStorage, SqliteStorage, LOAN_EVENTS_COMPACT_BYTES,
+                             PATCHES_COMPACT_BYTES)
+
+def make_loans(count, seed=0):
+    """Return count synthetic loans spread over ten years, oldest first like the appended log"""
+    rng = np.random.default_rng(seed)
+    loan_date = pd.Timestamp('2015-01-01') + pd.to_timedelta(np.sort(rng.integers(0, 3650, count)), unit='D')
+    return_date = pd.Series(loan_date + pd.to_timedelta(rng.integers(1, 60, count), unit='D'))
+    return_date[rng.random(count) < 0.1] = pd.NaT
+    return pd.DataFrame({'loaner_id': rng.integers(1, 5000, count), 'book_id': rng.integers(1, 50000, count),
+                         'loan_date': loan_date, 'return_date': return_date})
+
+def make_storage(backend, directory, compact_bytes=None):
+    """Open the storage of the backend in directory (the benchmarks share it)
+
+    compact_bytes overrides the size past which the CSV and Parquet logs are compacted.
+    """
+    if backend == 'sqlite':
+        return SqliteStorage(os.path.join(directory, 'library.db'))
+    compaction = {'events_compact_bytes': compact_bytes or LOAN_EVENTS_COMPACT_BYTES,
+                  'patches_compact_bytes': compact_bytes or PATCHES_COMPACT_BYTES}
+    if backend == 'parquet':
+        return ParquetStorage(directory, **compaction)
+    return CsvStorage(*(os.path.join(directory, name) for name in
+                        ['book_names.csv', 'book_loaners.csv', 'loans_log.csv', 'loans_events.csv', 'catalog_patches.csv']),
+                      **compaction)
+
+def measure(backend, loans_df, repeat):
+    """Return (file size in bytes, best cold load time in seconds) of the loans in a backend"""
+    directory = tempfile.mkdtemp(prefix='simplib_formats_')
+    try:
+        storage = make_storage(backend, directory)
+        storage.save_loans(loans_df)
+        size = os.path.getsize(storage.data_files()[0] if backend == 'sqlite' else storage.loans_path)
+        times = []
+        for _ in range(repeat):
+            storage.clear_cache()
+            start = time.perf_counter()
+            loaded = storage.load_loans()
+            times.append(time.perf_counter() - start)
+        assert len(loaded) == len(loans_df)
+        return size, min(times)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the loan log size and load time of the storage backends")
+    parser.add_argument('--loans', type=int, default=1_000_000, help="number of loans in the log")
+    parser.add_argument('--repeat', type=int, default=3, help="loads per backend, the best one is reported")
+    args = parser.parse_args()
+
+    loans_df = make_loans(args.loans)
+    results = {backend: measure(backend, loans_df, args.repeat) for backend in ['csv', 'sqlite', 'parquet']}
+    csv_size, csv_time = results['csv']
+    print(f"{args.loans:,} loans")
+    for backend, (size, seconds) in results.items():
+        print(f"  {backend:8} {size / 1e6:8.1f} MB ({csv_size / size:5.1f}x smaller)  "
+              f"load {seconds:6.3f}s ({csv_time / seconds:5.1f}x faster)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+"""
+Materialized loan statistics, updated per checkout and return.
+
+get_aggregates() returns the counters the statistics tab shows: loans per
+loaner, per book title, per category and per month, and the running sum and
+count of returned loan durations. They are built from the loan history once
+and then kept in sync by the on_* hooks that methods/operations.py calls after
+each write. They are saved to paths.aggregates_path together with the storage
+and data version they match (so a restart does not rebuild them) when built, and
+then with each backup snapshot rather than after every write. When the stored data
+changed behind our back, they are reloaded or rebuilt from scratch. Migrating or
+restoring the data deletes the saved file, as a recreated database starts its
+versions over.
+
+Leaderboards are served by RankedCounter, which keeps its entries sorted by
+count, so the top k are a slice and not a sort of the whole history.
+
+    python -m methods.aggregates verify    # compare the saved aggregates with a rebuild
+    python -m methods.aggregates rebuild   # rebuild and save them
+"""
+
+import argparse
+import bisect
+import json
+import os
+import tempfile
+from collections import Counter
+
+import pandas as pd
+
+import paths
+from methods.derived import VersionedState
+from methods.storage import get_storage, match_file_mode
+from methods.profiling import profiled
+
+# Loans dated on or before this are placeholders and are left out of the monthly counts
+FIRST_LOAN_DATE = pd.Timestamp('1900-01-01')
+
+
+class RankedCounter:
+    """Counts kept sorted by count (ties by key), so the top entries are a slice"""
+
+    def __init__(self, counts=()):
+        self._counts = {key: count for key, count in dict(counts).items() if count > 0}
+        self._ranking = sorted((-count, key) for key, count in self._counts.items())
+
+    def __len__(self):
+        return len(self._counts)
+
+    def __eq__(self, other):
+        return isinstance(other, RankedCounter) and self._counts == other._counts
+
+    def get(self, key):
+        return self._counts.get(key, 0)
+
+    def add(self, key, delta):
+        """Add delta to the count of key (dropping it at zero) in O(log n) search time"""
+        old = self._counts.get(key, 0)
+        if old:
+            del self._ranking[bisect.bisect_left(self._ranking, (-old, key))]
+        new = old + delta
+        if new > 0:
+            self._counts[key] = new
+            bisect.insort(self._ranking, (-new, key))
+        else:
+            self._counts.pop(key, None)
+
+    def top(self, k=None):
+        """Return the k (or all) highest (key, count) pairs, highest first"""
+        return [(key, -count) for count, key in self._ranking[:k]]
+
+
+def _book_titles():
+    """Return {book id: (name, author, category)} of the stored books"""
+    books_df = get_storage().load_books()
+    return {int(book_id): (name, author, category) for book_id, name, author, category
+            in zip(books_df['id'], books_df['name'], books_df['author'], books_df['category'])}
+
+def _build_state():
+    """Compute the aggregates from the full loan history, archived loans included"""
+    loans_df = get_storage().load_loan_history()
+    books = _book_titles()
+    by_book = Counter({int(book_id): int(count) for book_id, count in loans_df['book_id'].value_counts().items()})
+    by_title = Counter()
+    by_category = Counter()
+    for book_id, count in by_book.items():
+        if book_id in books:
+            name, author, category = books[book_id]
+            by_title[(name, author)] += count
+            by_category[category] += count
+    loan_dates = loans_df.loc[loans_df['loan_date'] > FIRST_LOAN_DATE, 'loan_date']
+    returned = loans_df[loans_df['return_date'].notna()]
+    return {
+        'total_loans': len(loans_df),
+        'by_loaner': RankedCounter({int(k): int(v) for k, v in loans_df['loaner_id'].value_counts().items()}),
+        'by_book': by_book,
+        'by_title': RankedCounter(by_title),
+        'by_category': RankedCounter(by_category),
+        'by_month': Counter({month: int(count) for month, count in loan_dates.dt.strftime('%Y-%m').value_counts().items()}),
+        'duration_sum': int((returned['return_date'] - returned['loan_date']).dt.days.sum()),
+        'duration_count': len(returned),
+        'books': books,
+    }
+
+def _json_key(key):
+    """Return the data version as it reads back from JSON"""
+    return json.loads(json.dumps(key))
+
+# The titles of the books (state['books']) are not saved, they are read back from the storage
+
+def _to_json(state):
+    return {
+        'total_loans': state['total_loans'],
+        'by_loaner': state['by_loaner'].top(),
+        'by_book': list(state['by_book'].items()),
+        'by_title': [[name, author, count] for (name, author), count in state['by_title'].top()],
+        'by_category': state['by_category'].top(),
+        'by_month': list(state['by_month'].items()),
+        'duration_sum': state['duration_sum'],
+        'duration_count': state['duration_count'],
+    }
+
+def _from_json(data):
+    return {
+        'total_loans': data['total_loans'],
+        'by_loaner': RankedCounter({loaner_id: count for loaner_id, count in data['by_loaner']}),
+        'by_book': Counter({book_id: count for book_id, count in data['by_book']}),
+        'by_title': RankedCounter({(name, author): count for name, author, count in data['by_title']}),
+        'by_category': RankedCounter({category: count for category, count in data['by_category']}),
+        'by_month': Counter({month: count for month, count in data['by_month']}),
+        'duration_sum': data['duration_sum'],
+        'duration_count': data['duration_count'],
+    }
+
+def _header(key):
+    """Return the first line of the saved file: the storage (backend and main data file) and the data version"""
+    storage = get_storage()
+    return json.dumps([type(storage).__name__, os.path.abspath(storage.data_files()[0]), _json_key(key)])
+
+def _write(key, data, path=None):
+    """Atomically write the storage and data version on the first line, then the aggregates"""
+    path = path or paths.aggregates_path
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.aggregates.', suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(_header(key) + '\n')
+        json.dump(data, f, ensure_ascii=False)
+    match_file_mode(temp_path, path)
+    os.replace(temp_path, path)
+
+def _save(key, state, path=None):
+    """Persist the aggregates of data version key next to the data"""
+    _write(key, _to_json(state), path)
+
+def _load_saved(key, path=None):
+    """Return the saved aggregates if they match the storage and data version (the rest of the file is only parsed then)"""
+    path = path or paths.aggregates_path
+    try:
+        with open(path, encoding='utf-8') as f:
+            if f.readline().rstrip('\n') != _header(key):
+                return None
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    state = _from_json(data)
+    state['books'] = _book_titles()
+    return state
+
+def _load_or_build(key):
+    """Return the saved aggregates of data version key, or build and save them"""
+    state = _load_saved(key)
+    if state is None:
+        state = _build_state()
+        _save(key, state)
+    return state
+
+def _data_version():
+    return get_storage().data_version()
+
+_state = VersionedState(_data_version, _load_or_build)
+# Whether the hooks changed the aggregates since they were last saved
+_unsaved = False
+
+@profiled
+def get_aggregates():
+    """Return the loan statistics (shared, callers must not modify them), rebuilding only if the data changed outside the hooks"""
+    return _state.get()
+
+def _apply(previous_version, update):
+    """Fold a write into the aggregates if they were current right before it (flagging them unsaved), otherwise drop them"""
+    def update_and_flag(state):
+        global _unsaved
+        update(state)
+        _unsaved = True
+    _state.apply(previous_version, update_and_flag)
+
+def discard(path=None):
+    """Delete the saved aggregates and drop the loaded ones (after the data was replaced by a migration or restore)"""
+    path = path or paths.aggregates_path
+    if os.path.exists(path):
+        os.remove(path)
+    _state.clear()
+
+def save_pending():
+    """Save the aggregates if writes changed them since they were last saved (called with each backup snapshot)"""
+    global _unsaved
+    with _state.lock:
+        if not _unsaved:
+            return
+        _unsaved = False
+        if _state.value is None or _state.key != get_storage().data_version():
+            return
+        key, data = _state.key, _to_json(_state.value)
+    _write(key, data)
+
+def on_checkout(previous_version, loaner_id, book_id, loan_date):
+    """Count a new loan"""
+    def update(state):
+        state['total_loans'] += 1
+        state['by_loaner'].add(int(loaner_id), 1)
+        state['by_book'][int(book_id)] += 1
+        if int(book_id) in state['books']:
+            name, author, category = state['books'][int(book_id)]
+            state['by_title'].add((name, author), 1)
+            state['by_category'].add(category, 1)
+        if pd.Timestamp(loan_date) > FIRST_LOAN_DATE:
+            state['by_month'][pd.Timestamp(loan_date).strftime('%Y-%m')] += 1
+    _apply(previous_version, update)
+
+def on_return(previous_version, loan_date, return_date):
+    """Add a returned loan to the running duration sum"""
+    def update(state):
+        state['duration_sum'] += (pd.Timestamp(return_date) - pd.Timestamp(loan_date)).days
+        state['duration_count'] += 1
+    _apply(previous_version, update)
+
+def on_book_added(previous_version, book_id, name, author, category):
+    """Remember the title and category of a new book"""
+    def update(state):
+        state['books'][int(book_id)] = (name, author, category)
+    _apply(previous_version, update)
+
+def _text(value):
+    """Return an edited cell as the stored text (a cleared cell is saved as '', see storage._patch_value)"""
+    return '' if value is None else value
+
+def on_books_edited(previous_version, changes):
+    """Move the loan counts of books whose title or category was edited"""
+    def update(state):
+        for book_id, values in changes.items():
+            book_id = int(book_id)
+            if book_id not in state['books']:
+                continue
+            name, author, category = state['books'][book_id]
+            new = tuple(_text(values[column]) if column in values else old
+                        for column, old in zip(['name', 'author', 'category'], (name, author, category)))
+            state['books'][book_id] = new
+            count = state['by_book'].get(book_id, 0)
+            if count and (new[0], new[1]) != (name, author):
+                state['by_title'].add((name, author), -count)
+                state['by_title'].add((new[0], new[1]), count)
+            if count and new[2] != category:
+                state['by_category'].add(category, -count)
+                state['by_category'].add(new[2], count)
+    _apply(previous_version, update)
+
+def on_unchanged(previous_version):
+    """Keep the aggregates after a write that does not affect them"""
+    _apply(previous_version, lambda state: None)
+
+def _differences(state, expected):
+    """Return the names of the aggregates that differ between two states"""
+    return [name for name in expected if state[name] != expected[name]]
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify or rebuild the materialized loan statistics")
+    parser.add_argument('command', choices=['verify', 'rebuild'])
+    args = parser.parse_args()
+
+    key = get_storage().data_version()
+    rebuilt = _build_state()
+    if args.command == 'rebuild':
+        _save(key, rebuilt)
+        print(f"Rebuilt the aggregates of {rebuilt['total_loans']} loans")
+        return
+    saved = _load_saved(key)
+    if saved is None:
+        print("No saved aggregates for the current data (they are rebuilt on the next run)")
+        return
+    differences = _differences(saved, rebuilt)
+    print(f"Aggregates differ in: {', '.join(differences)}" if differences else "Aggregates match the loan history")
+    raise SystemExit(1 if differences else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""
+Move old returned loans out of the loans store into the yearly loan archive.
+
+The loans store then only holds the open loans and those returned in the last
+paths.loan_archive_days days, so loading it (on every rerun) no longer grows
+with the age of the library. The archived loans stay part of the history tab
+and of the statistics, which are carried over without a rebuild.
+
+    python -m methods.archive                # archive the loans returned more than paths.loan_archive_days days ago
+    python -m methods.archive --days 180
+    python -m methods.archive list           # the partitions and their loans
+"""
+
+import argparse
+import os
+
+import paths
+from methods import backuper
+from methods.operations import archive_loans
+from methods.storage import get_storage
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive old returned loans into read-only yearly partitions")
+    parser.add_argument('command', nargs='?', choices=['archive', 'list'], default='archive')
+    parser.add_argument('--days', type=int, help=f"archive the loans returned more than this many days ago "
+                                                 f"(default {paths.loan_archive_days})")
+    args = parser.parse_args()
+
+    storage = get_storage()
+    if args.command == 'list':
+        archived_df = storage.archive.load()
+        counts = archived_df['loan_date'].dt.year.value_counts()
+        for year, path in storage.archive.partitions():
+            print(f"{path:50} {counts.get(year, 0):>9,} loans {os.path.getsize(path) / 1024:>10.1f} KB")
+        print(f"{len(archived_df):,} archived loans, {len(storage.load_loans()):,} in the loans store")
+        return
+    moved = archive_loans(args.days)
+    if moved:
+        print(f"Archived {moved:,} loans to {storage.archive.directory}, snapshot {backuper.snapshot_storage() or 'unchanged'}")
+    else:
+        print("No loans to archive")
+
+if __name__ == "__main__":
+    main()
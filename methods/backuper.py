@@ -1,43 +1,390 @@
-import streamlit as st
-import pandas as pd
-from datetime import datetime
+"""
+Content-addressed backups of the library data.
+
+    python -m methods.backuper backup            # take a snapshot now (skipped if nothing changed)
+    python -m methods.backuper list              # list the snapshots
+    python -m methods.backuper restore 20250701_102346 [--to DIR]
+    python -m methods.backuper restore --at "2025-07-01 10:30" [--to DIR]
+    python -m methods.backuper prune             # apply the retention policy
+
+Add --demo to work on the demo data instead of the production files.
+
+Layout of the backup directory:
+- objects/<sha256>.gz        - a file version, gzip compressed
+- objects/<sha256>.delta.gz  - a file version stored as "<base sha256>\\n" + the bytes
+                               appended to that base (for the append-only logs)
+- snapshots/<timestamp>.json - the files of one snapshot and the object of each, and
+                               the file set it covered (files missing then included)
+
+A file whose mtime and size did not change is not even read, one whose content
+did not change is not stored again, and a snapshot identical to the previous
+one is not taken. Old snapshots are thinned out to one per hour, per day and per
+month (see KEEP_ALL_HOURS and RETENTION), and objects no snapshot refers to are deleted.
+
+In the app, snapshots are triggered by writes: every write calls
+request_snapshot(), and a single background thread (started by init_backup())
+waits for a burst of writes to settle, then snapshots all the data files under
+the storage write lock, so a snapshot never mixes files from before and after
+a write. While nothing is written the thread just sleeps on its queue.
+"""
+
+import argparse
+import atexit
+import gzip
+import hashlib
+import json
 import os
+import queue
+import sqlite3
+import tempfile
+import threading
 import time
-import shutil
+from datetime import datetime, timedelta
 from pathlib import Path
-import threading
-from paths import prod_book_names_path, prod_book_loaners_path, prod_loans_log_path, backup_dir_path
 
-def backup_files():
-    """Backup all CSV files to the backup directory with timestamp"""
+import paths
+from methods import aggregates
+from methods.storage import archive_files, get_storage, loan_archive_dir, match_file_mode, parquet_files
+
+SNAPSHOT_FORMAT = '%Y%m%d_%H%M%S'
+# Every snapshot of the last 24 hours is kept
+KEEP_ALL_HOURS = 24
+# Older ones are thinned out by (bucket format, number of buckets kept): the newest
+# snapshot of each of the last 48 hours, 60 days and of every month is kept
+# (None keeps all buckets)
+RETENTION = [('%Y%m%d%H', 48), ('%Y%m%d', 60), ('%Y%m', None)]
+# Store a full copy instead of yet another delta once a chain is this long
+MAX_DELTA_CHAIN = 50
+# A snapshot is taken once no write happened for SNAPSHOT_DELAY seconds,
+# or SNAPSHOT_MAX_DELAY seconds after the first write of a burst at the latest
+SNAPSHOT_DELAY = 30
+SNAPSHOT_MAX_DELAY = 300
+
+def _with_archives(files):
+    """Add the partitions of the loan archives kept next to the loans files and databases of files"""
+    stores = [file for file in files if os.path.basename(file).startswith('loans_log.') or file.endswith('.db')]
+    return files + [path for store in stores for path in archive_files(loan_archive_dir(store))]
+
+def prod_files():
+    return _with_archives([paths.prod_book_names_path, paths.prod_book_loaners_path, paths.prod_loans_log_path,
+                           paths.prod_loans_events_path, paths.prod_catalog_patches_path, paths.prod_sqlite_db_path,
+                           *parquet_files(paths.prod_parquet_dir_path)])
+
+def demo_files():
+    return _with_archives([paths.book_names_path, paths.book_loaners_path, paths.loans_log_path,
+                           paths.loans_events_path, paths.catalog_patches_path, paths.sqlite_db_path,
+                           *parquet_files(paths.parquet_dir_path)])
+
+def backup_store_for(files):
+    """Return the backup store of a set of data files (the demo data is kept apart from the production backups)"""
+    if set(files) <= set(demo_files()):
+        # Named after the data directory, so generated data does not mix with the demo backups
+        return BackupStore(os.path.join(paths.backup_dir_path, os.path.basename(os.path.normpath(paths.data_dir))))
+    return BackupStore()
+
+def _write_atomic(path, data):
+    """Write bytes to a temporary file next to path and move it into place"""
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        match_file_mode(temp_path, path)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def _read_data_file(file):
+    """Return the bytes of a data file (a consistent copy for SQLite databases)"""
+    if file.endswith('.db'):
+        with sqlite3.connect(file) as source, sqlite3.connect(':memory:') as copy:
+            source.backup(copy)
+            return copy.serialize()
+    return Path(file).read_bytes()
+
+
+class BackupStore:
+    """Snapshots of a set of data files, stored as deduplicated compressed objects"""
+
+    def __init__(self, backup_dir=None):
+        self.root = Path(backup_dir or paths.backup_dir_path)
+        self.objects_dir = self.root / 'objects'
+        self.snapshots_dir = self.root / 'snapshots'
+
+    def _ensure_dirs(self):
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        self.snapshots_dir.mkdir(parents=True, exist_ok=True)
+
+    def _object_path(self, digest, delta=False):
+        return self.objects_dir / (f'{digest}.delta.gz' if delta else f'{digest}.gz')
+
+    def _has_object(self, digest):
+        return self._object_path(digest).exists() or self._object_path(digest, delta=True).exists()
+
+    def read_object(self, digest):
+        """Return the content with the given hash, following delta chains"""
+        path = self._object_path(digest)
+        if path.exists():
+            return gzip.decompress(path.read_bytes())
+        base, suffix = gzip.decompress(self._object_path(digest, delta=True).read_bytes()).split(b'\n', 1)
+        return self.read_object(base.decode()) + suffix
+
+    def _delta_base(self, digest):
+        """Return the base hash of a delta object, or None for a full object"""
+        path = self._object_path(digest, delta=True)
+        if not path.exists():
+            return None
+        with gzip.open(path, 'rb') as f:
+            return f.readline().strip().decode()
+
+    def _chain_length(self, digest):
+        """Return the number of deltas to apply to restore the given content"""
+        length = 0
+        digest = self._delta_base(digest)
+        while digest is not None:
+            length += 1
+            digest = self._delta_base(digest)
+        return length
+
+    def snapshot_names(self):
+        """Return the snapshot names, oldest first"""
+        if not self.snapshots_dir.exists():
+            return []
+        return sorted(path.stem for path in self.snapshots_dir.glob('*.json'))
+
+    def read_manifest(self, name):
+        return json.loads((self.snapshots_dir / f'{name}.json').read_text(encoding='utf-8'))
+
+    def _store(self, content, previous):
+        """Store a file version and return its manifest entry"""
+        digest = hashlib.sha256(content).hexdigest()
+        entry = {'sha256': digest, 'size': len(content), 'chain': 0}
+        if previous is not None and previous['sha256'] == digest:
+            entry['chain'] = previous['chain']
+            return entry
+        if self._has_object(digest):
+            # A version seen before (e.g. a file changed back), reuse its object
+            entry['chain'] = self._chain_length(digest)
+            return entry
+        # Append-only files: if the previous version is a prefix of this one, store just the appended bytes
+        if (previous is not None and 0 < previous['size'] < len(content) and previous['chain'] < MAX_DELTA_CHAIN
+                and hashlib.sha256(content[:previous['size']]).hexdigest() == previous['sha256']):
+            data = previous['sha256'].encode() + b'\n' + content[previous['size']:]
+            _write_atomic(self._object_path(digest, delta=True), gzip.compress(data))
+            entry['chain'] = previous['chain'] + 1
+        else:
+            _write_atomic(self._object_path(digest), gzip.compress(content))
+        return entry
+
+    def take_snapshot(self, files, now=None):
+        """Snapshot the given files and return the snapshot name, or None if nothing changed since the last one"""
+        self._ensure_dirs()
+        names = self.snapshot_names()
+        previous = self.read_manifest(names[-1])['files'] if names else {}
+        entries = {}
+        for file in files:
+            if not os.path.exists(file):
+                continue
+            stat = os.stat(file)
+            old = previous.get(file)
+            # Unchanged mtime and size: reuse the previous entry without reading the file
+            if old is not None and (old.get('mtime_ns'), old['size']) == (stat.st_mtime_ns, stat.st_size) and not file.endswith('.db'):
+                entries[file] = old
+                continue
+            entries[file] = dict(self._store(_read_data_file(file), old), mtime_ns=stat.st_mtime_ns)
+        if names and {f: e['sha256'] for f, e in entries.items()} == {f: e['sha256'] for f, e in previous.items()}:
+            return None
+        now = (now or datetime.now()).replace(microsecond=0)
+        # Names have a one second resolution, never overwrite a snapshot taken in the same second
+        while (self.snapshots_dir / f'{now.strftime(SNAPSHOT_FORMAT)}.json').exists():
+            now += timedelta(seconds=1)
+        name = now.strftime(SNAPSHOT_FORMAT)
+        manifest = {'created': now.isoformat(timespec='seconds'), 'files': entries, 'covered': list(files)}
+        _write_atomic(self.snapshots_dir / f'{name}.json', json.dumps(manifest, ensure_ascii=False, indent=1).encode('utf-8'))
+        return name
+
+    def snapshot_at(self, moment):
+        """Return the name of the newest snapshot taken at or before moment"""
+        candidates = [name for name in self.snapshot_names() if datetime.strptime(name, SNAPSHOT_FORMAT) <= moment]
+        if not candidates:
+            raise ValueError(f"No snapshot at or before {moment:%Y-%m-%d %H:%M}")
+        return candidates[-1]
+
+    def restore(self, name, files, target_dir=None):
+        """Restore the files of a snapshot, in place or into target_dir; return the restored paths
+
+        The snapshot files missing from files (archive partitions removed since) are restored as well. Only the
+        files the snapshot covered are removed when it did not contain them, so restoring a snapshot of one
+        backend leaves the files of the others alone.
+        """
+        snapshot = self.read_manifest(name)
+        manifest = snapshot['files']
+        covered = set(snapshot.get('covered', ()))
+        # Archive partitions written since belong to the covered loans files and databases too
+        covered_archives = {loan_archive_dir(file) for file in covered}
+        restored = []
+        for file in dict.fromkeys([*files, *manifest]):
+            destination = Path(target_dir) / Path(file).name if target_dir else Path(file)
+            if file in manifest:
+                destination.parent.mkdir(parents=True, exist_ok=True)
+                _write_atomic(destination, self.read_object(manifest[file]['sha256']))
+                restored.append(str(destination))
+            elif (target_dir is None and (file in covered or os.path.dirname(file) in covered_archives)
+                  and destination.exists()):
+                # The file did not exist at that time (e.g. an empty log), remove it so the restored state is consistent
+                destination.unlink()
+        if target_dir is None:
+            for suffix in ['-wal', '-shm']:
+                for file in manifest:
+                    if file.endswith('.db') and os.path.exists(file + suffix):
+                        os.remove(file + suffix)
+        return restored
+
+    def prune(self, now=None):
+        """Apply the retention policy and delete the objects no remaining snapshot needs; return the deleted snapshots"""
+        names = self.snapshot_names()
+        recent = ((now or datetime.now()) - timedelta(hours=KEEP_ALL_HOURS)).strftime(SNAPSHOT_FORMAT)
+        keep = set(names[-1:]) | {name for name in names if name >= recent}
+        for bucket_format, count in RETENTION:
+            buckets = set()
+            for name in reversed(names):
+                bucket = datetime.strptime(name, SNAPSHOT_FORMAT).strftime(bucket_format)
+                if bucket not in buckets and (count is None or len(buckets) < count):
+                    buckets.add(bucket)
+                    keep.add(name)
+        deleted = [name for name in names if name not in keep]
+        for name in deleted:
+            (self.snapshots_dir / f'{name}.json').unlink()
+        self._collect_garbage()
+        return deleted
+
+    def _collect_garbage(self):
+        """Delete the objects that are not reachable from any snapshot"""
+        live = set()
+        for name in self.snapshot_names():
+            for entry in self.read_manifest(name)['files'].values():
+                digest = entry['sha256']
+                while digest is not None and digest not in live:
+                    live.add(digest)
+                    digest = self._delta_base(digest)
+        for path in self.objects_dir.glob('*.gz'):
+            if path.name.split('.')[0] not in live:
+                path.unlink()
+
+    def disk_usage(self):
+        return sum(path.stat().st_size for path in self.root.rglob('*') if path.is_file())
+
+
+# Pending snapshot requests; a single slot, since any number of writes needs just one snapshot
+_requests = queue.Queue(maxsize=1)
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def request_snapshot():
+    """Ask the backup thread for a snapshot after a write (cheap, never blocks)"""
+    try:
+        _requests.put_nowait(True)
+    except queue.Full:
+        pass
+
+def snapshot_storage():
+    """Snapshot the data files of the configured storage, holding its write lock so the files are consistent"""
+    storage = get_storage()
+    files = storage.data_files()
+    store = backup_store_for(files)
+    with storage.write_lock():
+        # The statistics are saved along with the snapshot, not after every write
+        aggregates.save_pending()
+        name = store.take_snapshot(files)
+    if name:
+        store.prune()
+    return name
+
+def _wait_for_quiet():
+    """Return once no write was requested for SNAPSHOT_DELAY seconds (or SNAPSHOT_MAX_DELAY passed)"""
+    deadline = time.monotonic() + SNAPSHOT_MAX_DELAY
     while True:
+        timeout = min(SNAPSHOT_DELAY, deadline - time.monotonic())
+        if timeout <= 0:
+            return
         try:
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            backup_path = backup_dir / timestamp
-            backup_path.mkdir(exist_ok=True)
-            
-            # Backup all CSV files
-            for file in [prod_book_names_path, prod_book_loaners_path, prod_loans_log_path]:
-                if os.path.exists(file):
-                    shutil.copy2(file, backup_path / Path(file).name)
-            
-            # Keep only last 24 backups (4 hours worth of backups)
-            backups = sorted(backup_dir.glob('*'), key=os.path.getctime)
-            if len(backups) > 24:
-                for old_backup in backups[:-24]:
-                    shutil.rmtree(old_backup)
-                    
+            _requests.get(timeout=timeout)
+        except queue.Empty:
+            return
+
+def _run_scheduler():
+    while True:
+        # Idle until the first write of a burst
+        _requests.get()
+        _wait_for_quiet()
+        try:
+            snapshot_storage()
         except Exception as e:
             print(f"Backup error: {e}")
-            
-        time.sleep(600)  # Sleep for 10 minutes
+
+def _flush():
+    """Take the pending snapshot, if any, when the process exits"""
+    try:
+        _requests.get_nowait()
+    except queue.Empty:
+        return
+    snapshot_storage()
 
 def init_backup():
-    global backup_dir
-    # Create backup directory if it doesn't exist
-    backup_dir = Path(backup_dir_path)
-    backup_dir.mkdir(exist_ok=True) # Create backup directory if it doesn't exist
-
-    # Start backup thread
-    backup_thread = threading.Thread(target=backup_files, daemon=True)
-    backup_thread.start()
+    """Start the backup thread, once per process however many times it is called"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = threading.Thread(target=_run_scheduler, name='backup-scheduler', daemon=True)
+            _scheduler.start()
+            atexit.register(_flush)
+
+def main():
+    parser = argparse.ArgumentParser(description="Back up and restore the library data")
+    parser.add_argument('--demo', action='store_true', help="use the demo data instead of the production files")
+    parser.add_argument('--backup-dir', help="backup directory (defaults to paths.backup_dir_path)")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('backup', help="take a snapshot now")
+    commands.add_parser('list', help="list the snapshots")
+    commands.add_parser('prune', help="apply the retention policy")
+    restore = commands.add_parser('restore', help="restore a snapshot")
+    restore.add_argument('snapshot', nargs='?', help="snapshot name, as shown by list")
+    restore.add_argument('--at', help="restore the newest snapshot taken at or before this time ('YYYY-MM-DD HH:MM')")
+    restore.add_argument('--to', help="write the files into this directory instead of over the live data")
+    args = parser.parse_args()
+
+    files = demo_files() if args.demo else prod_files()
+    store = BackupStore(args.backup_dir) if args.backup_dir else backup_store_for(files)
+    if args.command == 'backup':
+        name = store.take_snapshot(files)
+        print(f"Snapshot {name} taken" if name else "Nothing changed since the last snapshot")
+    elif args.command == 'list':
+        for name in store.snapshot_names():
+            manifest = store.read_manifest(name)
+            size = sum(entry['size'] for entry in manifest['files'].values())
+            print(f"{name}  {manifest['created']}  {len(manifest['files'])} files  {size / 1024:.0f} KB")
+        print(f"Backup store size: {store.disk_usage() / 1024:.0f} KB")
+    elif args.command == 'prune':
+        deleted = store.prune()
+        print(f"Deleted {len(deleted)} snapshots")
+    elif args.command == 'restore':
+        if args.at:
+            try:
+                name = store.snapshot_at(datetime.fromisoformat(args.at))
+            except ValueError as e:
+                parser.error(str(e))
+        elif args.snapshot:
+            name = args.snapshot
+        else:
+            parser.error("restore needs a snapshot name or --at")
+        if not args.to:
+            # Keep the current state restorable too
+            store.take_snapshot(files)
+        for path in store.restore(name, files, args.to):
+            print(f"Restored {path} from {name}")
+        if not args.to:
+            aggregates.discard(paths.aggregates_path if args.demo else paths.prod_aggregates_path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Derived data (dashboard counters, statistics, the search index) kept per data version.
+
+A VersionedState holds one value together with the version of the stored data
+it was built from. get() rebuilds it when the data changed behind our back (another
+process, a manual edit); the write hooks fold each write into it instead, as long
+as it was current right before the write, and drop it otherwise.
+"""
+
+import threading
+
+
+class VersionedState:
+    """A value built by build(version), kept until version() changes or a write hook updates it"""
+
+    def __init__(self, version, build):
+        self._version = version
+        self._build = build
+        # Hold the lock to read key and value together
+        self.lock = threading.Lock()
+        self.key = None
+        self.value = None
+
+    def get(self):
+        """Return the value of the current data version, building it if needed"""
+        key = self._version()
+        with self.lock:
+            if self.value is None or self.key != key:
+                self.value = self._build(key)
+                self.key = key
+            return self.value
+
+    def apply(self, previous_key, update):
+        """Call update(value) if the value was current right before a write, otherwise drop it; return whether it was kept"""
+        with self.lock:
+            if self.value is not None and self.key == previous_key:
+                update(self.value)
+                self.key = self._version()
+                return True
+            self.value = None
+            return False
+
+    def unchanged(self, previous_key):
+        """Keep the value after a write that does not affect it"""
+        return self.apply(previous_key, lambda value: None)
+
+    def clear(self):
+        """Drop the value, the next get() rebuilds it"""
+        with self.lock:
+            self.value = None
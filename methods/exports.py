@@ -0,0 +1,107 @@
+"""
+On-demand exports of the catalog, the loaners list and the loan history.
+
+An export is written only when a librarian asks for it, in chunks of
+EXPORT_CHUNK_ROWS rows straight to a file, so a large history is never held
+twice in memory as a workbook. The file is kept in paths.export_dir_path under
+a name derived from the dataset, the format, the filters and the data version,
+so the same export is reused by every session until the data changes.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import pandas as pd
+
+import paths
+from methods.storage import get_storage, match_file_mode
+
+# Rows written per chunk
+EXPORT_CHUNK_ROWS = 10000
+# Number of export files kept, the oldest ones are removed
+EXPORT_CACHE_FILES = 20
+
+# Label and MIME type of each export format, keyed by its file extension
+FORMATS = {
+    'xlsx': ('Excel', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'csv': ('CSV', 'text/csv'),
+    'parquet': ('Parquet', 'application/vnd.apache.parquet'),
+}
+
+def _chunks(df):
+    for start in range(0, len(df), EXPORT_CHUNK_ROWS):
+        yield start, df.iloc[start:start + EXPORT_CHUNK_ROWS]
+
+def _write_csv(df, path):
+    # utf-8-sig so Excel shows the Hebrew text correctly
+    with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+        df.head(0).to_csv(f, index=False)
+        for _, chunk in _chunks(df):
+            chunk.to_csv(f, index=False, header=False)
+
+def _write_xlsx(df, path, sheet_name):
+    # constant_memory flushes each row to disk as soon as the next one is written
+    with pd.ExcelWriter(path, engine='xlsxwriter', datetime_format='DD/MM/YYYY',
+                        engine_kwargs={'options': {'constant_memory': True}}) as writer:
+        df.head(0).to_excel(writer, sheet_name=sheet_name, index=False)
+        for start, chunk in _chunks(df):
+            chunk.to_excel(writer, sheet_name=sheet_name, index=False, header=False, startrow=start + 1)
+
+def _write_parquet(df, path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    # One schema for all chunks, so a chunk of empty values does not infer another type
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    with pq.ParquetWriter(path, schema) as writer:
+        for _, chunk in _chunks(df):
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+
+def write_export(df, fmt, path, sheet_name='Sheet1'):
+    """Write df to path in the given format, chunk by chunk"""
+    if fmt == 'csv':
+        _write_csv(df, path)
+    elif fmt == 'xlsx':
+        _write_xlsx(df, path, sheet_name)
+    elif fmt == 'parquet':
+        _write_parquet(df, path)
+    else:
+        raise ValueError(f"Unknown export format: {fmt}")
+
+def export_path(name, fmt, filters=()):
+    """Return the file the export of name with these filters has for the current data"""
+    storage = get_storage()
+    key = json.dumps([sorted(storage.data_files()), storage.data_version(), list(filters)], default=str)
+    digest = hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(paths.export_dir_path, f"{name}_{digest}.{fmt}")
+
+def _prune(directory):
+    """Remove all but the EXPORT_CACHE_FILES newest exports"""
+    files = [os.path.join(directory, name) for name in os.listdir(directory) if not name.startswith('.')]
+    files.sort(key=os.path.getmtime, reverse=True)
+    for path in files[EXPORT_CACHE_FILES:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def export(name, fmt, build, filters=()):
+    """Return the path of the export of the frame build() returns, writing it only if it is not cached yet"""
+    path = export_path(name, fmt, filters)
+    if os.path.exists(path):
+        return path
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    # Written under a temporary name, so a concurrent request never serves a partial file
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f'.{name}.', suffix=f'.{fmt}')
+    os.close(fd)
+    try:
+        write_export(build(), fmt, temp_path, sheet_name=name)
+        match_file_mode(temp_path, path)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    _prune(directory)
+    return path
@@ -0,0 +1,75 @@
+"""
+Inter-process write lock for the library data.
+
+Several librarian sessions (threads of one Streamlit server, or several
+servers) may write at the same time. Every write goes through a FileLock, an
+exclusive lock on a small lock file next to the data, so a read-modify-write
+(a new id, a compaction, a version check) is never interleaved with another
+writer. The lock is re-entrant within a thread, so a locked write may call
+other locked writes.
+"""
+
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+class FileLock:
+    """Exclusive lock shared by threads and processes, re-entrant within a thread"""
+
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def _lock_file(self):
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        else:
+            self._file.seek(0)
+            # LK_LOCK gives up after 10 seconds, keep waiting like flock does
+            while True:
+                try:
+                    msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+                    return
+                except OSError:
+                    pass
+
+    def _unlock_file(self):
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        else:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            try:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                self._file = open(self.path, 'a+')
+                self._lock_file()
+            except BaseException:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                self._thread_lock.release()
+                raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self._depth -= 1
+        if self._depth == 0:
+            try:
+                self._unlock_file()
+            finally:
+                self._file.close()
+                self._file = None
+        self._thread_lock.release()
@@ -0,0 +1,91 @@
+"""
+Memory used by the library data.
+
+The frames cached by the storage and the joined views are shared by every
+session; memory_report() lists them with their size in their compact dtypes
+(see storage.FRAME_DTYPES) next to what the same frame took as plain object
+strings and int64 ids, and the resident size of the whole process.
+session_report() lists what a single session holds on top of them.
+
+    python -m methods.memory    # load the data and print the report
+"""
+
+import os
+import sys
+
+import pandas as pd
+
+from methods import views
+from methods.storage import get_storage
+
+def frame_bytes(df):
+    """Return the memory taken by a frame, counting the Python strings it holds
+
+    The categories of a categorical column are counted in every frame that uses
+    them, although frames filtered or joined from one another share them.
+    """
+    return int(df.memory_usage(deep=True).sum())
+
+def plain_frame(df):
+    """Return df as it was held before the compact dtypes: object text and int64 integers"""
+    dtypes = {}
+    for column, dtype in df.dtypes.items():
+        if isinstance(dtype, (pd.CategoricalDtype, pd.StringDtype)):
+            dtypes[column] = object
+        elif pd.api.types.is_integer_dtype(dtype):
+            dtypes[column] = 'int64'
+    return df.astype(dtypes)
+
+def view_bytes(view):
+    """Return (bytes, plain bytes) of a cached view: a frame, or a dict or set of ids and labels"""
+    if isinstance(view, pd.DataFrame):
+        return frame_bytes(view), frame_bytes(plain_frame(view))
+    size = sys.getsizeof(view) + sum(sys.getsizeof(item) for item in view)
+    if isinstance(view, dict):
+        size += sum(sys.getsizeof(value) for value in view.values())
+    return size, size
+
+def process_rss():
+    """Return the resident memory of this process in bytes (None where it cannot be read)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    # Peak rather than current, in KB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if os.uname().sysname == 'Darwin' else rss * 1024
+
+def memory_report():
+    """Return [(name, rows, bytes, plain bytes)] of the shared frames"""
+    frames = {**get_storage().cached_frames(), **{f'view:{name}': view for name, view in views.cached_views().items()}}
+    return [(name, len(frame), *view_bytes(frame)) for name, frame in sorted(frames.items())]
+
+def session_report(session_state):
+    """Return [(key, bytes)] of the values a session holds, largest first"""
+    sizes = [(str(key), frame_bytes(value) if isinstance(value, pd.DataFrame) else sys.getsizeof(value))
+             for key, value in session_state.items()]
+    return sorted(sizes, key=lambda item: item[1], reverse=True)
+
+def format_bytes(size):
+    return f"{size / 1024 / 1024:.2f} MB" if size >= 1024 * 1024 else f"{size / 1024:.1f} KB"
+
+def main():
+    storage = get_storage()
+    storage.load_books(), storage.load_loaners(), storage.load_loans()
+    views.loans_view(), views.active_loans_view()
+    report = memory_report()
+    for name, rows, size, plain_size in report:
+        print(f"{name:45} {rows:>9,} rows {format_bytes(size):>10} (plain {format_bytes(plain_size)})")
+    total, plain_total = sum(r[2] for r in report), sum(r[3] for r in report)
+    print(f"{'total':45} {'':>14} {format_bytes(total):>10} (plain {format_bytes(plain_total)}, {plain_total / total:.1f}x)")
+    rss = process_rss()
+    if rss is not None:
+        print(f"process RSS {format_bytes(rss)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Dashboard counters computed once per data version and updated incrementally.
+
+get_metrics() returns the counters shown in the loans, books and loaners tabs.
+They are computed from the open loans the first time and then kept in sync by
+the on_* hooks that methods/operations.py calls after each write. When the stored
+data changed behind our back (another process, a manual edit) or the day rolled
+over (loans become late), the counters are rebuilt from scratch.
+"""
+
+from collections import Counter
+from datetime import date
+
+import pandas as pd
+
+from methods.derived import VersionedState
+from methods.storage import get_storage, late_cutoff
+from methods.profiling import profiled
+from methods.views import LATE_DAYS
+
+def _is_late(loan_date):
+    """Return True if an open loan that started on loan_date is late today"""
+    return pd.Timestamp(loan_date) < pd.Timestamp(late_cutoff(LATE_DAYS))
+
+def _build_state(key):
+    """Compute the counters from the stored books, loaners and open loans"""
+    storage = get_storage()
+    active_loans = storage.active_loans()
+    late_loans = storage.late_loans(LATE_DAYS)
+    return {
+        'total_books': len(storage.load_books()),
+        'total_loaners': len(storage.load_loaners()),
+        'active_by_book': Counter(active_loans['book_id'].tolist()),
+        'active_by_loaner': Counter(active_loans['loaner_id'].tolist()),
+        'late_by_book': Counter(late_loans['book_id'].tolist()),
+        'late_by_loaner': Counter(late_loans['loaner_id'].tolist()),
+    }
+
+def _current_key():
+    return get_storage().data_version(), date.today()
+
+_state = VersionedState(_current_key, _build_state)
+
+@profiled
+def get_metrics():
+    """Return the dashboard metrics, rebuilding the counters only if the data changed outside the hooks"""
+    state = _state.get()
+    active_loans = sum(state['active_by_book'].values())
+    borrowed_books = len(state['active_by_book'])
+    return {
+        'total_loaners': state['total_loaners'],
+        'active_loaners': len(state['active_by_loaner']),
+        'late_loaners': len(state['late_by_loaner']),
+        'active_loans': active_loans,
+        'late_loans': sum(state['late_by_book'].values()),
+        'total_books': state['total_books'],
+        'borrowed_books': borrowed_books,
+        'late_books': len(state['late_by_book']),
+        'available_books': state['total_books'] - borrowed_books,
+    }
+
+def _apply(previous_version, update):
+    """Fold a write into the counters if they were current right before it, otherwise drop them"""
+    _state.apply((previous_version, date.today()), update)
+
+def _add(counter, key, delta):
+    counter[key] += delta
+    if counter[key] <= 0:
+        del counter[key]
+
+def on_checkout(previous_version, loaner_id, book_id, loan_date):
+    """Update the counters after a new loan"""
+    def update(state):
+        _add(state['active_by_book'], book_id, 1)
+        _add(state['active_by_loaner'], loaner_id, 1)
+        if _is_late(loan_date):
+            _add(state['late_by_book'], book_id, 1)
+            _add(state['late_by_loaner'], loaner_id, 1)
+    _apply(previous_version, update)
+
+def on_return(previous_version, loaner_id, book_id, loan_date):
+    """Update the counters after a loan was returned"""
+    def update(state):
+        _add(state['active_by_book'], book_id, -1)
+        _add(state['active_by_loaner'], loaner_id, -1)
+        if _is_late(loan_date):
+            _add(state['late_by_book'], book_id, -1)
+            _add(state['late_by_loaner'], loaner_id, -1)
+    _apply(previous_version, update)
+
+def on_book_added(previous_version):
+    """Update the counters after a book was added"""
+    _apply(previous_version, lambda state: state.update(total_books=state['total_books'] + 1))
+
+def on_loaner_added(previous_version):
+    """Update the counters after a loaner was added"""
+    _apply(previous_version, lambda state: state.update(total_loaners=state['total_loaners'] + 1))
+
+def on_unchanged(previous_version):
+    """Keep the counters after a write that does not affect them (e.g. (de)activating a book)"""
+    _state.unchanged((previous_version, date.today()))
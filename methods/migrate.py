@@ -0,0 +1,69 @@
+"""
+Copy the library data from one storage backend to another.
+
+    python -m methods.migrate                            # demo CSVs -> paths.sqlite_db_path
+    python -m methods.migrate --to parquet               # demo CSVs -> paths.parquet_dir_path
+    python -m methods.migrate --from parquet --to csv    # back to the CSV files
+    python -m methods.migrate --prod                     # the production files instead of the demo ones
+    python -m methods.migrate --db other.db
+    python -m methods.migrate --to parquet --dir other_dir
+
+The logs of the source (loan events, catalog edits) are replayed before
+copying, so pending checkouts, returns and edits are not lost, and the loan
+archive is copied along. Existing data in the target is replaced.
+"""
+
+import argparse
+
+import paths
+from methods import aggregates
+from methods.storage import CsvStorage, ParquetStorage, SqliteStorage
+
+BACKENDS = ['csv', 'sqlite', 'parquet']
+
+def open_storage(backend, prod=False, db_path=None, parquet_dir=None):
+    """Return the storage of a backend on the demo or production files"""
+    if backend == 'sqlite':
+        return SqliteStorage(db_path or (paths.prod_sqlite_db_path if prod else paths.sqlite_db_path))
+    if backend == 'parquet':
+        return ParquetStorage(parquet_dir or (paths.prod_parquet_dir_path if prod else paths.parquet_dir_path))
+    if prod:
+        return CsvStorage(paths.prod_book_names_path, paths.prod_book_loaners_path,
+                          paths.prod_loans_log_path, paths.prod_loans_events_path, paths.prod_catalog_patches_path)
+    return CsvStorage()
+
+def copy_storage(source, target):
+    """Copy books, loaners and loans (archived ones included) from one storage into another"""
+    books_df = source.load_books()
+    loaners_df = source.load_loaners()
+    loans_df = source.load_loans()
+    archived_df = source.archive.load()
+    target.save_books(books_df)
+    target.save_loaners(loaners_df)
+    target.archive.clear()
+    if len(archived_df):
+        target.archive.add(archived_df)
+    target.save_loans(loans_df)
+    return len(books_df), len(loaners_df), len(loans_df) + len(archived_df)
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy the library data between storage backends")
+    parser.add_argument('--from', dest='source', choices=BACKENDS, default='csv', help="backend to read (default csv)")
+    parser.add_argument('--to', dest='target', choices=BACKENDS, default='sqlite', help="backend to write (default sqlite)")
+    parser.add_argument('--prod', action='store_true', help="migrate the production files instead of the demo ones")
+    parser.add_argument('--db', help="target database path (defaults to the configured one)")
+    parser.add_argument('--dir', help="target Parquet directory (defaults to the configured one)")
+    args = parser.parse_args()
+    if args.source == args.target:
+        parser.error("--from and --to must be different backends")
+
+    source = open_storage(args.source, args.prod)
+    target = open_storage(args.target, args.prod, db_path=args.db, parquet_dir=args.dir)
+    books, loaners, loans = copy_storage(source, target)
+    # The saved statistics may match the versions of the database that was replaced
+    aggregates.discard(paths.prod_aggregates_path if args.prod else paths.aggregates_path)
+    print(f"Copied {books} books, {loaners} loaners and {loans} loans from {args.source} to {args.target} "
+          f"({', '.join(target.data_files()[:3])})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+"""
+Library operations: loading the data, the writes with their hooks, and the
+rules of the forms (duplicates, removals, edit validation).
+
+Nothing here imports Streamlit or Plotly, so batch jobs and the CLI below load
+only pandas and the storage; the tabs are thin views over these functions.
+
+    python -m methods.operations late [--csv]     # the late loans, e.g. for a nightly report
+    python -m methods.operations metrics
+    python -m methods.operations loan LOANER_ID BOOK_ID [--date YYYY-MM-DD]
+    python -m methods.operations return LOANER_ID BOOK_ID LOAN_DATE [--date YYYY-MM-DD]
+"""
+
+import argparse
+import sys
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+import paths
+from methods.storage import StaleWriteError, get_storage
+from methods.profiling import profiled
+from methods.views import borrowing_loaner_ids, late_loans_view, loaned_book_ids
+from methods import aggregates, backuper, metrics, search
+
+@profiled
+def load_data():
+    """Load data from the configured storage, reusing the cached frames of tables that did not change
+
+    The frames are the cached ones shared by all sessions, callers must not modify them.
+    """
+    storage = get_storage()
+    return storage.load_books(), storage.load_loaners(), storage.load_loans()
+
+@profiled
+def save_loans(df, expected_version=None):
+    """Save loans data, replacing all stored loans (rejected if they changed since expected_version)"""
+    get_storage().save_loans(df, expected_version)
+    backuper.request_snapshot()
+
+@profiled
+def save_books(df, expected_version=None):
+    """Save books data (rejected if they changed since expected_version)"""
+    get_storage().save_books(df, expected_version)
+    backuper.request_snapshot()
+
+@profiled
+def save_loaners(df, expected_version=None):
+    """Save loaners data (rejected if they changed since expected_version)"""
+    get_storage().save_loaners(df, expected_version)
+    backuper.request_snapshot()
+
+@contextmanager
+def _writing(catalog=False):
+    """Hold the storage write lock around a write and its hooks, then ask the backup thread for a snapshot
+
+    Yields (storage, data version, catalog version or None): the versions the incremental
+    metrics, aggregates and (for writes of books and loaners, catalog=True) search index
+    were built at, read under the lock so a write by another session can never slip in
+    between. The search index only depends on the books and loaners, so loan writes leave it be.
+    """
+    storage = get_storage()
+    with storage.write_lock():
+        yield storage, storage.data_version(), search.catalog_version() if catalog else None
+        backuper.request_snapshot()
+
+@profiled
+def add_book(name, author, category):
+    """Add a new active book and return its id"""
+    with _writing(catalog=True) as (storage, version, catalog):
+        book_id = storage.add_book(name, author, category)
+        metrics.on_book_added(version)
+        aggregates.on_book_added(version, book_id, name, author, category)
+        search.on_book_added(catalog, book_id, name, author)
+    return book_id
+
+@profiled
+def set_book_active(book_id, active):
+    """Activate or deactivate a single book"""
+    with _writing(catalog=True) as (storage, version, catalog):
+        storage.set_book_active(book_id, active)
+        metrics.on_unchanged(version)
+        aggregates.on_unchanged(version)
+        search.on_books_edited(catalog, {book_id: {'active': active}})
+
+@profiled
+def update_books(changes, expected=None):
+    """Save cell edits of books given as {book_id: {column: value}}, writing only the edited cells
+
+    expected holds the values the edits were based on, a conflicting edit by another session raises StaleWriteError.
+    """
+    with _writing(catalog=True) as (storage, version, catalog):
+        storage.update_books(changes, expected)
+        metrics.on_unchanged(version)
+        aggregates.on_books_edited(version, changes)
+        search.on_books_edited(catalog, changes)
+
+@profiled
+def add_loaner(name, surname, phone):
+    """Add a new active loaner and return its id"""
+    with _writing(catalog=True) as (storage, version, catalog):
+        loaner_id = storage.add_loaner(name, surname, phone)
+        metrics.on_loaner_added(version)
+        aggregates.on_unchanged(version)
+        search.on_loaner_added(catalog, loaner_id, name, surname)
+    return loaner_id
+
+@profiled
+def set_loaner_active(loaner_id, active):
+    """Activate or deactivate a single loaner"""
+    with _writing(catalog=True) as (storage, version, catalog):
+        storage.set_loaner_active(loaner_id, active)
+        metrics.on_unchanged(version)
+        aggregates.on_unchanged(version)
+        search.on_loaners_edited(catalog, {loaner_id: {'active': active}})
+
+@profiled
+def update_loaners(changes, expected=None):
+    """Save cell edits of loaners given as {loaner_id: {column: value}}, see update_books"""
+    with _writing(catalog=True) as (storage, version, catalog):
+        storage.update_loaners(changes, expected)
+        metrics.on_unchanged(version)
+        aggregates.on_unchanged(version)
+        search.on_loaners_edited(catalog, changes)
+
+@profiled
+def record_loan(loaner_id, book_id, loan_date):
+    """Record a new loan (loan_date is a date or Timestamp), StaleWriteError if the book was loaned meanwhile"""
+    with _writing() as (storage, version, _):
+        storage.record_loan(loaner_id, book_id, loan_date)
+        metrics.on_checkout(version, loaner_id, book_id, loan_date)
+        aggregates.on_checkout(version, loaner_id, book_id, loan_date)
+
+@profiled
+def record_return(loaner_id, book_id, loan_date, return_date):
+    """Record the return of an open loan (dates are dates or Timestamps), StaleWriteError if it was returned meanwhile"""
+    with _writing() as (storage, version, _):
+        storage.record_return(loaner_id, book_id, loan_date, return_date)
+        metrics.on_return(version, loaner_id, book_id, loan_date)
+        aggregates.on_return(version, loan_date, return_date)
+
+@profiled
+def compact_loans():
+    """Fold pending loan events into the loans store"""
+    get_storage().compact_loans()
+    backuper.request_snapshot()
+
+@profiled
+def archive_loans(days=None):
+    """Archive the loans returned more than days (default paths.loan_archive_days) days ago and return how many were moved"""
+    before = date.today() - timedelta(days=paths.loan_archive_days if days is None else days)
+    with _writing() as (storage, version, _):
+        moved = storage.archive_loans(before)
+        # The history is the same, only split differently, so nothing derived from it changes
+        metrics.on_unchanged(version)
+        aggregates.on_unchanged(version)
+    return moved
+
+def add_or_restore_book(name, author, category):
+    """Add a book, or reactivate the removed book of the same name and author (ignoring case)
+
+    Return (book_id, outcome), outcome being 'added', 'restored' or 'exists' when an active book
+    has the same name and author (nothing is written then).
+    """
+    books_df = get_storage().load_books()
+    same = (books_df['author'].str.lower() == author.lower()) & (books_df['name'].str.lower() == name.lower())
+    if not same.any():
+        return add_book(name, author, category), 'added'
+    book = books_df[same].iloc[0]
+    if book['active']:
+        return int(book['id']), 'exists'
+    set_book_active(int(book['id']), True)
+    return int(book['id']), 'restored'
+
+def add_or_restore_loaner(name, surname, phone):
+    """Add a loaner, or reactivate the removed loaner of the same name and surname, see add_or_restore_book"""
+    loaners_df = get_storage().load_loaners()
+    same = (loaners_df['name'].str.lower() == name.lower()) & (loaners_df['surname'].str.lower() == surname.lower())
+    if not same.any():
+        return add_loaner(name, surname, phone), 'added'
+    loaner = loaners_df[same].iloc[0]
+    if loaner['active']:
+        return int(loaner['id']), 'exists'
+    set_loaner_active(int(loaner['id']), True)
+    return int(loaner['id']), 'restored'
+
+def remove_book(book_id):
+    """Deactivate a book (books are never deleted), unless it is on loan; return whether it was removed"""
+    if book_id in loaned_book_ids():
+        return False
+    set_book_active(book_id, False)
+    return True
+
+def remove_loaner(loaner_id):
+    """Deactivate a loaner, unless they have open loans; return whether they were removed"""
+    if loaner_id in borrowing_loaner_ids():
+        return False
+    set_loaner_active(loaner_id, False)
+    return True
+
+def validate_book_changes(changes, page_books):
+    """Return error messages for edits of the id-indexed page_books that cannot be saved"""
+    errors = []
+    for book_id, values in changes.items():
+        name = page_books.loc[book_id, 'name']
+        if any(column in values and not str(values[column] or '').strip() for column in ['name', 'author']):
+            errors.append(f"לא ניתן לשמור את '{name}': יש למלא שם הספר ומחבר")
+        if values.get('active') is False and book_id in loaned_book_ids():
+            errors.append(f"לא ניתן להסיר את '{name}': הספר נמצא בהשאלה!")
+    return errors
+
+def validate_loaner_changes(changes, page_loaners):
+    """Return error messages for edits of the id-indexed page_loaners that cannot be saved"""
+    errors = []
+    for loaner_id, values in changes.items():
+        name = page_loaners.loc[loaner_id, 'name'] + ' ' + page_loaners.loc[loaner_id, 'surname']
+        if any(column in values and not str(values[column] or '').strip() for column in ['name', 'surname']):
+            errors.append(f"לא ניתן לשמור את '{name}': יש למלא שם ושם משפחה")
+        if values.get('active') is False and loaner_id in borrowing_loaner_ids():
+            errors.append(f"לא ניתן להסיר את '{name}': יש לו השאלות פעילות!")
+    return errors
+
+def late_report():
+    """Return the late loans, longest first, with what is needed to call the loaner"""
+    columns = ['loan_duration', 'loan_date', 'name_loaner', 'surname', 'phone', 'name_book', 'author']
+    return late_loans_view()[columns].sort_values('loan_duration', ascending=False, kind='stable')
+
+def main():
+    parser = argparse.ArgumentParser(description="Library operations without the web app")
+    commands = parser.add_subparsers(dest='command', required=True)
+    late = commands.add_parser('late', help="print the late loans")
+    late.add_argument('--csv', action='store_true', help="print CSV instead of a table")
+    commands.add_parser('metrics', help="print the dashboard metrics")
+    loan = commands.add_parser('loan', help="record a loan")
+    loan.add_argument('loaner_id', type=int)
+    loan.add_argument('book_id', type=int)
+    loan.add_argument('--date', type=date.fromisoformat, default=date.today(), help="loan date, YYYY-MM-DD (default today)")
+    ret = commands.add_parser('return', help="record the return of an open loan")
+    ret.add_argument('loaner_id', type=int)
+    ret.add_argument('book_id', type=int)
+    ret.add_argument('loan_date', type=date.fromisoformat, help="YYYY-MM-DD")
+    ret.add_argument('--date', type=date.fromisoformat, default=date.today(), help="return date, YYYY-MM-DD (default today)")
+    args = parser.parse_args()
+
+    if args.command == 'late':
+        report = late_report()
+        if args.csv:
+            report.to_csv(sys.stdout, index=False, date_format='%d/%m/%Y')
+        else:
+            print(report.to_string(index=False) if len(report) else "No late loans")
+        return
+    if args.command == 'metrics':
+        for name, value in metrics.get_metrics().items():
+            print(f"{name:20} {value}")
+        return
+    storage = get_storage()
+    if args.loaner_id not in set(storage.load_loaners()['id'].tolist()):
+        parser.error(f"no loaner {args.loaner_id}")
+    books_df = storage.load_books()
+    if args.book_id not in set(books_df.loc[books_df['active'], 'id'].tolist()):
+        parser.error(f"no active book {args.book_id}")
+    try:
+        if args.command == 'loan':
+            record_loan(args.loaner_id, args.book_id, args.date)
+        else:
+            record_return(args.loaner_id, args.book_id, args.loan_date, args.date)
+    except StaleWriteError as e:
+        parser.exit(1, f"{e}\n")
+    # No backup thread runs here, so the snapshot the write asked for is taken now
+    print(f"Recorded, snapshot {backuper.snapshot_storage() or 'unchanged'}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+Timing of the app reruns, switched on with SIMPLIB_PROFILE=1 or ?profile=1.
+
+Functions decorated with @profiled (data loading, the tab renderers, the view
+joins and the writes) record their wall time in the rerun being profiled on
+the calling thread, and only cost an attribute lookup otherwise. Each profiled
+rerun is appended as a JSON line to paths.profile_log_path; with
+SIMPLIB_PROFILE=cprofile (or ?profile=cprofile) a cProfile dump of the rerun is
+written next to it as well.
+
+    python -m methods.profiling [LOG]    # percentiles of the logged reruns
+"""
+
+import cProfile
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import paths
+
+# Reruns kept in a session for the percentiles of the debug panel
+PROFILE_HISTORY = 200
+
+_local = threading.local()
+_log_lock = threading.Lock()
+
+def profile_mode(query_value=None):
+    """Return None, 'timers' or 'cprofile' from the ?profile= value or else SIMPLIB_PROFILE"""
+    value = (query_value or os.environ.get('SIMPLIB_PROFILE', '')).strip().lower()
+    if value in ('', '0', 'false', 'off'):
+        return None
+    return 'cprofile' if value == 'cprofile' else 'timers'
+
+@contextmanager
+def timer(name):
+    """Time a block in the profiled rerun of the calling thread (does nothing if there is none)"""
+    record = getattr(_local, 'record', None)
+    if record is None:
+        yield
+        return
+    # [name, nesting depth, seconds], kept in call order
+    entry = [name, _local.depth, 0.0]
+    record['timings'].append(entry)
+    _local.depth += 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        entry[2] = time.perf_counter() - start
+        _local.depth -= 1
+
+def profiled(func):
+    """Time each call of func made during a profiled rerun"""
+    name = f"{func.__module__.rsplit('.', 1)[-1]}.{func.__name__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if getattr(_local, 'record', None) is None:
+            return func(*args, **kwargs)
+        with timer(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+@contextmanager
+def profile_rerun(label, mode, history=None):
+    """Profile the rerun run in the block, yielding its record (None when mode is None)
+
+    The record is appended to history (trimmed to PROFILE_HISTORY reruns) and to
+    the log even when the block is left by an exception, st.rerun() included.
+    """
+    if mode is None:
+        yield None
+        return
+    record = {'time': datetime.now().isoformat(timespec='milliseconds'), 'label': label, 'total': 0.0, 'timings': []}
+    _local.record, _local.depth = record, 0
+    profiler = cProfile.Profile() if mode == 'cprofile' else None
+    if profiler is not None:
+        try:
+            profiler.enable()
+        except ValueError:  # another session is being profiled (a single profiler can run at a time since 3.12)
+            profiler = None
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['total'] = time.perf_counter() - start
+        if profiler is not None:
+            profiler.disable()
+        _local.record = None
+        if history is not None:
+            history.append(record)
+            del history[:-PROFILE_HISTORY]
+        _write_log(record, profiler)
+
+def _write_log(record, profiler):
+    """Append the record to the log, and dump the cProfile stats of the rerun if they were collected"""
+    os.makedirs(paths.profile_dir_path, exist_ok=True)
+    if profiler is not None:
+        stamp = record['time'].replace(':', '').replace('-', '').replace('.', '_')
+        record['cprofile'] = os.path.join(paths.profile_dir_path, f"{stamp}_{record['label']}.prof")
+        profiler.dump_stats(record['cprofile'])
+    with _log_lock, open(paths.profile_log_path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+def breakdown(record):
+    """Return the timed calls of a rerun in call order, nested names indented"""
+    rows = [('  ' * depth + name, seconds * 1000, 100 * seconds / record['total'] if record['total'] else 0.0)
+            for name, depth, seconds in record['timings']]
+    return pd.DataFrame(rows, columns=['name', 'ms', '% of rerun'])
+
+def percentiles(records):
+    """Return the p50, p90, p99 and max time per rerun of each timed name over the records, slowest first"""
+    times = {'rerun': [record['total'] for record in records]}
+    for record in records:
+        totals = {}
+        for name, _, seconds in record['timings']:
+            totals[name] = totals.get(name, 0.0) + seconds
+        for name, seconds in totals.items():
+            times.setdefault(name, []).append(seconds)
+    rows = [(name, len(values), *(np.percentile(values, [50, 90, 99]) * 1000), max(values) * 1000)
+            for name, values in times.items()]
+    return pd.DataFrame(rows, columns=['name', 'reruns', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms']) \
+             .sort_values('p50 ms', ascending=False, ignore_index=True)
+
+def load_log(path=None):
+    """Return the records of the profiling log"""
+    with open(path or paths.profile_log_path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def main():
+    records = load_log(sys.argv[1] if len(sys.argv) > 1 else None)
+    for label in sorted({record['label'] for record in records}):
+        selected = [record for record in records if record['label'] == label]
+        print(f"{label} ({len(selected)} reruns)")
+        print(percentiles(selected).to_string(index=False, float_format='{:.1f}'.format))
+        print()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+"""
+Hebrew-aware search index over books (name and author) and loaners (name and surname).
+
+Text is normalized before indexing and querying: niqqud and cantillation marks,
+geresh/gershayim (and the ASCII quotes typed in their place) and punctuation
+are stripped, final letters are folded to their regular form and Latin letters
+are lowercased, so "ג'יי.קיי רולינג" is found by "גיי קיי רולינג".
+
+A document matches when every query word is a prefix of one of its words, or,
+failing that, when enough of the query's trigrams appear in it (typo tolerance).
+Removed (inactive) books and loaners stay indexed but are only returned when
+asked for, e.g. by the history filters.
+The index is built once per version of the books and loaners tables (loans do
+not affect it) and then kept in sync by the on_* hooks that methods/operations.py
+calls after adding or editing a book or a loaner.
+"""
+
+import bisect
+import re
+from collections import Counter, defaultdict
+
+from methods.derived import VersionedState
+from methods.storage import get_storage
+from methods.profiling import profiled
+
+# Number of results returned when the caller does not ask for a specific amount (pickers);
+# filters of tables and exports pass limit=None to get every match
+DEFAULT_LIMIT = 100
+# Minimal share of the query trigrams a document must contain to count as a fuzzy match
+FUZZY_THRESHOLD = 0.5
+
+_FINAL_LETTERS = str.maketrans('ךםןףץ', 'כמנפצ')
+# Niqqud and cantillation marks (maqaf, paseq and sof pasuq are left to act as separators)
+_MARKS = re.compile('[\u0591-\u05BD\u05BF\u05C1\u05C2\u05C4\u05C5\u05C7]')
+# Geresh, gershayim and the quotes typed in their place are dropped, other punctuation separates words
+_DROPPED = re.compile('[\u05F3\u05F4\'"`]')
+_SEPARATORS = re.compile(r'[^\w]+')
+
+def normalize(text):
+    """Normalize Hebrew (and Latin) text for searching"""
+    text = _MARKS.sub('', str(text))
+    text = _DROPPED.sub('', text)
+    text = _SEPARATORS.sub(' ', text)
+    return text.translate(_FINAL_LETTERS).lower().strip()
+
+def _trigrams(tokens):
+    """Return the set of padded trigrams of the given words"""
+    grams = set()
+    for token in tokens:
+        padded = f'  {token} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class SearchIndex:
+    """Prefix and trigram index over (kind, id) documents"""
+
+    def __init__(self):
+        # key -> (label, normalized text, trigrams, original texts)
+        self._docs = {}
+        # Sorted (word, key) pairs for prefix lookups
+        self._words = []
+        # trigram -> keys of the documents containing it
+        self._grams = defaultdict(set)
+        # Keys of the removed books and loaners
+        self._inactive = set()
+
+    def __len__(self):
+        return len(self._docs)
+
+    @classmethod
+    def build(cls, docs):
+        """Return an index of (key, label, texts, active) documents, sorting the words once instead of per document"""
+        index = cls()
+        words = []
+        for key, label, texts, active in docs:
+            words.extend((token, key) for token in index._store(key, label, texts, active))
+        words.sort()
+        index._words = words
+        return index
+
+    def _store(self, key, label, texts, active):
+        """Index a document except for its words, and return them"""
+        text = normalize(' '.join(str(t) for t in texts))
+        tokens = set(text.split())
+        grams = _trigrams(tokens)
+        self._docs[key] = (label, text, grams, texts)
+        self.set_active(key, active)
+        for gram in grams:
+            self._grams[gram].add(key)
+        return tokens
+
+    def add(self, key, label, *texts, active=True):
+        """Index a document (replacing an older version with the same key)"""
+        if key in self._docs:
+            self.remove(key)
+        for token in self._store(key, label, texts, active):
+            bisect.insort(self._words, (token, key))
+
+    def remove(self, key):
+        """Drop a document from the index"""
+        label, text, grams, texts = self._docs.pop(key)
+        for token in set(text.split()):
+            i = bisect.bisect_left(self._words, (token, key))
+            if i < len(self._words) and self._words[i] == (token, key):
+                del self._words[i]
+        for gram in grams:
+            self._grams[gram].discard(key)
+        self._inactive.discard(key)
+
+    def set_active(self, key, active):
+        """Mark a document as active or removed"""
+        if active:
+            self._inactive.discard(key)
+        else:
+            self._inactive.add(key)
+
+    def is_active(self, key):
+        return key not in self._inactive
+
+    def label(self, key):
+        return self._docs[key][0]
+
+    def texts(self, key):
+        """Return the original texts a document was indexed with"""
+        return self._docs[key][3]
+
+    def _prefix_matches(self, prefix):
+        """Return the keys of the documents with a word starting with prefix"""
+        keys = set()
+        i = bisect.bisect_left(self._words, (prefix,))
+        while i < len(self._words) and self._words[i][0].startswith(prefix):
+            keys.add(self._words[i][1])
+            i += 1
+        return keys
+
+    def search(self, query, kinds=None, limit=DEFAULT_LIMIT, inactive=False):
+        """Return the keys of the best matching documents, best first (removed ones too if inactive)"""
+        tokens = normalize(query).split()
+        if not tokens:
+            return []
+        text = ' '.join(tokens)
+        scores = {}
+        matches = None
+        for token in tokens:
+            keys = self._prefix_matches(token)
+            matches = keys if matches is None else matches & keys
+        for key in matches:
+            # Documents that start with the whole query rank above ones that only contain its words
+            scores[key] = 3.0 if self._docs[key][1].startswith(text) else 2.0
+        query_grams = _trigrams(tokens)
+        shared = Counter()
+        for gram in query_grams:
+            shared.update(self._grams.get(gram, ()))
+        for key, count in shared.items():
+            similarity = count / len(query_grams)
+            if key not in scores and similarity >= FUZZY_THRESHOLD:
+                scores[key] = similarity
+        if kinds is not None:
+            scores = {key: score for key, score in scores.items() if key[0] in kinds}
+        if not inactive:
+            scores = {key: score for key, score in scores.items() if key not in self._inactive}
+        ranked = sorted(scores, key=lambda key: (-scores[key], self._docs[key][0]))
+        return ranked if limit is None else ranked[:limit]
+
+
+# Indexed columns of each document kind
+_FIELDS = {'book': ('name', 'author'), 'loaner': ('name', 'surname')}
+
+def _book_doc(book_id, name, author, active=True):
+    return ('book', int(book_id)), f"{name} - {author}", (name, author), active
+
+def _loaner_doc(loaner_id, name, surname, active=True):
+    return ('loaner', int(loaner_id)), f"{name} {surname}", (name, surname), active
+
+_DOCS = {'book': _book_doc, 'loaner': _loaner_doc}
+
+def _add(index, doc):
+    key, label, texts, active = doc
+    index.add(key, label, *texts, active=active)
+
+def _build_index(books_df, loaners_df):
+    books = zip(books_df['id'], books_df['name'], books_df['author'], books_df['active'].astype(bool))
+    loaners = zip(loaners_df['id'], loaners_df['name'], loaners_df['surname'], loaners_df['active'].astype(bool))
+    return SearchIndex.build([_book_doc(*book) for book in books] + [_loaner_doc(*loaner) for loaner in loaners])
+
+def catalog_version():
+    """Return the versions of the books and loaners tables, which are all the index depends on"""
+    storage = get_storage()
+    return storage.table_version('books'), storage.table_version('loaners')
+
+def _build_stored_index(key):
+    storage = get_storage()
+    return _build_index(storage.load_books(), storage.load_loaners())
+
+_state = VersionedState(catalog_version, _build_stored_index)
+
+def get_search_index():
+    """Return the search index of the current books and loaners, building it if they changed outside the hooks"""
+    return _state.get()
+
+@profiled
+def search_books(query, limit=DEFAULT_LIMIT, inactive=False):
+    """Return the ids of the books whose name or author best match query (limit=None for all of them)"""
+    return [key[1] for key in get_search_index().search(query, kinds=('book',), limit=limit, inactive=inactive)]
+
+@profiled
+def search_loaners(query, limit=DEFAULT_LIMIT, inactive=False):
+    """Return the ids of the loaners whose name or surname best match query (limit=None for all of them)"""
+    return [key[1] for key in get_search_index().search(query, kinds=('loaner',), limit=limit, inactive=inactive)]
+
+@profiled
+def search_all(query, limit=DEFAULT_LIMIT, inactive=False):
+    """Return (book ids, loaner ids) best matching query"""
+    keys = get_search_index().search(query, limit=limit, inactive=inactive)
+    return [key[1] for key in keys if key[0] == 'book'], [key[1] for key in keys if key[0] == 'loaner']
+
+# The hooks take the catalog_version() read right before the write, and update
+# the index only if it was current then (otherwise it is dropped and rebuilt)
+
+def on_book_added(previous_version, book_id, name, author):
+    """Index a newly added book"""
+    _state.apply(previous_version, lambda index: _add(index, _book_doc(book_id, name, author)))
+
+def on_loaner_added(previous_version, loaner_id, name, surname):
+    """Index a newly added loaner"""
+    _state.apply(previous_version, lambda index: _add(index, _loaner_doc(loaner_id, name, surname)))
+
+def _on_edited(kind, previous_version, changes):
+    """Re-index only the documents whose indexed columns (or active flag) were edited"""
+    def update(index):
+        for doc_id, values in changes.items():
+            key = (kind, int(doc_id))
+            fields = dict(zip(_FIELDS[kind], index.texts(key)))
+            active = bool(values.get('active', index.is_active(key)))
+            if any(column in fields for column in values):
+                fields.update((column, value) for column, value in values.items() if column in fields)
+                _add(index, _DOCS[kind](doc_id, *fields.values(), active))
+            else:
+                index.set_active(key, active)
+    _state.apply(previous_version, update)
+
+def on_books_edited(previous_version, changes):
+    """Re-index books after cell edits given as {book_id: {column: value}} (a removal being {'active': False})"""
+    _on_edited('book', previous_version, changes)
+
+def on_loaners_edited(previous_version, changes):
+    """Re-index loaners after cell edits given as {loaner_id: {column: value}}"""
+    _on_edited('loaner', previous_version, changes)
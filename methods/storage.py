@@ -0,0 +1,1042 @@
+"""
+Storage backends for the library data.
+
+The backend is chosen by `storage_backend` in paths.py (or the SIMPLIB_STORAGE
+environment variable):
+- 'csv'    - the CSV files with append-only logs for loan events and catalog edits (default)
+- 'sqlite' - a single SQLite database with indexed tables
+- 'parquet' - typed, compressed Parquet snapshots with the same append-only logs as 'csv'
+
+Frames returned by the load_* methods are cached and shared, callers must copy
+them before modifying. Writes from several sessions (threads or processes) are
+serialized by an inter-process lock (see write_lock()); CSV files are replaced
+atomically, and writes based on data that changed in the meantime raise
+StaleWriteError instead of overwriting the other session's changes. Loan dates are parsed once, on load, into datetime64
+columns (NaT for open loans); the dd/mm/YYYY text format only exists in the
+CSV files and is applied by the tabs at render time.
+
+Returned loans older than paths.loan_archive_days can be moved by
+archive_loans() (see methods/archive.py) to a LoanArchive of read-only, compressed
+yearly partitions, kept next to the loans file or database. load_loans() and
+everything the loans, books and loaners tabs read then only cover the open and
+recent loans; load_loan_history() adds the archived ones, read on first use.
+query_loans() serves the history tab a page of matching loans at a time,
+reading only the partitions the page reaches.
+
+Every backend hands out frames with the compact dtypes of FRAME_DTYPES (see
+compact_frame()): int32 ids, Arrow-backed strings, and categoricals for the
+text that repeats from row to row. Categorical columns cannot be concatenated,
+code that builds labels from them uses methods.views.text() first.
+"""
+
+import csv
+import glob
+import gzip
+import os
+import sqlite3
+import tempfile
+import threading
+from collections import Counter
+from contextlib import closing
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+import paths
+from methods.locking import FileLock
+
+BOOK_COLUMNS = ['id', 'name', 'author', 'category', 'active']
+LOANER_COLUMNS = ['id', 'name', 'surname', 'phone', 'active']
+# Columns of the loans snapshot and of the append-only loan event log
+LOAN_COLUMNS = ['loaner_id', 'book_id', 'loan_date', 'return_date']
+LOAN_EVENT_COLUMNS = ['event'] + LOAN_COLUMNS
+# Fold the event log into the snapshot once it grows past this size
+LOAN_EVENTS_COMPACT_BYTES = 64 * 1024
+# Columns of the append-only catalog patch log (cell edits of books and loaners)
+PATCH_COLUMNS = ['table', 'id', 'column', 'value']
+# Columns that can be edited through update_books / update_loaners
+BOOK_EDITABLE_COLUMNS = ['name', 'author', 'category', 'active']
+LOANER_EDITABLE_COLUMNS = ['name', 'surname', 'phone', 'active']
+# Fold the patch log into the books and loaners files once it grows past this size
+PATCHES_COMPACT_BYTES = 64 * 1024
+# Format of the dates in the CSV files
+DATE_FORMAT = '%d/%m/%Y'
+# In-memory dtypes of the loaded frames: narrow ids, Arrow-backed text, and
+# categoricals for the columns whose values repeat (authors, categories, surnames)
+FRAME_DTYPES = {
+    'books': {'id': 'int32', 'name': 'string[pyarrow]', 'author': 'category', 'category': 'category', 'active': 'bool'},
+    'loaners': {'id': 'int32', 'name': 'string[pyarrow]', 'surname': 'category', 'phone': 'string[pyarrow]', 'active': 'bool'},
+    'loans': {'loaner_id': 'int32', 'book_id': 'int32'},
+}
+
+
+class StaleWriteError(Exception):
+    """Raised when a write is based on data that another session changed in the meantime"""
+
+
+class Storage:
+    """Interface implemented by every storage backend"""
+
+    def write_lock(self):
+        """Return the inter-process lock held by every write (re-entrant, so callers can wrap several writes)"""
+        return self._write_lock
+
+    def data_files(self):
+        """Return the paths of the files holding the data (what a backup must copy)"""
+        raise NotImplementedError
+
+    def data_version(self):
+        """Return a cheap token that changes whenever any stored table changes"""
+        raise NotImplementedError
+
+    def table_version(self, table):
+        """Return a token that changes whenever the given table ('books', 'loaners' or 'loans') changes"""
+        raise NotImplementedError
+
+    def load_books(self):
+        raise NotImplementedError
+
+    def load_loaners(self):
+        raise NotImplementedError
+
+    def load_loans(self):
+        """Return the current loans: the open ones and those returned too recently to be archived"""
+        raise NotImplementedError
+
+    def load_loan_history(self):
+        """Return every loan: the archived ones (read from the partitions on first use) followed by the current ones"""
+        loans_df = self.load_loans()
+        stamp = (self.archive.stamp(), self.table_version('loans'))
+        if not stamp[0]:
+            return loans_df
+        with self._lock:
+            cached = self._cache.get('loan_history')
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        history_df = pd.concat([self.archive.load(), loans_df], ignore_index=True)
+        with self._lock:
+            self._cache['loan_history'] = (stamp, history_df)
+        return history_df
+
+    def archive_loans(self, before):
+        """Move the loans returned before the date `before` to the archive and return how many were moved"""
+        with self.write_lock():
+            loans_df = self.load_loans()
+            archived = (loans_df['return_date'] < pd.Timestamp(before)).to_numpy()
+            if archived.any():
+                # Partitions first: if the current loans are not rewritten, the next run archives the same loans
+                # again and LoanArchive.add drops the duplicates
+                self.archive.add(loans_df[archived])
+                self.save_loans(loans_df[~archived].reset_index(drop=True))
+            return int(archived.sum())
+
+    def query_loans(self, start=None, end=None, loaner_id=None, book_id=None, status=None, limit=None):
+        """Return (loans, more): the first limit loans matching the filters, newest first, and whether more match
+
+        start and end are dates (both included) the loans started between, status is 'active' or 'returned'.
+        Archive partitions of the years in range are read newest first, only while they can still hold one of
+        the first limit loans, and kept cached.
+        """
+        wanted = None if limit is None else limit + 1
+        found = [self._match_current_loans(start, end, loaner_id, book_id, status, wanted)]
+        # Archived loans are all returned
+        for year, path in ([] if status == 'active' else reversed(self.archive.partitions())):
+            if (start is not None and year < start.year) or (end is not None and year > end.year):
+                continue
+            # The loans of this partition and the older ones all started before the next year
+            if wanted is not None and sum((df['loan_date'] >= pd.Timestamp(year + 1, 1, 1)).sum() for df in found) >= wanted:
+                break
+            found.append(_match_loans(self._read_partition(path), start, end, loaner_id, book_id, status).head(wanted))
+        # Each part is newest first already, and a current loan comes before an archived one of the same date
+        loans_df = pd.concat(found, ignore_index=True).sort_values('loan_date', ascending=False, kind='stable') \
+            if len(found) > 1 else found[0]
+        if wanted is None:
+            return loans_df.reset_index(drop=True), False
+        return loans_df.head(limit).reset_index(drop=True), len(loans_df) > limit
+
+    def _match_current_loans(self, start, end, loaner_id, book_id, status, limit):
+        """Return the current loans matching the query_loans filters, newest first, at most limit of them"""
+        return _match_loans(self.load_loans(), start, end, loaner_id, book_id, status).head(limit)
+
+    def _read_partition(self, path):
+        """Return an archive partition, cached until it is rewritten"""
+        stamp = _file_stamp(path)
+        with self._lock:
+            cached = self._cache.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        df = self.archive.read(path)
+        with self._lock:
+            self._cache[path] = (stamp, df)
+        return df
+
+    def active_loans(self):
+        """Return the loans that were not returned yet"""
+        raise NotImplementedError
+
+    def late_loans(self, days):
+        """Return the open loans that started more than `days` days ago"""
+        raise NotImplementedError
+
+    def save_books(self, df, expected_version=None):
+        """Replace all books, raising StaleWriteError if the table changed since expected_version"""
+        raise NotImplementedError
+
+    def save_loaners(self, df, expected_version=None):
+        """Replace all loaners, raising StaleWriteError if the table changed since expected_version"""
+        raise NotImplementedError
+
+    def save_loans(self, df, expected_version=None):
+        """Replace all loans, raising StaleWriteError if the table changed since expected_version"""
+        raise NotImplementedError
+
+    def add_book(self, name, author, category):
+        """Insert a new active book and return its id"""
+        raise NotImplementedError
+
+    def set_book_active(self, book_id, active):
+        raise NotImplementedError
+
+    def update_books(self, changes, expected=None):
+        """Apply cell edits given as {book_id: {column: value}}
+
+        expected holds the values the edits were based on, in the same shape. Edits of
+        other cells are merged, but if any expected cell changed meanwhile nothing is
+        written and StaleWriteError is raised.
+        """
+        raise NotImplementedError
+
+    def add_loaner(self, name, surname, phone):
+        """Insert a new active loaner and return its id"""
+        raise NotImplementedError
+
+    def set_loaner_active(self, loaner_id, active):
+        raise NotImplementedError
+
+    def update_loaners(self, changes, expected=None):
+        """Apply cell edits given as {loaner_id: {column: value}}, see update_books"""
+        raise NotImplementedError
+
+    def record_loan(self, loaner_id, book_id, loan_date):
+        """Record a new loan (loan_date is a date or Timestamp), raising StaleWriteError if the book is already loaned"""
+        raise NotImplementedError
+
+    def record_return(self, loaner_id, book_id, loan_date, return_date):
+        """Close an open loan (dates are dates or Timestamps), raising StaleWriteError if it is not open"""
+        raise NotImplementedError
+
+    def compact_loans(self):
+        """Fold any pending loan events into the main loans store"""
+
+    def clear_cache(self):
+        """Forget all cached frames"""
+
+    def cached_frames(self):
+        """Return the cached frames by cache key (for the memory report)"""
+        with self._lock:
+            return {str(key): cached[1] for key, cached in self._cache.items()}
+
+
+def _sorted_categories(series, extra=()):
+    """Return a categorical series whose categories are sorted (so sorting by it sorts by text) and include ''"""
+    if not isinstance(series.dtype, pd.CategoricalDtype):
+        series = series.astype('category')
+    categories = sorted(set(series.cat.categories) | {''} | set(extra))
+    if list(series.cat.categories) != categories:
+        series = series.cat.set_categories(categories)
+    return series
+
+def compact_frame(table, df):
+    """Return df with the compact FRAME_DTYPES of its table, missing text becoming ''"""
+    df = df.copy()
+    for column, dtype in FRAME_DTYPES[table].items():
+        if column not in df.columns:
+            continue
+        if dtype == 'category':
+            df[column] = _sorted_categories(df[column]).fillna('')
+        elif dtype.startswith('string'):
+            df[column] = df[column].fillna('').astype(dtype)
+        else:
+            df[column] = df[column].astype(dtype)
+    return df
+
+def _file_stamp(path):
+    """Return the (mtime, size) stamp used to detect changes to a data file"""
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+def _read_books(path):
+    """Parse the books CSV"""
+    books_df = pd.read_csv(path, dtype={'active': bool,'id': int,'name': str,'author': str,'category': str})
+    return compact_frame('books', books_df)
+
+def _read_loaners(path):
+    """Parse the loaners CSV"""
+    loaners_df = pd.read_csv(path, dtype={'phone': str,'active': bool,'id': int,'name': str,'surname': str})
+    # Add active column if it doesn't exist
+    if 'active' not in loaners_df.columns:
+        loaners_df['active'] = True
+    return compact_frame('loaners', loaners_df)
+
+def _parse_dates(df):
+    """Parse the dd/mm/YYYY loan_date and return_date columns in place"""
+    df['loan_date'] = pd.to_datetime(df['loan_date'], format=DATE_FORMAT)
+    df['return_date'] = pd.to_datetime(df['return_date'], format=DATE_FORMAT)
+    return df
+
+def _empty_loans():
+    """Return a loans frame without rows, with the dtypes of a loaded one (so .dt and comparisons still work)"""
+    empty_df = pd.DataFrame({column: pd.Series(dtype='datetime64[ns]' if column.endswith('_date') else 'int64')
+                             for column in LOAN_COLUMNS})
+    return compact_frame('loans', empty_df)
+
+def _read_loans(path):
+    """Parse the loans log CSV"""
+    return compact_frame('loans', _parse_dates(pd.read_csv(path, dtype={'loan_date': str, 'return_date': str})))
+
+def _read_loan_events(path):
+    """Parse the loan event log CSV"""
+    return compact_frame('loans', _parse_dates(pd.read_csv(path, dtype={'event': str, 'loan_date': str, 'return_date': str})))
+
+def _format_date(value):
+    """Format a date for the CSV files"""
+    return pd.Timestamp(value).strftime(DATE_FORMAT)
+
+def _apply_loan_events(loans_df, events_df):
+    """Replay checkout and return events on top of a loans snapshot"""
+    new_loans = events_df.loc[events_df['event'] == 'loan', LOAN_COLUMNS]
+    loans_df = pd.concat([loans_df, new_loans], ignore_index=True)
+    returns = events_df[events_df['event'] == 'return']
+    if returns.empty:
+        return loans_df
+    # Only open loans can be returned, so index them by (loaner, book, loan date) once
+    open_loans = loans_df[loans_df['return_date'].isna()]
+    open_index = {}
+    for idx, key in zip(open_loans.index, zip(open_loans['loaner_id'], open_loans['book_id'], open_loans['loan_date'])):
+        open_index.setdefault(key, []).append(idx)
+    for loaner_id, book_id, loan_date, return_date in zip(returns['loaner_id'], returns['book_id'], returns['loan_date'], returns['return_date']):
+        for idx in open_index.pop((loaner_id, book_id, loan_date), []):
+            loans_df.at[idx, 'return_date'] = return_date
+    return loans_df
+
+def _read_patches(path):
+    """Parse the catalog patch log CSV"""
+    return pd.read_csv(path, dtype=str, keep_default_na=False)
+
+def _patch_value(column, value):
+    """Format an edited cell for the patch log"""
+    if column == 'active':
+        return str(bool(value))
+    return '' if value is None else str(value)
+
+def _conflicts(current, expected, editable_columns):
+    """Return the ids whose current editable cells differ from the values an edit was based on"""
+    return [row_id for row_id, values in expected.items()
+            if row_id not in current or any(_patch_value(column, current[row_id][column]) != _patch_value(column, value)
+                                            for column, value in values.items() if column in editable_columns)]
+
+def _check_version(table, current_version, expected_version):
+    """Reject a full rewrite of a table that changed since the caller read it"""
+    if expected_version is not None and current_version != expected_version:
+        raise StaleWriteError(f"{table} changed since it was read")
+
+def match_file_mode(temp_path, path):
+    """Give a temporary file (mkstemp makes them 0600) the mode of the file it replaces
+
+    A new file gets the read and write bits of its directory, 0644 in a 0755 directory.
+    """
+    if os.path.exists(path):
+        mode = os.stat(path).st_mode
+    else:
+        mode = os.stat(os.path.dirname(path) or '.').st_mode & 0o666
+    os.chmod(temp_path, mode)
+
+def _replace_file(path, write, binary=False):
+    """Call write(f) on a temporary file next to path and atomically move it into place"""
+    directory = os.path.dirname(path) or '.'
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f'.{os.path.basename(path)}.', suffix='.tmp')
+    try:
+        with (os.fdopen(fd, 'wb') if binary else os.fdopen(fd, 'w', newline='', encoding='utf-8')) as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        match_file_mode(temp_path, path)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def _replace_csv(path, df, **kwargs):
+    """Atomically replace the CSV file at path with df"""
+    _replace_file(path, lambda f: df.to_csv(f, index=False, **kwargs))
+
+def _apply_patches(df, patches_df):
+    """Replay cell edits on top of a books or loaners snapshot (later edits win)"""
+    if patches_df.empty:
+        return df
+    df = df.copy()
+    # Edited values that are new to a categorical column become categories first
+    for column, values in patches_df.groupby('column')['value']:
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = _sorted_categories(df[column], values)
+    positions = pd.Index(df['id']).get_indexer(patches_df['id'].astype(int))
+    for position, column, value in zip(positions, patches_df['column'], patches_df['value']):
+        # Edits of rows that no longer exist are ignored
+        if position >= 0:
+            df.iat[position, df.columns.get_loc(column)] = value == 'True' if column == 'active' else value
+    return df
+
+def late_cutoff(days):
+    """Return the date before which an open loan counts as late"""
+    return datetime.today().date() - timedelta(days=days)
+
+
+def _newest_first(loans_df):
+    """Sort loans by start date, newest first, the later recorded first on the same date"""
+    return loans_df.iloc[::-1].sort_values('loan_date', ascending=False, kind='stable')
+
+def _match_loans(loans_df, start=None, end=None, loaner_id=None, book_id=None, status=None):
+    """Return the loans matching the query_loans filters, newest first"""
+    mask = np.ones(len(loans_df), dtype=bool)
+    if start is not None:
+        mask &= (loans_df['loan_date'] >= pd.Timestamp(start)).to_numpy()
+    if end is not None:
+        mask &= (loans_df['loan_date'] <= pd.Timestamp(end)).to_numpy()
+    if loaner_id is not None:
+        mask &= (loans_df['loaner_id'] == loaner_id).to_numpy()
+    if book_id is not None:
+        mask &= (loans_df['book_id'] == book_id).to_numpy()
+    if status is not None:
+        mask &= loans_df['return_date'].isna().to_numpy() == (status == 'active')
+    return _newest_first(loans_df[mask])
+
+def loan_archive_dir(path):
+    """Return the directory of the loan archive kept next to a loans file or database"""
+    return os.path.splitext(path)[0] + '_archive'
+
+def archive_files(directory):
+    """Return the partitions of the loan archive in directory, oldest year first"""
+    return sorted(glob.glob(os.path.join(glob.escape(directory), 'loans_*.csv.gz'))
+                  + glob.glob(os.path.join(glob.escape(directory), 'loans_*.parquet')))
+
+
+class LoanArchive:
+    """Yearly partitions of archived loans, each holding the loans that started in its year
+
+    Partitions are gzip compressed CSV files (or typed Parquet files for the
+    Parquet storage), read-only and only rewritten when more loans of their
+    year are archived.
+    """
+
+    def __init__(self, directory, parquet=False):
+        self.directory = directory
+        self.suffix = '.parquet' if parquet else '.csv.gz'
+
+    def files(self):
+        return archive_files(self.directory)
+
+    def stamp(self):
+        """Return a token that changes whenever a partition is written (empty when there is no archive)"""
+        return tuple((path, _file_stamp(path)) for path in self.files())
+
+    def partition_path(self, year):
+        return os.path.join(self.directory, f'loans_{year}{self.suffix}')
+
+    def partitions(self):
+        """Return [(year, path)] of the partitions, oldest first"""
+        return [(int(os.path.basename(path)[len('loans_'):].split('.')[0]), path) for path in self.files()]
+
+    def read(self, path):
+        return _read_parquet(path, 'loans') if path.endswith('.parquet') else _read_loans(path)
+
+    def _write(self, path, df):
+        if self.suffix == '.parquet':
+            _replace_file(path, lambda f: _write_parquet(f, df, 'loans'), binary=True)
+        else:
+            # No timestamp in the gzip header, so an unchanged partition keeps its bytes (and its backup object)
+            data = df.to_csv(index=False, date_format=DATE_FORMAT).encode('utf-8')
+            _replace_file(path, lambda f: f.write(gzip.compress(data, mtime=0)), binary=True)
+        os.chmod(path, 0o444)
+
+    def load(self):
+        """Return all archived loans, oldest year first"""
+        frames = [self.read(path) for path in self.files()]
+        return pd.concat(frames, ignore_index=True) if frames else _empty_loans()
+
+    def add(self, loans_df):
+        """Merge returned loans into the partitions of their years"""
+        os.makedirs(self.directory, exist_ok=True)
+        for year, year_df in loans_df.groupby(loans_df['loan_date'].dt.year):
+            path = self.partition_path(year)
+            if os.path.exists(path):
+                year_df = pd.concat([self.read(path), year_df], ignore_index=True).drop_duplicates()
+            self._write(path, year_df.sort_values('loan_date', kind='stable')[LOAN_COLUMNS])
+
+    def clear(self):
+        """Remove every partition"""
+        for path in self.files():
+            os.remove(path)
+
+
+class CsvStorage(Storage):
+    """CSV files with parsed frames cached by file mtime and size"""
+
+    def __init__(self, books_path=None, loaners_path=None, loans_path=None, events_path=None, patches_path=None,
+                 events_compact_bytes=LOAN_EVENTS_COMPACT_BYTES, patches_compact_bytes=PATCHES_COMPACT_BYTES):
+        self.books_path = books_path or paths.book_names_path
+        self.loaners_path = loaners_path or paths.book_loaners_path
+        self.loans_path = loans_path or paths.loans_log_path
+        self.events_path = events_path or paths.loans_events_path
+        self.patches_path = patches_path or paths.catalog_patches_path
+        # Sizes past which the event and patch logs are folded into the snapshots
+        self.events_compact_bytes = events_compact_bytes
+        self.patches_compact_bytes = patches_compact_bytes
+        self._write_lock = FileLock(os.path.join(os.path.dirname(self.books_path), 'write.lock'))
+        self.archive = LoanArchive(loan_archive_dir(self.loans_path), parquet=self.loans_path.endswith('.parquet'))
+        # Parsed frames keyed by file path, together with the stamp they were read at
+        self._cache = {}
+        self._lock = threading.Lock()
+        # (loans version, open loans by (loaner, book, loan date), open loans by book), see _open_loans
+        self._open_index = None
+
+    def _read_cached(self, path, reader):
+        """Return the parsed DataFrame for path, re-reading the file only if its mtime or size changed"""
+        stamp = _file_stamp(path)
+        with self._lock:
+            cached = self._cache.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        df = reader(path)
+        with self._lock:
+            self._cache[path] = (stamp, df)
+        return df
+
+    def _update_cache(self, path, df):
+        """Store a freshly written DataFrame in the cache so the next load does not re-read the file"""
+        with self._lock:
+            self._cache[path] = (_file_stamp(path), df.reset_index(drop=True))
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+        self._open_index = None
+
+    def _reader(self, table):
+        """Return the parser of the snapshot file of a table"""
+        return {'books': _read_books, 'loaners': _read_loaners, 'loans': _read_loans}[table]
+
+    def _write_snapshot(self, table, path, df):
+        """Atomically replace the snapshot file of a table"""
+        if table == 'loans':
+            _replace_csv(path, df, date_format=DATE_FORMAT)
+        else:
+            _replace_csv(path, df)
+
+    def data_files(self):
+        return [self.books_path, self.loaners_path, self.loans_path, self.events_path, self.patches_path, *self.archive.files()]
+
+    def _log_stamp(self, path):
+        return _file_stamp(path) if os.path.exists(path) else None
+
+    def data_version(self):
+        return (_file_stamp(self.books_path), _file_stamp(self.loaners_path), _file_stamp(self.loans_path),
+                self._log_stamp(self.events_path), self._log_stamp(self.patches_path))
+
+    def table_version(self, table):
+        if table == 'books':
+            return _file_stamp(self.books_path), self._log_stamp(self.patches_path)
+        if table == 'loaners':
+            return _file_stamp(self.loaners_path), self._log_stamp(self.patches_path)
+        return _file_stamp(self.loans_path), self._log_stamp(self.events_path)
+
+    def _load_with_log(self, key, path, reader, log_path, replay):
+        """Return the snapshot at path with its (small) append-only log replayed on top"""
+        if not os.path.exists(log_path):
+            return self._read_cached(path, reader)
+        with self._lock:
+            cached = self._cache.get(key)
+        if cached is not None and cached[0] == (_file_stamp(path), self._log_stamp(log_path)):
+            return cached[1]
+        # A compaction replaces the snapshot and removes the log, hold the write lock to read a consistent pair
+        with self._write_lock:
+            snapshot_df = self._read_cached(path, reader)
+            if not os.path.exists(log_path):
+                return snapshot_df
+            stamp = (_file_stamp(path), _file_stamp(log_path))
+            df = replay(snapshot_df, log_path)
+        with self._lock:
+            self._cache[key] = (stamp, df)
+        return df
+
+    def _replay_patches(self, table):
+        def replay(snapshot_df, log_path):
+            patches_df = self._read_cached(log_path, _read_patches)
+            return _apply_patches(snapshot_df, patches_df[patches_df['table'] == table])
+        return replay
+
+    def load_books(self):
+        return self._load_with_log('books', self.books_path, self._reader('books'), self.patches_path, self._replay_patches('books'))
+
+    def load_loaners(self):
+        return self._load_with_log('loaners', self.loaners_path, self._reader('loaners'), self.patches_path, self._replay_patches('loaners'))
+
+    def load_loans(self):
+        """Return the current loans: the cached snapshot with the (small) event log replayed on top"""
+        def replay(snapshot_df, log_path):
+            return _apply_loan_events(snapshot_df, self._read_cached(log_path, _read_loan_events))
+        return self._load_with_log('loans', self.loans_path, self._reader('loans'), self.events_path, replay)
+
+    def active_loans(self):
+        loans_df = self.load_loans()
+        return loans_df[loans_df['return_date'].isna()]
+
+    def late_loans(self, days):
+        active_loans = self.active_loans()
+        return active_loans[active_loans['loan_date'] < pd.Timestamp(late_cutoff(days))]
+
+    def _save_catalog(self, books_df=None, loaners_df=None):
+        """Rewrite the books and/or loaners files, folding any pending patches into both first"""
+        with self._write_lock:
+            if os.path.exists(self.patches_path):
+                books_df = self.load_books() if books_df is None else books_df
+                loaners_df = self.load_loaners() if loaners_df is None else loaners_df
+            if books_df is not None:
+                books_df = books_df[BOOK_COLUMNS]
+                self._write_snapshot('books', self.books_path, books_df)
+                self._update_cache(self.books_path, compact_frame('books', books_df))
+            if loaners_df is not None:
+                loaners_df = loaners_df[LOANER_COLUMNS]
+                self._write_snapshot('loaners', self.loaners_path, loaners_df)
+                self._update_cache(self.loaners_path, compact_frame('loaners', loaners_df))
+            if os.path.exists(self.patches_path):
+                os.remove(self.patches_path)
+
+    def save_books(self, df, expected_version=None):
+        with self._write_lock:
+            if expected_version is not None:
+                _check_version('books', self.table_version('books'), expected_version)
+            self._save_catalog(books_df=df)
+
+    def save_loaners(self, df, expected_version=None):
+        with self._write_lock:
+            if expected_version is not None:
+                _check_version('loaners', self.table_version('loaners'), expected_version)
+            self._save_catalog(loaners_df=df)
+
+    def _append_rows(self, path, header, rows):
+        """Append rows to an append-only log, writing the header if the log is new"""
+        write_header = not os.path.exists(path) or os.path.getsize(path) == 0
+        with open(path, 'a', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            if write_header:
+                writer.writerow(header)
+            writer.writerows(rows)
+        return os.path.getsize(path)
+
+    def _update_catalog(self, table, load, editable_columns, changes, expected):
+        """Check the edits against the current rows and append them to the catalog patch log"""
+        with self._write_lock:
+            if expected:
+                df = load()
+                current = df[df['id'].isin([int(row_id) for row_id in expected])].set_index('id').to_dict('index')
+                conflicts = _conflicts(current, {int(row_id): values for row_id, values in expected.items()}, editable_columns)
+                if conflicts:
+                    raise StaleWriteError(f"{table} {conflicts} were changed by another session")
+            rows = [[table, int(row_id), column, _patch_value(column, value)]
+                    for row_id, values in changes.items() for column, value in values.items() if column in editable_columns]
+            if self._append_rows(self.patches_path, PATCH_COLUMNS, rows) > self.patches_compact_bytes:
+                self.compact_catalog()
+
+    def compact_catalog(self):
+        """Fold the catalog patch log into the books and loaners files"""
+        with self._write_lock:
+            if os.path.exists(self.patches_path):
+                self._save_catalog()
+
+    def save_loans(self, df, expected_version=None):
+        """Replace the loans snapshot and clear the event log"""
+        with self._write_lock:
+            if expected_version is not None:
+                _check_version('loans', self.table_version('loans'), expected_version)
+            self._write_snapshot('loans', self.loans_path, df)
+            if os.path.exists(self.events_path):
+                os.remove(self.events_path)
+            self._update_cache(self.loans_path, compact_frame('loans', df))
+
+    def add_book(self, name, author, category):
+        with self._write_lock:
+            books_df = self.load_books()
+            new_id = int(books_df['id'].max()) + 1 if not books_df.empty else 1
+            new_book = pd.DataFrame({'id': [new_id], 'name': [name], 'author': [author], 'category': [category], 'active': [True]})
+            self._save_catalog(books_df=pd.concat([books_df, new_book], ignore_index=True))
+        return new_id
+
+    def set_book_active(self, book_id, active):
+        self.update_books({book_id: {'active': active}})
+
+    def update_books(self, changes, expected=None):
+        self._update_catalog('books', self.load_books, BOOK_EDITABLE_COLUMNS, changes, expected)
+
+    def add_loaner(self, name, surname, phone):
+        with self._write_lock:
+            loaners_df = self.load_loaners()
+            new_id = int(loaners_df['id'].max()) + 1 if not loaners_df.empty else 1
+            new_loaner = pd.DataFrame({'id': [new_id], 'name': [name], 'surname': [surname], 'phone': [phone], 'active': [True]})
+            self._save_catalog(loaners_df=pd.concat([loaners_df, new_loaner], ignore_index=True))
+        return new_id
+
+    def set_loaner_active(self, loaner_id, active):
+        self.update_loaners({loaner_id: {'active': active}})
+
+    def update_loaners(self, changes, expected=None):
+        self._update_catalog('loaners', self.load_loaners, LOANER_EDITABLE_COLUMNS, changes, expected)
+
+    def _open_loans(self):
+        """Return the open loans index, built from the loans only when they changed outside record_loan/record_return
+
+        Called with the write lock held; the writes below keep the index in step with the events they append,
+        so checking a checkout or a return does not replay the loan history.
+        """
+        version = self.table_version('loans')
+        if self._open_index is None or self._open_index[0] != version:
+            active_loans = self.active_loans()
+            keys = zip(active_loans['loaner_id'].tolist(), active_loans['book_id'].tolist(), active_loans['loan_date'].tolist())
+            self._open_index = (version, Counter(keys), Counter(active_loans['book_id'].tolist()))
+        return self._open_index
+
+    def _append_loan_event(self, event, loaner_id, book_id, loan_date, return_date=None):
+        """Append a single event row to the loan event log and update the open loans index"""
+        _, by_key, by_book = self._open_loans()
+        row = [event, int(loaner_id), int(book_id), _format_date(loan_date),
+               _format_date(return_date) if return_date is not None else '']
+        if self._append_rows(self.events_path, LOAN_EVENT_COLUMNS, [row]) > self.events_compact_bytes:
+            self.compact_loans()
+        delta = 1 if event == 'loan' else -1
+        for counter, key in ((by_key, (int(loaner_id), int(book_id), pd.Timestamp(loan_date))), (by_book, int(book_id))):
+            counter[key] += delta
+            if counter[key] <= 0:
+                del counter[key]
+        self._open_index = (self.table_version('loans'), by_key, by_book)
+
+    def record_loan(self, loaner_id, book_id, loan_date):
+        with self._write_lock:
+            if self._open_loans()[2][int(book_id)]:
+                raise StaleWriteError(f"book {book_id} is already loaned")
+            self._append_loan_event('loan', loaner_id, book_id, loan_date)
+
+    def record_return(self, loaner_id, book_id, loan_date, return_date):
+        with self._write_lock:
+            if not self._open_loans()[1][(int(loaner_id), int(book_id), pd.Timestamp(loan_date))]:
+                raise StaleWriteError(f"loan of book {book_id} is not open")
+            self._append_loan_event('return', loaner_id, book_id, loan_date, return_date)
+
+    def compact_loans(self):
+        with self._write_lock:
+            self.save_loans(self.load_loans())
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    author TEXT NOT NULL DEFAULT '',
+    category TEXT NOT NULL DEFAULT '',
+    active INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS loaners (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    surname TEXT NOT NULL DEFAULT '',
+    phone TEXT NOT NULL DEFAULT '',
+    active INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS loans (
+    id INTEGER PRIMARY KEY,
+    loaner_id INTEGER NOT NULL,
+    book_id INTEGER NOT NULL,
+    loan_date TEXT NOT NULL,
+    return_date TEXT
+);
+-- Per-table change counters, bumped by every write and used to invalidate cached frames
+CREATE TABLE IF NOT EXISTS versions (
+    name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO versions (name, version) VALUES ('books', 0), ('loaners', 0), ('loans', 0);
+CREATE INDEX IF NOT EXISTS idx_loans_book_id ON loans (book_id);
+CREATE INDEX IF NOT EXISTS idx_loans_loaner_id ON loans (loaner_id);
+CREATE INDEX IF NOT EXISTS idx_loans_return_date ON loans (return_date);
+CREATE INDEX IF NOT EXISTS idx_loans_loan_date ON loans (loan_date);
+CREATE INDEX IF NOT EXISTS idx_books_name_author ON books (name, author);
+"""
+
+def _to_iso(value):
+    """Convert a date to the ISO text stored in SQLite (so dates sort and compare)"""
+    return pd.Timestamp(value).strftime('%Y-%m-%d')
+
+def _dates_to_iso(series):
+    """Vectorized _to_iso, keeping missing dates as NULL"""
+    return series.dt.strftime('%Y-%m-%d').astype(object).where(series.notna(), None)
+
+def _dates_from_iso(series):
+    """Parse ISO dates read from SQLite"""
+    return pd.to_datetime(series, format='%Y-%m-%d')
+
+
+class SqliteStorage(Storage):
+    """SQLite database with indexes on the columns the tabs filter and join on"""
+
+    def __init__(self, db_path=None):
+        self.db_path = db_path or paths.sqlite_db_path
+        # SQLite serializes its own transactions, the lock lets callers group a write with what they read around it
+        self._write_lock = FileLock(self.db_path + '.lock')
+        self.archive = LoanArchive(loan_archive_dir(self.db_path))
+        self._cache = {}
+        self._lock = threading.Lock()
+        with closing(self._connect()) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SQLITE_SCHEMA)
+
+    def _connect(self):
+        # A short-lived connection per operation, since Streamlit runs each session in its own thread
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def _write(self, table, sql, params=(), check=None):
+        """Run a write statement and bump the table version in the same transaction
+
+        check(conn), if given, runs first inside the transaction (which already holds
+        the database write lock) and may raise StaleWriteError to abort the write.
+        """
+        with closing(self._connect()) as conn, conn:
+            conn.execute('BEGIN IMMEDIATE')
+            if check is not None:
+                check(conn)
+            cursor = conn.execute(sql, params)
+            conn.execute('UPDATE versions SET version = version + 1 WHERE name = ?', (table,))
+            return cursor.lastrowid
+
+    @staticmethod
+    def _table_version(conn, table):
+        return conn.execute('SELECT version FROM versions WHERE name = ?', (table,)).fetchone()[0]
+
+    def _load_table(self, table, query, convert):
+        """Return the cached frame of a table, re-querying only when its version changed"""
+        with closing(self._connect()) as conn:
+            version = self._table_version(conn, table)
+            with self._lock:
+                cached = self._cache.get(table)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+            df = convert(pd.read_sql_query(query, conn))
+        with self._lock:
+            self._cache[table] = (version, df)
+        return df
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+
+    def data_files(self):
+        return [self.db_path, *self.archive.files()]
+
+    def data_version(self):
+        with closing(self._connect()) as conn:
+            return tuple(conn.execute('SELECT name, version FROM versions ORDER BY name').fetchall())
+
+    def table_version(self, table):
+        with closing(self._connect()) as conn:
+            return self._table_version(conn, table)
+
+    def load_books(self):
+        return self._load_table('books', 'SELECT id, name, author, category, active FROM books ORDER BY id',
+                                lambda df: compact_frame('books', df))
+
+    def load_loaners(self):
+        return self._load_table('loaners', 'SELECT id, name, surname, phone, active FROM loaners ORDER BY id',
+                                lambda df: compact_frame('loaners', df))
+
+    def load_loans(self):
+        return self._load_table('loans', 'SELECT loaner_id, book_id, loan_date, return_date FROM loans ORDER BY id', self._convert_loans)
+
+    @staticmethod
+    def _convert_loans(df):
+        df['loan_date'] = _dates_from_iso(df['loan_date'])
+        df['return_date'] = _dates_from_iso(df['return_date'])
+        return compact_frame('loans', df)
+
+    def _query_loans(self, where, params=(), order='id', limit=None):
+        with closing(self._connect()) as conn:
+            df = pd.read_sql_query(f'SELECT loaner_id, book_id, loan_date, return_date FROM loans WHERE {where} '
+                                   f'ORDER BY {order} LIMIT ?', conn, params=(*params, -1 if limit is None else limit))
+        return self._convert_loans(df)
+
+    def _match_current_loans(self, start, end, loaner_id, book_id, status, limit):
+        conditions, params = ['1'], []
+        for condition, value in [('loan_date >= ?', start and start.isoformat()), ('loan_date <= ?', end and end.isoformat()),
+                                 ('loaner_id = ?', loaner_id), ('book_id = ?', book_id)]:
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        if status is not None:
+            conditions.append('return_date IS NULL' if status == 'active' else 'return_date IS NOT NULL')
+        return self._query_loans(' AND '.join(conditions), params, order='loan_date DESC, id DESC', limit=limit)
+
+    def active_loans(self):
+        return self._query_loans('return_date IS NULL')
+
+    def late_loans(self, days):
+        return self._query_loans('return_date IS NULL AND loan_date < ?', (late_cutoff(days).isoformat(),))
+
+    def _replace_table(self, table, columns, rows, expected_version=None):
+        """Replace the full contents of a table"""
+        with closing(self._connect()) as conn, conn:
+            conn.execute('BEGIN IMMEDIATE')
+            _check_version(table, self._table_version(conn, table), expected_version)
+            conn.execute(f'DELETE FROM {table}')
+            conn.executemany(f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})', rows)
+            conn.execute('UPDATE versions SET version = version + 1 WHERE name = ?', (table,))
+
+    def save_books(self, df, expected_version=None):
+        df = df[BOOK_COLUMNS].fillna("")
+        rows = [(int(i), n, a, c, bool(act)) for i, n, a, c, act in df.itertuples(index=False)]
+        self._replace_table('books', BOOK_COLUMNS, rows, expected_version)
+
+    def save_loaners(self, df, expected_version=None):
+        df = df[LOANER_COLUMNS].fillna("")
+        rows = [(int(i), n, s, p, bool(act)) for i, n, s, p, act in df.itertuples(index=False)]
+        self._replace_table('loaners', LOANER_COLUMNS, rows, expected_version)
+
+    def save_loans(self, df, expected_version=None):
+        rows = zip(df['loaner_id'].astype(int).tolist(), df['book_id'].astype(int).tolist(),
+                   _dates_to_iso(df['loan_date']).tolist(), _dates_to_iso(df['return_date']).tolist())
+        self._replace_table('loans', LOAN_COLUMNS, rows, expected_version)
+
+    def add_book(self, name, author, category):
+        return self._write('books', 'INSERT INTO books (name, author, category, active) VALUES (?, ?, ?, 1)', (name, author, category))
+
+    def set_book_active(self, book_id, active):
+        self._write('books', 'UPDATE books SET active = ? WHERE id = ?', (bool(active), int(book_id)))
+
+    def _update_rows(self, table, editable_columns, changes, expected=None):
+        """Update only the edited cells of a table in a single transaction"""
+        with closing(self._connect()) as conn, conn:
+            conn.execute('BEGIN IMMEDIATE')
+            if expected:
+                ids = [int(row_id) for row_id in expected]
+                rows = conn.execute(f'SELECT id, {", ".join(editable_columns)} FROM {table} WHERE id IN ({", ".join("?" * len(ids))})', ids)
+                current = {row[0]: dict(zip(editable_columns, row[1:])) for row in rows}
+                conflicts = _conflicts(current, {int(row_id): values for row_id, values in expected.items()}, editable_columns)
+                if conflicts:
+                    raise StaleWriteError(f"{table} {conflicts} were changed by another session")
+            for row_id, values in changes.items():
+                columns = [column for column in values if column in editable_columns]
+                if not columns:
+                    continue
+                params = [bool(values[c]) if c == 'active' else ('' if values[c] is None else str(values[c])) for c in columns]
+                conn.execute(f'UPDATE {table} SET {", ".join(f"{c} = ?" for c in columns)} WHERE id = ?', params + [int(row_id)])
+            conn.execute('UPDATE versions SET version = version + 1 WHERE name = ?', (table,))
+
+    def update_books(self, changes, expected=None):
+        self._update_rows('books', BOOK_EDITABLE_COLUMNS, changes, expected)
+
+    def add_loaner(self, name, surname, phone):
+        return self._write('loaners', 'INSERT INTO loaners (name, surname, phone, active) VALUES (?, ?, ?, 1)', (name, surname, phone))
+
+    def set_loaner_active(self, loaner_id, active):
+        self._write('loaners', 'UPDATE loaners SET active = ? WHERE id = ?', (bool(active), int(loaner_id)))
+
+    def update_loaners(self, changes, expected=None):
+        self._update_rows('loaners', LOANER_EDITABLE_COLUMNS, changes, expected)
+
+    def record_loan(self, loaner_id, book_id, loan_date):
+        def check(conn):
+            if conn.execute('SELECT 1 FROM loans WHERE book_id = ? AND return_date IS NULL', (int(book_id),)).fetchone():
+                raise StaleWriteError(f"book {book_id} is already loaned")
+        self._write('loans', 'INSERT INTO loans (loaner_id, book_id, loan_date) VALUES (?, ?, ?)',
+                    (int(loaner_id), int(book_id), _to_iso(loan_date)), check)
+
+    def record_return(self, loaner_id, book_id, loan_date, return_date):
+        def check(conn):
+            if not conn.execute('SELECT 1 FROM loans WHERE loaner_id = ? AND book_id = ? AND loan_date = ? AND return_date IS NULL',
+                                (int(loaner_id), int(book_id), _to_iso(loan_date))).fetchone():
+                raise StaleWriteError(f"loan of book {book_id} is not open")
+        self._write('loans', 'UPDATE loans SET return_date = ? WHERE loaner_id = ? AND book_id = ? AND loan_date = ? AND return_date IS NULL',
+                    (_to_iso(return_date), int(loaner_id), int(book_id), _to_iso(loan_date)), check)
+
+
+# Files of a Parquet storage: the typed snapshots and the append-only CSV logs
+PARQUET_FILES = ['book_names.parquet', 'book_loaners.parquet', 'loans_log.parquet', 'loans_events.csv', 'catalog_patches.csv']
+
+def parquet_files(directory):
+    """Return the paths of the files of the Parquet storage in directory"""
+    return [os.path.join(directory, name) for name in PARQUET_FILES]
+
+def _parquet_schema(table):
+    """Return the typed schema of a Parquet snapshot: int32 ids, bool flags, date32 dates, dictionary-encoded repeated text"""
+    import pyarrow as pa
+    repeated = pa.dictionary(pa.int32(), pa.string())
+    if table == 'books':
+        return pa.schema([('id', pa.int32()), ('name', pa.string()), ('author', repeated),
+                          ('category', repeated), ('active', pa.bool_())])
+    if table == 'loaners':
+        return pa.schema([('id', pa.int32()), ('name', pa.string()), ('surname', pa.string()),
+                          ('phone', pa.string()), ('active', pa.bool_())])
+    return pa.schema([('loaner_id', pa.int32()), ('book_id', pa.int32()),
+                      ('loan_date', pa.date32()), ('return_date', pa.date32())])
+
+def _read_parquet(path, table):
+    """Read a Parquet snapshot into a frame like the one parsed from the CSV file"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    data = pq.read_table(path)
+    # Dates as datetime64[ns] like the parsed CSV dates, the ids, text and dictionaries map to the compact dtypes as is
+    data = data.cast(pa.schema([(field.name, pa.timestamp('ns') if pa.types.is_date(field.type) else field.type)
+                                for field in data.schema]))
+    return compact_frame(table, data.to_pandas(types_mapper={pa.string(): pd.StringDtype('pyarrow')}.get))
+
+def _write_parquet(f, df, table):
+    """Write a frame to f as a typed, compressed Parquet snapshot"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = _parquet_schema(table)
+    data = pa.Table.from_pandas(df[schema.names], schema=schema, preserve_index=False)
+    # Without the pandas metadata the snapshot reads back by its Arrow types
+    pq.write_table(data.replace_schema_metadata(None), f, compression='zstd')
+
+
+class ParquetStorage(CsvStorage):
+    """Typed Parquet snapshots, loaded without parsing, and the append-only CSV logs of CsvStorage"""
+
+    def __init__(self, directory=None, events_compact_bytes=LOAN_EVENTS_COMPACT_BYTES,
+                 patches_compact_bytes=PATCHES_COMPACT_BYTES):
+        directory = directory or paths.parquet_dir_path
+        os.makedirs(directory, exist_ok=True)
+        super().__init__(*parquet_files(directory), events_compact_bytes=events_compact_bytes,
+                         patches_compact_bytes=patches_compact_bytes)
+
+    def _reader(self, table):
+        return lambda path: _read_parquet(path, table)
+
+    def _write_snapshot(self, table, path, df):
+        _replace_file(path, lambda f: _write_parquet(f, df, table), binary=True)
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+def get_storage():
+    """Return the process-wide storage backend selected in paths.py"""
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            if paths.storage_backend == 'sqlite':
+                _storage = SqliteStorage()
+            elif paths.storage_backend == 'csv':
+                _storage = CsvStorage()
+            elif paths.storage_backend == 'parquet':
+                _storage = ParquetStorage()
+            else:
+                raise ValueError(f"Unknown storage backend: {paths.storage_backend}")
+        return _storage
@@ -0,0 +1,170 @@
+"""
+Denormalized loan views shared by all tabs.
+
+Each view is the loans ⋈ books ⋈ loaners join, built once per data version
+(and per day, since loan durations depend on today's date) and reused by every
+tab in the rerun. The returned frames are shared, callers must not modify them.
+The option labels and id sets of the forms are cached the same way.
+"""
+
+import threading
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from methods.storage import get_storage
+from methods.profiling import profiled
+
+# A loan that is open for more than this many days is late
+LATE_DAYS = 30
+
+_view_cache = {}
+_view_lock = threading.Lock()
+
+@profiled
+def _join_loans(loans_df, books_df, loaners_df):
+    """Join loans with their book and loaner and add loan_duration, is_active and is_late"""
+    view = loans_df.merge(books_df, left_on='book_id', right_on='id', how='left', suffixes=('_loan', '_book'))
+    view = view.merge(loaners_df, left_on='loaner_id', right_on='id', how='left', suffixes=('_book', '_loaner'))
+    today = pd.Timestamp(date.today())
+    view['is_active'] = view['return_date'].isna()
+    # Open loans count up to today, returned loans up to their return date
+    view['loan_duration'] = (view['return_date'].fillna(today) - view['loan_date']).dt.days
+    view['is_late'] = view['is_active'] & (view['loan_duration'] > LATE_DAYS)
+    return view
+
+def _cached_view(name, build):
+    """Return the named view, rebuilding it only when the stored data (or the date) changed"""
+    key = (get_storage().data_version(), date.today())
+    with _view_lock:
+        cached = _view_cache.get(name)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    view = build()
+    with _view_lock:
+        _view_cache[name] = (key, view)
+    return view
+
+def cached_views():
+    """Return the cached views (frames, and the label maps and id sets of the forms) by name, for the memory report"""
+    with _view_lock:
+        return {name: cached[1] for name, cached in _view_cache.items()}
+
+@profiled
+def loans_view():
+    """Return every loan joined with its book and loaner"""
+    storage = get_storage()
+    return _cached_view('loans', lambda: _join_loans(storage.load_loan_history(), storage.load_books(), storage.load_loaners()))
+
+@profiled
+def join_loans(loans_df):
+    """Return a slice of the loans (e.g. a page of Storage.query_loans) joined with their book and loaner"""
+    storage = get_storage()
+    return _join_loans(loans_df, storage.load_books(), storage.load_loaners())
+
+@profiled
+def active_loans_view():
+    """Return the open loans joined with their book and loaner"""
+    storage = get_storage()
+    return _cached_view('active_loans', lambda: _join_loans(storage.active_loans(), storage.load_books(), storage.load_loaners()))
+
+def late_loans_view():
+    """Return the open loans that are more than LATE_DAYS days old"""
+    active_loans = active_loans_view()
+    return active_loans[active_loans['is_late']]
+
+def text(series):
+    """Return a text column as plain strings with '' for missing values (categorical columns cannot be concatenated)"""
+    return series.astype(object).fillna('')
+
+def _distinct_labels(keys, labels, suffixes):
+    """Return {key: label}, the labels shared by several keys followed by their suffix so each option can be told apart"""
+    labels = pd.Series(labels.to_numpy(dtype=object))
+    duplicated = labels.duplicated(keep=False).to_numpy()
+    labels[duplicated] = labels[duplicated] + pd.Series(suffixes.to_numpy(dtype=object))[duplicated]
+    return dict(zip(keys, labels))
+
+# The forms offer ids and show these labels through format_func, so a submitted
+# choice is one dict lookup away from its record, even with duplicate titles
+
+def book_labels():
+    """Return {book id: 'name - author'} of every book, copies of a title followed by their id"""
+    def build():
+        books_df = get_storage().load_books()
+        labels = text(books_df['name']) + ' - ' + text(books_df['author'])
+        return _distinct_labels(books_df['id'].tolist(), labels, ' #' + books_df['id'].astype(str))
+    return _cached_view('book_labels', build)
+
+def loaner_labels():
+    """Return {loaner id: 'name surname'} of every loaner, namesakes followed by their id"""
+    def build():
+        loaners_df = get_storage().load_loaners()
+        labels = text(loaners_df['name']) + ' ' + text(loaners_df['surname'])
+        return _distinct_labels(loaners_df['id'].tolist(), labels, ' #' + loaners_df['id'].astype(str))
+    return _cached_view('loaner_labels', build)
+
+def active_loan_labels():
+    """Return {(loaner id, book id, loan date): 'book - loaner'} of the open loans, in the order of active_loans_view"""
+    def build():
+        active_loans = active_loans_view()
+        keys = zip(active_loans['loaner_id'].tolist(), active_loans['book_id'].tolist(), active_loans['loan_date'].tolist())
+        labels = text(active_loans['name_book']) + ' - ' + text(active_loans['name_loaner']) + ' ' + text(active_loans['surname'])
+        return _distinct_labels(list(keys), labels, ' (' + active_loans['loan_date'].dt.strftime('%d/%m/%Y') + ')')
+    return _cached_view('active_loan_labels', build)
+
+def loaned_book_ids():
+    """Return the ids of the books that are loaned out"""
+    return _cached_view('loaned_book_ids', lambda: frozenset(active_loans_view()['book_id'].tolist()))
+
+def borrowing_loaner_ids():
+    """Return the ids of the loaners that have an open loan"""
+    return _cached_view('borrowing_loaner_ids', lambda: frozenset(active_loans_view()['loaner_id'].tolist()))
+
+@profiled
+def book_status(books_df):
+    """Return the availability status of each book, aligned with books_df"""
+    active_loans = active_loans_view()
+    # One row per borrowed book, the longest running loan wins if a book is somehow loaned twice
+    loans = active_loans.sort_values('loan_duration', ascending=False).drop_duplicates('book_id').set_index('book_id')
+    borrower = text(loans['name_loaner']) + ' ' + text(loans['surname'])
+    duration = loans['loan_duration'].astype(str)
+    status = pd.Series(np.where(
+        loans['is_late'],
+        'באיחור - ' + borrower + ' - ' + duration + ' ימים⚠️',
+        'מושאל - ' + borrower + ' - ' + duration + ' ימים📚',
+    ), index=loans.index)
+    return books_df['id'].map(status).fillna('✅ זמין')
+
+@profiled
+def loaner_status(loaners_df):
+    """Return the loan status of each loaner, aligned with loaners_df"""
+    active_loans = active_loans_view()
+    loans = active_loans.groupby('loaner_id').agg(
+        count=('book_id', 'size'),
+        duration=('loan_duration', 'max'),
+        late=('is_late', 'any'),
+    )
+    count = loans['count'].astype(str)
+    duration = loans['duration'].astype(str)
+    multiple = loans['count'] > 1
+    status = pd.Series(np.select(
+        [multiple & loans['late'], multiple, loans['late']],
+        [
+            'באיחור - ' + count + ' השאלות - ' + duration + ' ימים⚠️',
+            count + ' השאלות פעילות - ' + duration + ' ימים📚',
+            'באיחור - ' + duration + ' ימים⚠️',
+        ],
+        default='השאלה פעילה - ' + duration + ' ימים📚',
+    ), index=loans.index)
+    return loaners_df['id'].map(status).fillna('✅ אין השאלות פעילות')
+
+def paginate(df, page, page_size, sort_by=None, ascending=True):
+    """Return the rows of the given 1-based page of df, optionally sorted by a column first"""
+    if sort_by is not None:
+        df = df.sort_values(sort_by, ascending=ascending, kind='stable')
+    start = (page - 1) * page_size
+    page = df.iloc[start:start + page_size]
+    # Pages go to widgets, which need plain text (a data editor would turn categoricals into dropdowns)
+    categorical = [column for column in page.columns if isinstance(page[column].dtype, pd.CategoricalDtype)]
+    return page.astype({column: object for column in categorical}) if categorical else page
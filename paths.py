@@ -1,15 +1,40 @@
+import os
 
+# Storage backend: 'csv', 'sqlite' or 'parquet' (can be overridden with the SIMPLIB_STORAGE environment variable)
+storage_backend = os.environ.get('SIMPLIB_STORAGE', 'csv')
 
-# Demo paths (currently used)
-book_names_path = 'data/demo/book_names.csv'
-book_loaners_path = 'data/demo/book_loaners.csv'
-loans_log_path = 'data/demo/loans_log.csv'
-backup_path = 'data/demo/backup'
+# Demo paths (currently used), in a directory that can be overridden with the
+# SIMPLIB_DATA_DIR environment variable (e.g. for data made by benchmarks.generate_data)
+data_dir = os.environ.get('SIMPLIB_DATA_DIR', 'data/demo')
+book_names_path = os.path.join(data_dir, 'book_names.csv')
+book_loaners_path = os.path.join(data_dir, 'book_loaners.csv')
+loans_log_path = os.path.join(data_dir, 'loans_log.csv')
+loans_events_path = os.path.join(data_dir, 'loans_events.csv')
+catalog_patches_path = os.path.join(data_dir, 'catalog_patches.csv')
+sqlite_db_path = os.path.join(data_dir, 'library.db')
+parquet_dir_path = os.path.join(data_dir, 'parquet')
+aggregates_path = os.path.join(data_dir, 'aggregates.json')
+backup_path = os.path.join(data_dir, 'backup')
 
 # Production paths (for future use)
 prod_book_names_path = 'data/prod/book_names.csv'
 prod_book_loaners_path = 'data/prod/book_loaners.csv'
 prod_loans_log_path = 'data/prod/loans_log.csv'
+prod_loans_events_path = 'data/prod/loans_events.csv'
+prod_catalog_patches_path = 'data/prod/catalog_patches.csv'
+prod_sqlite_db_path = 'data/prod/library.db'
+prod_parquet_dir_path = 'data/prod/parquet'
+prod_aggregates_path = 'data/prod/aggregates.json'
+
+# Loans returned more than this many days ago are moved to the yearly loan archive by python -m methods.archive
+loan_archive_days = 365
 
 # Backup directory
 backup_dir_path = 'backups'
+
+# Directory of the cached exports (regenerated from the data, safe to delete)
+export_dir_path = 'exports'
+
+# Profiling output: one JSON line per profiled rerun, and the cProfile dumps (safe to delete)
+profile_dir_path = 'profiling'
+profile_log_path = 'profiling/reruns.jsonl'
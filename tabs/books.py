@@ -1,12 +1,16 @@
 import streamlit as st
-import pandas as pd
-from datetime import datetime
-from methods.utils import calculate_metrics, save_books
-import io
+from methods.operations import update_books, add_or_restore_book, remove_book, validate_book_changes
+from tabs.widgets import render_pagination, editor_changes, render_export, render_search_picker
+from methods.metrics import get_metrics
+from methods.views import book_labels, book_status, paginate
+from methods.search import search_books
+from methods.storage import BOOK_EDITABLE_COLUMNS, StaleWriteError
+from methods.profiling import profiled
 
-def render_books_tab(books_df, loaners_df, loans_df):
+@profiled
+def render_books_tab(books_df):
     """Render the books tab content"""
-    metrics = calculate_metrics(books_df, loaners_df, loans_df)
+    metrics = get_metrics()
     col1, col2, col3, col4, col5 = st.columns([2, 1, 1, 1, 1])
     with col1:
         st.title("📚 ספרים")
@@ -19,53 +23,45 @@ def render_books_tab(books_df, loaners_df, loans_df):
     with col5:
         st.metric("⚠️ ספרים באיחור", metrics['late_books'])
     
-    render_books_search_and_table(books_df, loaners_df, loans_df)
+    render_books_search_and_table(books_df)
     
     st.markdown("---")
     col1, col2 = st.columns([1, 1])
     with col1:
-        render_add_book_form(books_df)
+        render_add_book_form()
     with col2:
-        render_remove_book_form(books_df, loans_df)
+        render_remove_book_form()
 
-def render_books_search_and_table(books_df, loaners_df, loans_df):
+@profiled
+def render_books_search_and_table(books_df):
     """Render the books search and table section"""
     # Search and filter
     col1, col2, col3 = st.columns([1, 1, 1])
-    books_df = books_df.copy()
     books_df  = books_df.query('active == True')#.drop(columns=['active'])
     with col1:
-        search_term = st.selectbox("חיפוש ספרים לפי שם או מחבר", 
-                                 options=[''] + sorted(books_df['name'].unique().tolist() + books_df['author'].unique().tolist()),
-                                 placeholder='בחר/י ספר או מחבר')
+        search_term = st.text_input("חיפוש ספרים לפי שם או מחבר",
+                                    placeholder='הקלד/י שם ספר או מחבר')
+    with col2:
+        category = st.selectbox("קטגוריה", [''] + sorted(books_df['category'].unique().tolist()),
+                                format_func=lambda x: x or 'כל הקטגוריות')
     
-    # Calculate book status
-    active_loans = loans_df[loans_df['return_date'].isna()].copy()
-    active_loans.loc[:, 'loan_duration'] = (datetime.today() - pd.to_datetime(active_loans['loan_date'], format='%d/%m/%Y')).dt.days
-    active_loans = active_loans.merge(loaners_df[['id', 'name', 'surname']], left_on='loaner_id', right_on='id', how='left')
-
-    # Create status mapping
-    book_status = {}
-    for _, loan in active_loans.iterrows():
-        if loan['loan_duration'] > 30:
-            book_status[loan['book_id']] = f"באיחור - {loan['name']} {loan['surname']} - {loan['loan_duration']} ימים⚠️"
-        else:
-            book_status[loan['book_id']] = f"מושאל - {loan['name']} {loan['surname']} - {loan['loan_duration']} ימים📚"
-
-    # Add status to books_df
-    books_df.loc[:, 'status'] = books_df['id'].apply(lambda x: book_status.get(x, '✅ זמין'))
     # Filter books based on search and category
     filtered_books = books_df#.query('active == True').drop(columns=['active'])
     if search_term:
-        filtered_books = filtered_books[
-            filtered_books['name'].str.contains(search_term, case=False) |
-            filtered_books['author'].str.contains(search_term, case=False)
-        ]
+        filtered_books = filtered_books[filtered_books['id'].isin(search_books(search_term, limit=None))]
+    if category:
+        filtered_books = filtered_books[filtered_books['category'] == category]
+    
+    # Only the visible page is sent to the editor, indexed by book id so edits map back to the right rows
+    page, page_size, sort_by, ascending = render_pagination(
+        "books", len(filtered_books), {'name': 'שם הספר', 'author': 'מחבר', 'category': 'קטגוריה', 'id': 'סדר הוספה'})
+    page_books = paginate(filtered_books, page, page_size, sort_by, ascending).set_index('id')
+    page_books['status'] = book_status(page_books.reset_index()).values
     
     # Configure columns for books table
     books_columns = {
         'category': st.column_config.TextColumn('🏷️ קטגוריה', width='medium'),
-        'status': st.column_config.TextColumn('📊 זמינות', width='medium'),
+        'status': st.column_config.TextColumn('📊 זמינות', width='medium', disabled=True),
         'author': st.column_config.TextColumn('✍️ מחבר', width='medium'),
         'name': st.column_config.TextColumn('📖 שם הספר', width='large'),
         # 'id': st.column_config.NumberColumn('🔢 מזהה', width='small'),
@@ -75,43 +71,42 @@ def render_books_search_and_table(books_df, loaners_df, loans_df):
     # Display books with reversed columns
     if edit_mode:
         st.markdown("*💡 נא ללחוץ ENTER לשמירת השינויים*")
-        edited_books = st.data_editor(
-            filtered_books[list(books_columns.keys())],
+        editor_key = f"books_editor_{page}_{page_size}_{sort_by}_{ascending}"
+        st.data_editor(
+            page_books[list(books_columns.keys())],
             column_config=books_columns,
             hide_index=True,
             use_container_width=True,
             num_rows="fixed",
-            key="books_editor"
+            key=editor_key
         )
         if st.button("שמור שינויים"):
-            books_df.loc[filtered_books.index,list(books_columns.keys())] = edited_books
-            save_books(books_df)
-            st.success("שינויים נשמרו בהצלחה!")
-            st.rerun()
+            # Only the edited cells are validated and written
+            changes, expected = editor_changes(editor_key, page_books, BOOK_EDITABLE_COLUMNS)
+            errors = validate_book_changes(changes, page_books)
+            for error in errors:
+                st.error(error)
+            if not errors and changes:
+                try:
+                    update_books(changes, expected)
+                except StaleWriteError:
+                    st.error("ספרים אלה שונו בינתיים על ידי משתמש אחר, נא לרענן את הדף ולנסות שוב")
+                else:
+                    st.success("שינויים נשמרו בהצלחה!")
+                    st.rerun()
+            elif not errors:
+                st.info("לא בוצעו שינויים")
     else:
         st.dataframe(
-            filtered_books[filtered_books.columns[::-1]],
+            page_books[page_books.columns[::-1]],
             column_config=books_columns,
             hide_index=True,
             use_container_width=True,
         )
-    # Add header row every 44 rows
-    # Create Excel file in memory
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        filtered_books[["name","author"]].to_excel(writer, sheet_name='Books', index=False)
-    
-    # Get the Excel file data
-    excel_data = output.getvalue()
-
-    st.download_button(
-        label="הורד ספרים",
-        data=excel_data,
-        file_name="books.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-    )
+    render_export("books", "הורד ספרים", lambda: filtered_books[["name", "author"]], filters=(search_term, category))
 
-def render_add_book_form(books_df):
+@profiled
+def render_add_book_form():
     """Render the add book form"""
     st.subheader("➕ הוספת ספר חדש")
     with st.form("new_book_form"):
@@ -123,60 +118,29 @@ def render_add_book_form(books_df):
         
         if submitted:
             if new_book_name and new_book_author:
-                # Check for duplicates
-                bool_book = (books_df['author'].str.lower() == new_book_author.lower()) & (books_df['name'].str.lower() == new_book_name.lower())
-                is_duplicate = books_df[bool_book].shape[0] > 0
-                
-                if is_duplicate:
-                    if books_df[bool_book]["active"].iloc[0] == False:
-                        books_df.loc[bool_book, "active"] = True
-                        st.success("ספר זה הוסף מחדש")
-                        save_books(books_df)
-                        st.rerun()
-                    else:
-                        st.error("ספר זה כבר קיים במערכת")
+                # A removed book of the same name and author is reactivated, otherwise the storage generates the new ID
+                _, outcome = add_or_restore_book(new_book_name, new_book_author, new_book_category)
+                if outcome == 'exists':
+                    st.error("ספר זה כבר קיים במערכת")
                 else:
-                    # Generate new ID
-                    new_id = books_df['id'].max() + 1 if not books_df.empty else 1
-                    
-                    # Create new book entry
-                    new_book = pd.DataFrame({
-                        'id': [new_id],
-                        'name': [new_book_name],
-                        'author': [new_book_author],
-                        'category': [new_book_category],
-                        'active': [True]
-                    })
-                    
-                    # Add to database
-                    books_df = pd.concat([books_df, new_book], ignore_index=True)
-                    save_books(books_df)
-                    st.success("הספר נוסף בהצלחה!")
+                    st.success("ספר זה הוסף מחדש" if outcome == 'restored' else "הספר נוסף בהצלחה!")
                     st.rerun()
             else:
                 st.error("יש למלא שם הספר ומחבר")
 
-def render_remove_book_form(books_df, loans_df):
+@profiled
+def render_remove_book_form():
     """Render the remove book form"""
     st.subheader("🗑️ הסרת ספר")
     with st.container(border=True):
-        book_to_remove = st.selectbox("בחר ספר להסרה", 
-                                    options=[''] + sorted(books_df[books_df['active']]['name'] + ' - ' + books_df[books_df['active']]['author']),
-                                    key='book_remove',
-                                    placeholder='בחר/י ספר להסרה')
+        # Only the active books matching the search are offered
+        book_id = render_search_picker("בחר ספר להסרה", search_books, book_labels(), 'book_remove')
         if st.button("הסר ספר", key='remove_book_btn'):
-            if book_to_remove:
-                # Find the book to remove
-                book_name, author = book_to_remove.split(' - ')
-                book_id = books_df[(books_df['name'] == book_name) & (books_df['author'] == author)]['id'].iloc[0]
-                
-                # Check if book is currently loaned
-                if book_id in loans_df[loans_df['return_date'].isna()]['book_id'].values:
+            if book_id is not None:
+                # The book is set inactive instead of deleted, and not while it is loaned
+                if not remove_book(book_id):
                     st.error("לא ניתן להסיר ספר שנמצא בהשאלה!")
                 else:
-                    # Set book as inactive instead of deleting
-                    books_df.loc[books_df['id'] == book_id, 'active'] = False
-                    save_books(books_df)
                     st.success("הספר הוסר בהצלחה!")
                     st.rerun()
             else:
@@ -1,45 +1,82 @@
 import streamlit as st
-import pandas as pd
-from datetime import datetime
+from datetime import timedelta
+from functools import partial
 
-from tabs.stats import render_stats_calculations
+from methods.views import LATE_DAYS, book_labels, join_loans, loaner_labels
+from methods.storage import get_storage, late_cutoff
+from methods.search import search_books, search_loaners
+from tabs.widgets import render_export, render_search_picker
+from methods.profiling import profiled
 
-def render_history_table(stats_df):
+# Loans fetched per page, each "load more" fetches one page more
+HISTORY_PAGE_ROWS = 100
 
+STATUSES = {None: "הכל", 'active': "פעילות", 'late': "באיחור", 'returned': "הוחזרו"}
+
+def _reset_pages():
+    st.session_state['history_pages'] = 1
+
+def _load_more():
+    st.session_state['history_pages'] = st.session_state.get('history_pages', 1) + 1
+
+def query_history(start, end, loaner_id, book_id, status, limit):
+    """Return (loans, more) of the history filters, see Storage.query_loans; late loans are the open ones older than LATE_DAYS"""
+    if status == 'late':
+        cutoff = late_cutoff(LATE_DAYS) - timedelta(days=1)
+        status, end = 'active', cutoff if end is None else min(end, cutoff)
+    return get_storage().query_loans(start, end, loaner_id, book_id, status, limit)
+
+def history_rows(loans_df):
+    """Join loans with their book and loaner for display"""
+    return join_loans(loans_df).fillna({'name_book': '', 'author': '', 'name_loaner': 'משאיל לא פעיל', 'surname': ''})
+
+@profiled
+def render_history_table():
+    """Render the loans history, newest first, fetching only the loans of the pages shown"""
     st.subheader("🗂️ טבלת השאלות")
-    stats_df = stats_df.fillna("")
-    # Add search functionality
-    loaner_options = sorted((stats_df['name_loaner'].fillna('') + ' ' + stats_df['surname'].fillna('')).str.strip())
-    book_options = sorted(stats_df['name_book'].unique().tolist() + stats_df['author'].unique().tolist())
-    col1, col2, col3 = st.columns([1, 1, 1])
+    col1, col2, col3, col4, col5 = st.columns([1, 1, 1, 2, 2])
     with col1:
-        search_term = st.selectbox("🔍 חיפוש לפי שם משאיל או ספר", 
-                                 options=[''] + list(set(loaner_options + book_options)),
-                                 placeholder='בחר/י שם משאיל או ספר')
-    
-    # Filter data based on search term
-    filtered_stats = stats_df.copy()
-    if search_term:
-        filtered_stats = filtered_stats[
-            (stats_df['name_loaner'] + ' ' + stats_df['surname']).str.contains(search_term, case=False) |
-            filtered_stats['name_book'].str.contains(search_term, case=False) |
-            filtered_stats['author'].str.contains(search_term, case=False)
-        ]
-    
+        start = st.date_input("📅 מתאריך", None, format='DD/MM/YYYY', key='history_start', on_change=_reset_pages)
+    with col2:
+        end = st.date_input("📅 עד תאריך", None, format='DD/MM/YYYY', key='history_end', on_change=_reset_pages)
+    with col3:
+        status = st.selectbox("סטטוס", list(STATUSES), format_func=STATUSES.get, key='history_status', on_change=_reset_pages)
+    # The history holds removed loaners and books too, so the pickers search them as well
+    with col4:
+        loaner_id = render_search_picker("👤 משאיל", partial(search_loaners, inactive=True), loaner_labels(), 'history_loaner',
+                                         none_label='כל המשאילים', on_change=_reset_pages)
+    with col5:
+        book_id = render_search_picker("📖 ספר", partial(search_books, inactive=True), book_labels(), 'history_book',
+                                       none_label='כל הספרים', on_change=_reset_pages)
+
+    limit = HISTORY_PAGE_ROWS * st.session_state.setdefault('history_pages', 1)
+    loans_df, more = query_history(start, end, loaner_id, book_id, status, limit)
+    history_df = history_rows(loans_df)
+
     loans_columns = {
         'name_loaner': st.column_config.TextColumn('👤 שם פרטי', width=150),
         'surname': st.column_config.TextColumn('👥 שם משפחה', width=150),
         'name_book': st.column_config.TextColumn('📖 שם הספר', width=250),
         'author': st.column_config.TextColumn('✍️ מחבר', width=150),
-        'loan_date': st.column_config.TextColumn('📅 תאריך השאלה', width=150),
-        'return_date': st.column_config.TextColumn('📅 תאריך החזרה', width=150),
+        'loan_date': st.column_config.DateColumn('📅 תאריך השאלה', width=150, format='DD/MM/YYYY'),
+        'return_date': st.column_config.DateColumn('📅 תאריך החזרה', width=150, format='DD/MM/YYYY'),
         'loan_duration': st.column_config.NumberColumn('⏳ משך השאלה - ימים', width=200)
     }
-    current = (datetime.today() - pd.to_datetime(filtered_stats['loan_date'], format='%d/%m/%Y')).dt.days
-    filtered_stats['loan_duration'] = filtered_stats['loan_duration'].fillna(current)
     st.dataframe(
-        filtered_stats[list(loans_columns.keys())[::-1]],
+        history_df[list(loans_columns.keys())[::-1]],
         column_config=loans_columns,
         hide_index=True,
         use_container_width=True
-    )
\ No newline at end of file
+    )
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        st.caption(f"מוצגות {len(history_df)} ההשאלות האחרונות" if more else f"נמצאו {len(history_df)} השאלות")
+    with col2:
+        if more:
+            st.button("⬇️ טען עוד", key='history_more', on_click=_load_more, use_container_width=True)
+
+    # The export holds every matching loan, not just the shown page
+    export_columns = ['loan_date', 'return_date', 'loan_duration', 'name_loaner', 'surname', 'name_book', 'author']
+    render_export("loans_history", "הורד היסטוריית השאלות",
+                  lambda: history_rows(query_history(start, end, loaner_id, book_id, status, None)[0])[export_columns],
+                  filters=(start, end, status, loaner_id, book_id))
@@ -1,12 +1,18 @@
 import streamlit as st
-import pandas as pd
 from datetime import datetime
 import time
-from methods.utils import calculate_metrics, save_loans
-import time
-def render_loans_tab(books_df, loaners_df, loans_df):
+from methods.operations import record_loan, record_return
+from methods.metrics import get_metrics
+from methods.views import active_loan_labels, active_loans_view, book_labels, late_loans_view, loaned_book_ids, loaner_labels
+from methods.search import search_all, search_books, search_loaners
+from tabs.widgets import search_options
+from methods.storage import StaleWriteError
+from methods.profiling import profiled
+
+@profiled
+def render_loans_tab():
     """Render the loans tab content"""
-    metrics = calculate_metrics(books_df, loaners_df, loans_df)
+    metrics = get_metrics()
     col1, col2, col3 = st.columns([2, 1, 1])
     with col1:
         st.title("📖 השאלות")
@@ -20,127 +26,114 @@ def render_loans_tab(books_df, loaners_df, loans_df):
     
     # New Loan section
     with col1:
-        render_new_loan_form(books_df, loaners_df, loans_df)
+        render_new_loan_form()
     
     # Return Book section
     with col2:
-        render_return_book_form(books_df, loaners_df, loans_df)
+        render_return_book_form()
     
     st.markdown("---")
-    render_active_loans(books_df, loaners_df, loans_df)
+    render_active_loans()
     
     st.markdown("---")
-    render_late_loans(books_df, loaners_df, loans_df)
+    render_late_loans()
 
-def render_new_loan_form(books_df, loaners_df, loans_df):
+@profiled
+def render_new_loan_form():
     """Render the new loan form"""
     st.subheader("➕ השאלה חדשה")
     
-    # Get available books (not currently loaned)
-    loaned_book_ids = loans_df[loans_df['return_date'].isna()]['book_id'].unique()
-    available_books = books_df[~books_df['id'].isin(loaned_book_ids)]
+    # Options are ids shown through their labels, so the chosen records are found without scanning
+    books = book_labels()
+    loaners = loaner_labels()
+    # The search boxes sit outside the form so typing refreshes the options, which are
+    # the best matches among the active loaners and the active books that are not loaned
+    book_term = st.text_input("🔍 חיפוש ספר", key='new_loan_book_search', placeholder='הקלד/י שם ספר או מחבר')
+    loaner_term = st.text_input("🔍 חיפוש משאיל", key='new_loan_loaner_search', placeholder='הקלד/י שם או שם משפחה')
     
     # Create form
     with st.form("new_loan_form"):
-        selected_book = st.selectbox("בחר ספר", ['']+available_books['name'].tolist())
-        selected_loaner = st.selectbox("בחר משאיל", ['']+list(loaners_df['name'] + ' ' + loaners_df['surname']))
+        book_id = st.selectbox("בחר ספר", search_options(search_books, book_term, exclude=loaned_book_ids()),
+                               format_func=lambda book_id: books.get(book_id, ''))
+        loaner_id = st.selectbox("בחר משאיל", search_options(search_loaners, loaner_term),
+                                 format_func=lambda loaner_id: loaners.get(loaner_id, ''))
         loan_date = st.date_input("תאריך השאלה", datetime.now(), format='DD/MM/YYYY')
         
         submitted = st.form_submit_button("צור השאלה")
         
         if submitted:
-            book_id = available_books[available_books['name'] == selected_book]['id'].iloc[0]
-            loaner_id = loaners_df[loaners_df['name'] + ' ' + loaners_df['surname'] == selected_loaner]['id'].iloc[0]
-            
-            new_loan = pd.DataFrame({
-                'loaner_id': [loaner_id],
-                'book_id': [book_id],
-                'loan_date': [loan_date.strftime('%d/%m/%Y')],
-                'return_date': [None]
-            })
-            
-            loans_df = pd.concat([loans_df, new_loan], ignore_index=True)
-            save_loans(loans_df)
-            st.success("ההשאלה נוצרה בהצלחה!")
-            time.sleep(0.5)
-            st.rerun()
+            if book_id is None or loaner_id is None:
+                st.error("יש לבחור ספר ומשאיל")
+            else:
+                try:
+                    record_loan(loaner_id, book_id, loan_date)
+                except StaleWriteError:
+                    st.error("ספר זה הושאל בינתיים על ידי משתמש אחר")
+                else:
+                    st.success("ההשאלה נוצרה בהצלחה!")
+                    time.sleep(0.5)
+                    st.rerun()
 
-def render_return_book_form(books_df, loaners_df, loans_df):
+@profiled
+def render_return_book_form():
     """Render the return book form"""
     st.subheader("↩️ החזרת ספר")
     
-    # Get active loans
-    active_loans = loans_df[loans_df['return_date'].isna()]
-    active_loans = active_loans.merge(books_df, left_on='book_id', right_on='id', how='left')
-    active_loans = active_loans.merge(loaners_df, left_on='loaner_id', right_on='id', how='left', suffixes=('_book', '_loaner'))
+    # Active loans keyed by (loaner_id, book_id, loan_date), which is what identifies the loan to close
+    loans = active_loan_labels()
     
-    if not active_loans.empty:
+    if loans:
         with st.form("return_book_form"):
-            selected_loan = st.selectbox(
+            loan_key = st.selectbox(
                 "בחר השאלה להחזרה",
-                ['']+list(active_loans['name_book'] + ' - ' + active_loans['name_loaner'] + ' ' + active_loans['surname'])
+                [None] + list(loans),
+                format_func=lambda loan_key: loans.get(loan_key, '')
             )
             return_date = st.date_input("תאריך החזרה", datetime.now(), format='DD/MM/YYYY')
             
             submitted = st.form_submit_button("החזר ספר")
             
             if submitted:
-                # Find the row in active_loans that matches the selected loan
-                matched_row = active_loans[
-                    (active_loans['name_book'] + ' - ' + active_loans['name_loaner'] + ' ' + active_loans['surname']) == selected_loan
-                ].iloc[0]
-
-                # Find the corresponding index in loans_df (by loaner_id, book_id, and loan_date)
-                mask = (
-                    (loans_df['loaner_id'] == matched_row['loaner_id']) &
-                    (loans_df['book_id'] == matched_row['book_id']) &
-                    (loans_df['loan_date'] == matched_row['loan_date'])
-                )
-                loans_df.loc[mask, 'return_date'] = return_date.strftime('%d/%m/%Y')
-                save_loans(loans_df)
-                st.success("הספר הוחזר בהצלחה!")
-                time.sleep(0.5)
-                st.rerun()
+                if loan_key is None:
+                    st.error("יש לבחור השאלה להחזרה")
+                else:
+                    loaner_id, book_id, loan_date = loan_key
+                    try:
+                        record_return(loaner_id, book_id, loan_date, return_date)
+                    except StaleWriteError:
+                        st.error("השאלה זו כבר הוחזרה על ידי משתמש אחר")
+                    else:
+                        st.success("הספר הוחזר בהצלחה!")
+                        time.sleep(0.5)
+                        st.rerun()
     else:
         st.info("אין השאלות פעילות להחזרה.")
 
-def render_active_loans(books_df, loaners_df, loans_df):
+@profiled
+def render_active_loans():
     """Render the active loans section"""
     st.subheader("📖 השאלות פעילות")
     
-    # Merge loans with book and loaner information first
-    current_loans = loans_df.merge(books_df, left_on='book_id', right_on='id', how='left', suffixes=('_loan', '_book'))
-    current_loans = current_loans.merge(loaners_df, left_on='loaner_id', right_on='id', how='left', suffixes=('_book', '_loaner'))
-    
-    # Create options list from active loans
-    active_loans = current_loans[current_loans['return_date'].isna()]
-    loan_duration = (datetime.today() - pd.to_datetime(active_loans['loan_date'],format='%d/%m/%Y')).dt.days
-    active_loans = pd.concat([active_loans, loan_duration.rename('loan_duration')], axis=1)
-    active_loans = active_loans.fillna("")
-    books_df =books_df.fillna("")
-    # Create search options
-    book_options = sorted(active_loans['name_book'].unique().tolist() + active_loans['author'].unique().tolist())
-    loaner_options = sorted(active_loans['name_loaner'] + ' ' + active_loans['surname'])
-    search_options = [''] + list(set(book_options + loaner_options))
+    # Active loans with book and loaner information
+    active_loans = active_loans_view().fillna({'name_book': '', 'author': '', 'name_loaner': '', 'surname': ''})
     
     col1, col2, col3 = st.columns([1, 1, 1])
     with col1:
-        search_term = st.selectbox("🔍 חיפוש לפי שם ספר, מחבר, או משאיל", 
-                                 options=search_options,
-                                 placeholder='בחר/י לחיפוש...')
+        search_term = st.text_input("🔍 חיפוש לפי שם ספר, מחבר, או משאיל",
+                                    placeholder='הקלד/י לחיפוש...')
     
     # Apply search filter if search term exists
     if search_term:
+        book_ids, loaner_ids = search_all(search_term, limit=None)
         filtered_active_loans = active_loans[
-            (active_loans['name_book'] + ' - ' + active_loans['author']).str.contains(search_term, case=False) |
-            (active_loans['name_loaner'] + ' ' + active_loans['surname']).str.contains(search_term, case=False)
+            active_loans['book_id'].isin(book_ids) | active_loans['loaner_id'].isin(loaner_ids)
         ]
     else:
         filtered_active_loans = active_loans.copy()
 
     # Configure columns for loans table
     loans_columns = {
-        'loan_date': st.column_config.TextColumn('📅 תאריך השאלה', width=150),
+        'loan_date': st.column_config.DateColumn('📅 תאריך השאלה', width=150, format='DD/MM/YYYY'),
         'name_book': st.column_config.TextColumn('📖 שם הספר', width='medium'),
         'author': st.column_config.TextColumn('✍️ מחבר', width=150),
         'name_loaner': st.column_config.TextColumn('👤 שם פרטי', width=150),
@@ -159,23 +152,17 @@ def render_active_loans(books_df, loaners_df, loans_df):
     else:
         st.info("אין השאלות פעילות.")
 
-def render_late_loans(books_df, loaners_df, loans_df):
+@profiled
+def render_late_loans():
     """Render the late loans section"""
     st.subheader("⚠️ השאלות באיחור")
     
-    # Get active loans and calculate duration
-    active_loans = loans_df[loans_df['return_date'].isna()]
-    active_loans = active_loans.merge(books_df, left_on='book_id', right_on='id', how='left')
-    active_loans = active_loans.merge(loaners_df, left_on='loaner_id', right_on='id', how='left', suffixes=('_book', '_loaner'))
-    loan_duration = (datetime.today() - pd.to_datetime(active_loans['loan_date'],format='%d/%m/%Y')).dt.days
-    active_loans = pd.concat([active_loans, loan_duration.rename('loan_duration')], axis=1)
-    
-    # Filter late loans (more than 30 days)
-    late_loans = active_loans[active_loans['loan_duration'] > 30].copy()
+    # Get late loans (more than 30 days)
+    late_loans = late_loans_view()
     
     # Configure columns for late loans table
     late_loans_columns = {
-        'loan_date': st.column_config.TextColumn('📅 תאריך השאלה', width=150),
+        'loan_date': st.column_config.DateColumn('📅 תאריך השאלה', width=150, format='DD/MM/YYYY'),
         'name_book': st.column_config.TextColumn('📖 שם הספר', width='medium'),
         'author': st.column_config.TextColumn('✍️ מחבר', width=150),
         'name_loaner': st.column_config.TextColumn('👤 שם פרטי', width=150),
@@ -1,161 +1,155 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
 import streamlit as st
 import pandas as pd
-from datetime import datetime
-import plotly.express as px
+from methods.aggregates import get_aggregates
+from methods.views import text
+from methods.profiling import profiled
 
-def render_statistics_tab(books_df, loaners_df, loans_df):
+@profiled
+def render_statistics_tab(books_df, loaners_df):
     """Render the statistics tab content"""
     st.title("📊 סטטיסטיקות")
-    stats_df, top_loaners = render_stats_calculations(books_df, loaners_df, loans_df)
-    render_stats_metrics(stats_df, top_loaners)    
-    render_leaderboard(stats_df, top_loaners)    
-    # Calculate metrics
+    # Served from the materialized aggregates, so the cost does not grow with the loan history
+    aggregates = get_aggregates()
+    top_loaners = render_stats_calculations(aggregates, loaners_df)
+    render_stats_metrics(aggregates, top_loaners)
+    render_leaderboard(aggregates, top_loaners)
     
     # Display charts
     col1, col2 = st.columns(2)
     with col1:
-        render_loans_over_time_chart(loans_df)
+        render_loans_over_time_chart(aggregates)
     with col2:
         render_books_by_category_chart(books_df)
-    return stats_df
     
 
-def render_loans_over_time_chart(loans_df):
-    """Render the loans over time chart"""
-    st.subheader("📈 השאלות לאורך זמן")
-    
-    # Convert loan_date to datetime
-    loans_df['loan_date'] = pd.to_datetime(loans_df['loan_date'], format='%d/%m/%Y')
-    loans_df.query('loan_date > "1900-01-01"', inplace=True)
-    # Group by month and count loans
-    monthly_loans = loans_df.groupby(loans_df['loan_date'].dt.to_period('M')).size().reset_index()
-    monthly_loans.columns = ['month', 'count']
-    monthly_loans = monthly_loans.query('count > 25') #TODO: remove this
-    monthly_loans['month'] = monthly_loans['month'].astype(str)
-    
-    # Create line chart
-    fig = px.line(monthly_loans, x='month', y='count', 
-                #   title='מספר השאלות לפי חודש',
-                  labels={'month': 'חודש', 'count': 'מספר השאלות'})
+# Plotly is imported by the figure builders on first use, so the app starts (and
+# the other tabs run) without paying for it; the figures are cached afterwards.
+
+# Months with fewer loans and categories with fewer books are left out of the charts
+MIN_MONTHLY_LOANS = 25
+MIN_CATEGORY_BOOKS = 10
+# Number of built figures kept for reuse across reruns
+FIGURE_CACHE_SIZE = 32
+
+_figures = OrderedDict()
+_figures_lock = threading.Lock()
+
+def _frame_hash(df):
+    """Return a hash of the frame's columns and values"""
+    values = pd.util.hash_pandas_object(df, index=False).values
+    return hashlib.sha1(repr(list(df.columns)).encode() + values.tobytes()).hexdigest()
+
+def cached_figure(name, df, build, **params):
+    """Return build(df, **params), reusing the figure built for the same data and parameters (callers must not modify it)"""
+    key = (name, _frame_hash(df), tuple(sorted(params.items())))
+    with _figures_lock:
+        if key in _figures:
+            _figures.move_to_end(key)
+            return _figures[key]
+    fig = build(df, **params)
+    with _figures_lock:
+        _figures[key] = fig
+        if len(_figures) > FIGURE_CACHE_SIZE:
+            _figures.popitem(last=False)
+    return fig
+
+def _axis_style(**extra):
+    return dict(title_font=dict(size=20), tickfont=dict(size=16, family="Arial, sans-serif"), **extra)
+
+def _style_figure(fig, **layout):
+    """Apply the Hebrew-friendly fonts and side padding shared by all charts"""
     fig.update_layout(
-        xaxis_title='חודש', 
-        yaxis_title='מספר השאלות',
-        # title_x=0.5,
         font=dict(size=16, family="Arial, sans-serif"),
-        xaxis=dict(title_font=dict(size=20), tickfont=dict(size=16, family="Arial, sans-serif")),
-        yaxis=dict(title_font=dict(size=20), tickfont=dict(size=16, family="Arial, sans-serif"))
+        margin=dict(l=150, r=150),  # Add padding to left and right sides
+        **layout
     )
-    fig.update_layout(margin=dict(l=150, r=150))  # Add padding to left and right sides
+    return fig
+
+def _build_loans_over_time_figure(monthly_loans, min_count):
+    import plotly.express as px
+    monthly_loans = monthly_loans[monthly_loans['count'] > min_count]
+    fig = px.line(monthly_loans, x='month', y='count',
+                  labels={'month': 'חודש', 'count': 'מספר השאלות'})
+    return _style_figure(fig, xaxis_title='חודש', yaxis_title='מספר השאלות',
+                         xaxis=_axis_style(), yaxis=_axis_style())
 
+def _build_books_by_category_figure(category_counts, min_count):
+    import plotly.express as px
+    category_counts = category_counts[category_counts['count'] > min_count]
+    category_counts = category_counts.assign(percent=category_counts['count'] / category_counts['count'].sum() * 100)
+    fig = px.pie(category_counts, values='percent', names='category')
+    _style_figure(fig, legend=dict(font=dict(size=16, family="Arial, sans-serif")))
+    fig.update_traces(textinfo='value', texttemplate='%{value:.0f}%')  # Show whole numbers without decimals
+    return fig
+
+def _build_top_bar_figure(top_df, y, y_title, whole_ticks=False):
+    import plotly.express as px
+    fig = px.bar(top_df, x='מספר השאלות', y=y)
+    xaxis = _axis_style(tickmode='linear', dtick=1) if whole_ticks else _axis_style()  # Force ticks to be whole numbers
+    return _style_figure(fig, yaxis_title=y_title, xaxis_title='מספר השאלות',
+                         xaxis=xaxis, yaxis=_axis_style(autorange="reversed"))  # Make highest value appear at top
+
+@profiled
+def render_loans_over_time_chart(aggregates, min_count=MIN_MONTHLY_LOANS):
+    """Render the loans over time chart"""
+    st.subheader("📈 השאלות לאורך זמן")
+    
+    # Monthly loan counts (placeholder dates are already left out), oldest month first
+    monthly_loans = pd.DataFrame(sorted(aggregates['by_month'].items()), columns=['month', 'count'])
+    fig = cached_figure('loans_over_time', monthly_loans, _build_loans_over_time_figure, min_count=min_count)
     st.plotly_chart(fig, use_container_width=True)
 
-def render_books_by_category_chart(books_df):
+@profiled
+def render_books_by_category_chart(books_df, min_count=MIN_CATEGORY_BOOKS):
     """Render the books by category chart"""
     st.subheader("📚 ספרים לפי קטגוריה")
     count_df = books_df.query('active == True and category != "לא ידוע"')
     # Count books by category
-    category_counts = count_df.groupby('category').size().reset_index()
+    category_counts = count_df.groupby(text(count_df['category'])).size().reset_index()
     category_counts.columns = ['category', 'count']
-    category_counts = category_counts.query('count > 10') #TODO: remove this
-    category_counts['percent'] = category_counts['count'] / category_counts['count'].sum() * 100
-    
-    # Create pie chart
-    fig = px.pie(category_counts, values='percent', names='category')
-    fig.update_layout( 
-        # title_x=0.5,
-        font=dict(size=16, family="Arial, sans-serif"),
-        legend=dict(font=dict(size=16, family="Arial, sans-serif"))
-    )
-    fig.update_layout(margin=dict(l=150, r=150))  # Add padding to left and right sides
-    fig.update_traces(textinfo='value', texttemplate='%{value:.0f}%')  # Show whole numbers without decimals
-
+    fig = cached_figure('books_by_category', category_counts, _build_books_by_category_figure, min_count=min_count)
     st.plotly_chart(fig, use_container_width=True)
 
+@profiled
 def render_top_loaners_chart(loaner_counts):
     """Render the top loaners chart"""
-    
-    # Sort and get top 10
-    top_loaners = loaner_counts.sort_values('מספר השאלות', ascending=False).head(10)
-    
-    # Create bar chart
-    fig = px.bar(top_loaners, x='מספר השאלות', y='שם מלא',
-                #  title='📖 השואלים המובילים 🏆'
-                )
-
-    fig.update_layout(
-        yaxis_title='שם השואל',
-        xaxis_title='מספר השאלות',
-        # title_x=0.5, # Center the title
-        font=dict(size=16, family="Arial, sans-serif"), # Set all labels to size 18 with Hebrew-friendly font
-        xaxis=dict(
-            title_font=dict(size=20),
-            tickfont=dict(size=16, family="Arial, sans-serif")
-        ),
-        yaxis=dict(
-            title_font=dict(size=20),
-            tickfont=dict(size=16, family="Arial, sans-serif")
-        )
-    )
-    fig.update_layout(margin=dict(l=150, r=150))  # Add padding to left and right sides
-    fig.update_layout(yaxis=dict(autorange="reversed"))  # Make highest value appear at top
-
+    # Already ranked by the aggregates, get top 10
+    top_loaners = loaner_counts[['מספר השאלות', 'שם מלא']].head(10)
+    fig = cached_figure('top_loaners', top_loaners, _build_top_bar_figure, y='שם מלא', y_title='שם השואל')
     st.plotly_chart(fig, use_container_width=True)
 
+@profiled
 def render_top_books_chart(book_counts):
     """Render the top books chart"""
-    # Sort and get top 10
-    top_books = book_counts.sort_values('מספר השאלות', ascending=False).head(10)
-    top_books.rename(columns={'name_book': 'שם הספר'}, inplace=True)
-    # Create bar chart
-    fig = px.bar(top_books, x='מספר השאלות', y='שם הספר',
-                #  title='📚 הספרים הפופולריים 🏆',
-                )
-
-    fig.update_layout(
-        yaxis_title='שם הספר',
-        xaxis_title='מספר השאלות',
-        # title_x=0.5, # Center the title
-        font=dict(size=16, family="Arial, sans-serif"), # Set all labels to size 18 with Hebrew-friendly font
-        xaxis=dict(
-            title_font=dict(size=20),
-            tickfont=dict(size=16, family="Arial, sans-serif"),
-            tickmode='linear',
-            dtick=1  # Force ticks to be whole numbers
-        ),
-        yaxis=dict(
-            title_font=dict(size=20),
-            tickfont=dict(size=16, family="Arial, sans-serif")
-        )
-    )
-    fig.update_layout(margin=dict(l=150, r=150))  # Add padding to left and right sides
-    fig.update_layout(yaxis=dict(autorange="reversed"))  # Make highest value appear at top
-
+    # Already ranked by the aggregates, get top 10
+    top_books = book_counts[['מספר השאלות', 'name_book']].head(10).rename(columns={'name_book': 'שם הספר'})
+    fig = cached_figure('top_books', top_books, _build_top_bar_figure, y='שם הספר', y_title='שם הספר', whole_ticks=True)
     st.plotly_chart(fig, use_container_width=True)
 
-def render_stats_calculations(books_df, loaners_df, loans_df):
+@profiled
+def render_stats_calculations(aggregates, loaners_df):
     """Render the stats metrics"""
-    # Merge all data for statistics
-    stats_df = loans_df.merge(books_df, left_on='book_id', right_on='id', how='left', suffixes=('_loan', '_book'))
-    stats_df = stats_df.merge(loaners_df, left_on='loaner_id', right_on='id', how='left', suffixes=('_book', '_loaner'))
+    # Loaners ranked by their number of loans
+    top_loaners = pd.DataFrame(aggregates['by_loaner'].top(), columns=['loaner_id', 'מספר השאלות'])
+    loaners = loaners_df.set_index('id')
     
     # Handle deleted loaners
-    stats_df['name_loaner'] = stats_df['name_loaner'].fillna('משאיל לא פעיל')
-    stats_df['surname'] = stats_df['surname'].fillna('')
-    
-    # stats_df.dropna(subset=['return_date'],inplace=True)
-    stats_df['loan_duration'] = (pd.to_datetime(stats_df['return_date'],format='%d/%m/%Y') - pd.to_datetime(stats_df['loan_date'],format='%d/%m/%Y')).dt.days
-    # Count loans per loaner
-    top_loaners = stats_df.groupby(['name_loaner', 'surname']).size().reset_index(name='מספר השאלות')
+    top_loaners['name_loaner'] = top_loaners['loaner_id'].map(loaners['name']).fillna('משאיל לא פעיל')
+    top_loaners['surname'] = top_loaners['loaner_id'].map(loaners['surname']).fillna('')
 
-    return stats_df, top_loaners
+    return top_loaners
 
 
-def render_stats_metrics(stats_df, top_loaners):
+@profiled
+def render_stats_metrics(aggregates, top_loaners):
     """Render the stats table"""
-    # Calculate metrics from stats_df
-    total_loans = len(stats_df)
-    avg_loan_duration = stats_df['loan_duration'].mean(skipna=True)
-    avg_loan_duration = avg_loan_duration if not pd.isna(avg_loan_duration) else 0
+    # Calculate metrics from the running totals
+    total_loans = aggregates['total_loans']
+    avg_loan_duration = aggregates['duration_sum'] / aggregates['duration_count'] if aggregates['duration_count'] else 0
     avg_loans_per_loaner = top_loaners['מספר השאלות'].mean()#stats_df['loaner_id'].nunique() / stats_df['loaner_id'].count()
     # max_loan_duration = stats_df['loan_duration'].max()
     # total_unique_loaners = len(stats_df['loaner_id'].unique())
@@ -172,19 +166,14 @@ def render_stats_metrics(stats_df, top_loaners):
     
     st.markdown("---")
 
-def render_leaderboard(stats_df, top_loaners):
-    # Reorder columns to show return date before loan date
-    stats_df = stats_df[['name_loaner', 'surname', 'name_book', 'author', 'loan_date', 'return_date', 'loan_duration']]
-    
+@profiled
+def render_leaderboard(aggregates, top_loaners):
     # Create two columns for side-by-side display
-    
-    
     col1, col2 = st.columns(2)
 
     with col1:
         st.subheader("👥 משאילים מובילים")
-        top_loaners = top_loaners.sort_values('מספר השאלות', ascending=False)
-        top_loaners['שם מלא'] = top_loaners['name_loaner'] + ' ' + top_loaners['surname']
+        top_loaners['שם מלא'] = text(top_loaners['name_loaner']) + ' ' + text(top_loaners['surname'])
         render_top_loaners_chart(top_loaners)
         
         # Configure columns for top loaners
@@ -203,9 +192,9 @@ def render_leaderboard(stats_df, top_loaners):
     
     with col2:
         st.subheader("📚 ספרים פופולריים")
-        # Count loans per book
-        top_books = stats_df.groupby(['name_book', 'author']).size().reset_index(name='מספר השאלות')
-        top_books = top_books.sort_values('מספר השאלות', ascending=False)
+        # Book titles ranked by their number of loans (all copies of a title count together)
+        top_books = pd.DataFrame([(name, author, count) for (name, author), count in aggregates['by_title'].top()],
+                                 columns=['name_book', 'author', 'מספר השאלות'])
         render_top_books_chart(top_books)
         
         # Configure columns for top books
@@ -0,0 +1,144 @@
+import streamlit as st
+import pandas as pd
+import math
+import paths
+from methods import exports, memory, profiling
+from methods.search import DEFAULT_LIMIT
+
+def setup_page():
+    """Set up the Streamlit page configuration and styling"""
+    st.set_page_config(
+        page_title="ספרייה פשוטה",
+        page_icon="📚",
+        layout="wide",
+        initial_sidebar_state="collapsed"
+    )
+    st.markdown("<h1 style='text-align: center;'>📚 ספרייה קהילתית 🌳</h1>", unsafe_allow_html=True)
+    st.markdown(
+        """
+        <style>
+        .stApp {
+            direction: rtl;
+        }
+        /* Make the section navigation spread equally along the width */
+        .stRadio [role="radiogroup"] {
+            display: flex !important;
+            justify-content: stretch !important;
+            width: 100% !important;
+            gap: 0 !important;
+        }
+        .stRadio [role="radiogroup"] > label {
+            flex: 1 1 0 !important;
+            justify-content: center !important;
+            min-width: 0 !important;
+            max-width: 100% !important;
+        }
+        .stRadio [role="radiogroup"] > label p {
+            font-size: 1.2rem !important;
+        }
+        </style>
+        """,
+        unsafe_allow_html=True,
+    )
+
+
+# Page sizes offered by the paginated tables
+PAGE_SIZES = [25, 50, 100, 250]
+
+def render_pagination(key, total_rows, sort_columns):
+    """Render sort and paging controls for a table and return (page, page_size, sort_by, ascending)"""
+    col1, col2, col3, col4 = st.columns([2, 1, 1, 1])
+    with col1:
+        sort_by = st.selectbox("מיון לפי", list(sort_columns), format_func=sort_columns.get, key=f"{key}_sort")
+    with col2:
+        ascending = st.selectbox("סדר", [True, False], format_func=lambda x: "עולה" if x else "יורד", key=f"{key}_order")
+    with col3:
+        page_size = st.selectbox("שורות בעמוד", PAGE_SIZES, key=f"{key}_page_size")
+    pages = max(1, math.ceil(total_rows / page_size))
+    # Filters or a larger page size may leave the remembered page out of range
+    if st.session_state.get(f"{key}_page", 1) > pages:
+        st.session_state[f"{key}_page"] = pages
+    with col4:
+        page = st.number_input(f"עמוד (מתוך {pages})", min_value=1, max_value=pages, step=1, key=f"{key}_page")
+    return int(page), page_size, sort_by, ascending
+
+def editor_changes(editor_key, page_df, editable_columns):
+    """Return (changes, expected) for the edits made in a data editor, page_df being the id-indexed frame it shows
+
+    changes maps each edited id to {column: new value} of its editable_columns (computed columns such as the
+    status are dropped), expected to the values the editor showed before the edit.
+    """
+    edited_rows = st.session_state.get(editor_key, {}).get('edited_rows', {})
+    changes = {int(page_df.index[int(position)]): edited for position, values in edited_rows.items()
+               if (edited := {column: value for column, value in values.items() if column in editable_columns})}
+    expected = {row_id: {column: page_df.at[row_id, column] for column in values} for row_id, values in changes.items()}
+    return changes, expected
+
+def search_options(search, term, exclude=()):
+    """Return [None] followed by the ids of the best DEFAULT_LIMIT matches of term that are not in exclude (none without a term)"""
+    if not term:
+        return [None]
+    ids = search(term, limit=None) if exclude else search(term)
+    return [None] + [i for i in ids if i not in exclude][:DEFAULT_LIMIT]
+
+def render_search_picker(label, search, labels, key, none_label='', on_change=None):
+    """Render a search box and a selectbox of its best matches, and return the chosen id (None if nothing was chosen)
+
+    Only the matches are sent to the browser, so the picker stays small however many records there are.
+    """
+    term = st.text_input(f"🔍 {label}", key=f"{key}_search", placeholder='הקלד/י לחיפוש...', on_change=on_change)
+    return st.selectbox(label, search_options(search, term), format_func=lambda i: labels.get(i, none_label),
+                        key=key, on_change=on_change)
+
+def render_export(name, label, build, filters=()):
+    """Render a download of the frame build() returns, written only when asked for and reused until the data or filters change
+
+    The file is only read in the session that asked for it, until it is downloaded; other sessions and reruns
+    just show the prepare button (which reuses the cached file).
+    """
+    col1, col2 = st.columns([1, 1])
+    with col1:
+        fmt = st.selectbox("פורמט קובץ", list(exports.FORMATS), format_func=lambda x: exports.FORMATS[x][0],
+                           key=f"{name}_export_format")
+    requested_key = f"{name}_export_requested"
+    path = exports.export_path(name, fmt, filters)
+    with col2:
+        data = _read_export(path) if st.session_state.get(requested_key) == path else None
+        if data is None and st.button(f"הכן קובץ: {label}", key=f"{name}_export_btn"):
+            with st.spinner("מכין את הקובץ..."):
+                st.session_state[requested_key] = path = exports.export(name, fmt, build, filters)
+                data = _read_export(path)
+        if data is not None and st.download_button(label=label, data=data, file_name=f"{name}.{fmt}",
+                                                   mime=exports.FORMATS[fmt][1], key=f"{name}_export_download"):
+            del st.session_state[requested_key]
+
+def _read_export(path):
+    """Return the contents of a cached export, or None if it was not written (or was pruned meanwhile)"""
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def render_memory_report():
+    """Render the memory used by the shared frames and by this session"""
+    with st.expander("🧠 שימוש בזיכרון"):
+        report = pd.DataFrame(memory.memory_report(), columns=['frame', 'rows', 'bytes', 'plain_bytes'])
+        st.dataframe(report, hide_index=True, use_container_width=True)
+        rss = memory.process_rss()
+        st.caption(f"סה״כ טבלאות משותפות: {memory.format_bytes(int(report['bytes'].sum()))}"
+                   + (f" | זיכרון התהליך: {memory.format_bytes(rss)}" if rss is not None else ""))
+        session = pd.DataFrame(memory.session_report(st.session_state), columns=['key', 'bytes'])
+        st.dataframe(session, hide_index=True, use_container_width=True)
+        st.caption(f"סה״כ בזיכרון הסשן: {memory.format_bytes(int(session['bytes'].sum()))}")
+
+def render_profile_report(history):
+    """Render the timings of the last rerun and their percentiles over the profiled reruns of this session"""
+    last = history[-1]
+    with st.expander(f"⏱️ זמני ריצה ({last['total'] * 1000:.0f} ms)"):
+        st.dataframe(profiling.breakdown(last), hide_index=True, use_container_width=True,
+                     column_config={'ms': st.column_config.NumberColumn(format='%.1f'),
+                                    '% of rerun': st.column_config.NumberColumn(format='%.0f%%')})
+        st.caption(f"אחוזונים על פני {len(history)} הריצות האחרונות בסשן")
+        st.dataframe(profiling.percentiles(history), hide_index=True, use_container_width=True)
+        st.caption(f"כל ריצה נשמרת ב-{paths.profile_log_path}" + (f" | cProfile: {last['cprofile']}" if 'cprofile' in last else ""))